@@ -3,6 +3,10 @@ from flask import Flask
 from .config import Config
 from .extensions import db, login_manager, migrate
 from .models import User
+from .services.llm import configure_http_pool
+from .services.ratelimit import configure_rate_limiter
+from .services.runner import configure_runner
+from .services.scheduler import configure_scheduler
 
 
 def create_app():
@@ -26,6 +30,21 @@ def create_app():
         if path:
             os.makedirs(path, exist_ok=True)
 
+    configure_http_pool(app.config["OPENROUTER_POOL_SIZE"], app.config["OPENROUTER_TCP_KEEPALIVE"])
+    configure_rate_limiter(
+        enabled=app.config["OPENROUTER_RATE_LIMIT_ENABLED"],
+        redis_url=app.config["CELERY_BROKER_URL"],
+        rate=app.config["OPENROUTER_RATE_LIMIT_RPS"],
+        burst=app.config["OPENROUTER_RATE_LIMIT_BURST"],
+        initial_concurrency=app.config["OPENROUTER_INITIAL_CONCURRENCY"],
+        max_concurrency=app.config["OPENROUTER_MAX_CONCURRENCY"],
+    )
+    configure_scheduler(
+        enabled=app.config["SCHEDULER_ENABLED"],
+        max_concurrency=app.config["SCHEDULER_MAX_CONCURRENCY"],
+        per_user_concurrency=app.config["SCHEDULER_USER_CONCURRENCY"],
+    )
+
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
@@ -43,6 +62,15 @@ def create_app():
     with app.app_context():
         db.create_all()
 
+    configure_runner(
+        app,
+        enabled=app.config["BACKGROUND_RUNNER_ENABLED"] and app.config["CELERY_TASK_ALWAYS_EAGER"],
+        workers=app.config["BACKGROUND_RUNNER_WORKERS"],
+        poll_seconds=app.config["BACKGROUND_RUNNER_POLL_SECONDS"],
+        stale_seconds=app.config["BACKGROUND_RUNNER_STALE_SECONDS"],
+        max_attempts=app.config["BACKGROUND_RUNNER_MAX_ATTEMPTS"],
+    )
+
     return app
 
 
@@ -8,11 +8,60 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
     OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-3-flash-preview")
+    OPENROUTER_FAST_MODEL = os.getenv("OPENROUTER_FAST_MODEL", "")
+    OPENROUTER_STRONG_MODEL = os.getenv("OPENROUTER_STRONG_MODEL", "")
+    OPENROUTER_FALLBACK_MODELS = os.getenv("OPENROUTER_FALLBACK_MODELS", "")
+    ROUTING_SHORT_CHUNK_TOKENS = int(os.getenv("ROUTING_SHORT_CHUNK_TOKENS", "300"))
+    ROUTING_LONG_CHUNK_TOKENS = int(os.getenv("ROUTING_LONG_CHUNK_TOKENS", "1500"))
+    ROUTING_MATH_MIN_EXPRESSIONS = int(os.getenv("ROUTING_MATH_MIN_EXPRESSIONS", "3"))
     OPENROUTER_SITE_URL = os.getenv("OPENROUTER_SITE_URL", "")
     OPENROUTER_APP_NAME = os.getenv("OPENROUTER_APP_NAME", "AnkiGPT")
     OPENROUTER_TIMEOUT_SECONDS = float(os.getenv("OPENROUTER_TIMEOUT_SECONDS", "120"))
     OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
     OPENROUTER_RETRY_BACKOFF_SECONDS = float(os.getenv("OPENROUTER_RETRY_BACKOFF_SECONDS", "1.5"))
+    OPENROUTER_STREAMING = os.getenv("OPENROUTER_STREAMING", "true").lower() == "true"
+    OPENROUTER_POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", "16"))
+    OPENROUTER_TCP_KEEPALIVE = os.getenv("OPENROUTER_TCP_KEEPALIVE", "true").lower() == "true"
+    OPENROUTER_RATE_LIMIT_ENABLED = os.getenv("OPENROUTER_RATE_LIMIT_ENABLED", "true").lower() == "true"
+    OPENROUTER_RATE_LIMIT_RPS = float(os.getenv("OPENROUTER_RATE_LIMIT_RPS", "10"))
+    OPENROUTER_RATE_LIMIT_BURST = int(os.getenv("OPENROUTER_RATE_LIMIT_BURST", "20"))
+    OPENROUTER_INITIAL_CONCURRENCY = int(os.getenv("OPENROUTER_INITIAL_CONCURRENCY", "8"))
+    OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "64"))
+    OPENROUTER_HEDGE_ENABLED = os.getenv("OPENROUTER_HEDGE_ENABLED", "false").lower() == "true"
+    OPENROUTER_HEDGE_PERCENTILE = float(os.getenv("OPENROUTER_HEDGE_PERCENTILE", "95"))
+    OPENROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("OPENROUTER_HEDGE_MIN_SAMPLES", "20"))
+    OPENROUTER_HEDGE_MODEL = os.getenv("OPENROUTER_HEDGE_MODEL", "")
+    GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+    GENERATION_MAX_OUTPUT_TOKENS = int(os.getenv("GENERATION_MAX_OUTPUT_TOKENS", "8192"))
+    GENERATION_MAX_CONTINUATIONS = int(os.getenv("GENERATION_MAX_CONTINUATIONS", "2"))
+    GENERATION_MAX_HEDGES = int(os.getenv("GENERATION_MAX_HEDGES", "4"))
+    GENERATION_BISECT_MAX_DEPTH = int(os.getenv("GENERATION_BISECT_MAX_DEPTH", "3"))
+    GENERATION_PACK_MAX_TOKENS = int(os.getenv("GENERATION_PACK_MAX_TOKENS", "1500"))
+    GENERATION_PACK_SMALL_TOKENS = int(os.getenv("GENERATION_PACK_SMALL_TOKENS", "300"))
+    GENERATION_RETRY_ROUNDS = int(os.getenv("GENERATION_RETRY_ROUNDS", "2"))
+    GENERATION_RETRY_DELAY_SECONDS = float(os.getenv("GENERATION_RETRY_DELAY_SECONDS", "30"))
+    GENERATION_SUBTASKS = os.getenv("GENERATION_SUBTASKS", "false").lower() == "true"
+    SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "false").lower() == "true"
+    CHUNK_TASK_MAX_RETRIES = int(os.getenv("CHUNK_TASK_MAX_RETRIES", "2"))
+    CHUNK_TASK_RETRY_DELAY_SECONDS = float(os.getenv("CHUNK_TASK_RETRY_DELAY_SECONDS", "10"))
+    CHUNK_TASK_SOFT_TIME_LIMIT = float(os.getenv("CHUNK_TASK_SOFT_TIME_LIMIT", "600"))
+    CHUNK_TASK_TIME_LIMIT = float(os.getenv("CHUNK_TASK_TIME_LIMIT", "660"))
+    IMPROVE_BATCH_SIZE = int(os.getenv("IMPROVE_BATCH_SIZE", "20"))
+    SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.getenv("SINGLE_FLIGHT_TIMEOUT_SECONDS", "900"))
+    SINGLE_FLIGHT_RETRY_SECONDS = float(os.getenv("SINGLE_FLIGHT_RETRY_SECONDS", "5"))
+    PROGRESS_STREAM_INTERVAL_SECONDS = float(os.getenv("PROGRESS_STREAM_INTERVAL_SECONDS", "2"))
+    PROGRESS_STREAM_HEARTBEAT_SECONDS = float(os.getenv("PROGRESS_STREAM_HEARTBEAT_SECONDS", "15"))
+    PROGRESS_STREAM_MAX_SECONDS = float(os.getenv("PROGRESS_STREAM_MAX_SECONDS", "30"))
+    PROGRESS_POLL_SECONDS = float(os.getenv("PROGRESS_POLL_SECONDS", "5"))
+    SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+    SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "16"))
+    SCHEDULER_USER_CONCURRENCY = int(os.getenv("SCHEDULER_USER_CONCURRENCY", "8"))
+    SCHEDULER_DISPATCH_CONCURRENCY = int(os.getenv("SCHEDULER_DISPATCH_CONCURRENCY", "32"))
+    SCHEDULER_SMALL_DECK_CHUNKS = int(os.getenv("SCHEDULER_SMALL_DECK_CHUNKS", "10"))
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+    LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+    STATS_LOG_SECONDS = float(os.getenv("STATS_LOG_SECONDS", "300"))
     AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "true").lower() == "true"
     UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "1024"))
     MAX_CONTENT_LENGTH = UPLOAD_MAX_MB * 1024 * 1024
@@ -23,6 +72,11 @@ class Config:
     CELERY_ALWAYS_EAGER = os.getenv("CELERY_ALWAYS_EAGER", "true").lower() == "true"
     CELERY_TASK_ALWAYS_EAGER = CELERY_ALWAYS_EAGER or not bool(CELERY_BROKER_URL)
     CELERY_TASK_EAGER_PROPAGATES = True
+    BACKGROUND_RUNNER_ENABLED = os.getenv("BACKGROUND_RUNNER_ENABLED", "true").lower() == "true"
+    BACKGROUND_RUNNER_WORKERS = int(os.getenv("BACKGROUND_RUNNER_WORKERS", "2"))
+    BACKGROUND_RUNNER_POLL_SECONDS = float(os.getenv("BACKGROUND_RUNNER_POLL_SECONDS", "1"))
+    BACKGROUND_RUNNER_STALE_SECONDS = float(os.getenv("BACKGROUND_RUNNER_STALE_SECONDS", "60"))
+    BACKGROUND_RUNNER_MAX_ATTEMPTS = int(os.getenv("BACKGROUND_RUNNER_MAX_ATTEMPTS", "3"))
     DEFAULT_CARD_STYLE = "basic"
     DEFAULT_DIFFICULTY = "intermediate"
     DEFAULT_TARGET_CARDS = 30
@@ -32,6 +32,9 @@ class Deck(db.Model):
     user = db.relationship("User", backref="decks")
     sources = db.relationship("Source", backref="deck", cascade="all, delete-orphan")
     cards = db.relationship("Card", backref="deck", cascade="all, delete-orphan")
+    jobs = db.relationship("BulkJob", backref="deck", cascade="all, delete-orphan")
+    progress = db.relationship("GenerationProgress", uselist=False, cascade="all, delete-orphan")
+    dispatches = db.relationship("ChunkDispatch", cascade="all, delete-orphan")
 
 
 class Source(db.Model):
@@ -75,3 +78,86 @@ class LLMRun(db.Model):
     error = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+
+
+class LLMCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True, index=True, nullable=False)
+    model = db.Column(db.String(100))
+    prompt_version = db.Column(db.String(50))
+    response_text = db.Column(db.Text)
+    parsed_json = db.Column(db.JSON)
+    input_tokens = db.Column(db.Integer)
+    output_tokens = db.Column(db.Integer)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class BulkJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    deck_id = db.Column(db.Integer, db.ForeignKey("deck.id"), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    applied = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class GenerationProgress(db.Model):
+    deck_id = db.Column(db.Integer, db.ForeignKey("deck.id"), primary_key=True)
+    total_chunks = db.Column(db.Integer, nullable=False, default=0)
+    done_chunks = db.Column(db.Integer, nullable=False, default=0)
+    initial_done = db.Column(db.Integer, nullable=False, default=0)
+    failed_chunks = db.Column(db.Integer, nullable=False, default=0)
+    cards_created = db.Column(db.Integer, nullable=False, default=0)
+    cards_auto_deleted = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ChunkDispatch(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    deck_id = db.Column(db.Integer, db.ForeignKey("deck.id"), nullable=False, index=True)
+    source_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    priority = db.Column(db.String(20), nullable=False)
+    run_token = db.Column(db.String(64), nullable=False, index=True)
+    lock_name = db.Column(db.String(200), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="waiting", index=True)
+    errors = db.Column(db.JSON)
+    auto_deleted = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    dispatched_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+class ResourceLock(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), unique=True, nullable=False)
+    token = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    finished_at = db.Column(db.DateTime)
+    result = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class BackgroundTask(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    args = db.Column(db.JSON)
+    status = db.Column(db.String(20), nullable=False, default="queued", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    owner = db.Column(db.String(120))
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    heartbeat_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
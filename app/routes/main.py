@@ -1,13 +1,40 @@
+import json
 import os
-from flask import Blueprint, current_app, flash, redirect, render_template, request, send_file, url_for
+import time
+import uuid
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask_login import current_user
+from werkzeug.utils import secure_filename
+from sqlalchemy import func
 from ..extensions import db
 from ..models import Card, Deck, LLMRun, Source, User
-from ..services.pdf import extract_pdf_text
+from ..services import chunk_queue
+from ..services.pdf import count_pdf_pages, extract_pdf_text
 from ..services.validators import is_valid_cloze
-from ..services.deckgen import regenerate_source, improve_card
+from ..services.deckgen import DEFAULT_GENERATION_SETTINGS, discard_upload, improve_card, pending_upload
 from ..services.export import export_deck as export_deck_file
-from ..tasks import generate_deck_task
+from ..services.jobs import create_job, deck_jobs
+from ..services.progress import progress_snapshot
+from ..tasks import (
+    generate_deck_task,
+    improve_cards_task,
+    queue_task,
+    regenerate_sources_task,
+    resume_deck_task,
+    speculate_deck_task,
+)
 
 bp = Blueprint("main", __name__)
 
@@ -55,8 +82,10 @@ def delete_deck(deck_id):
     if deck.user_id != user.id:
         flash("Not authorized to delete this deck", "error")
         return redirect(url_for("main.decks"))
+    upload = pending_upload(deck)
     db.session.delete(deck)
     db.session.commit()
+    discard_upload(upload)
     return redirect(url_for("main.decks"))
 
 
@@ -80,12 +109,38 @@ def new_deck():
             if not pdf_file:
                 flash("PDF file is required", "error")
                 return render_template("deck_new.html")
-            filename = pdf_file.filename
+            # Unique per upload: streamed decks read the file after this request returns.
+            filename = f"{uuid.uuid4().hex}-{secure_filename(pdf_file.filename) or 'upload.pdf'}"
             upload_path = os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
             pdf_file.save(upload_path)
             start = int(page_start) if page_start else None
             end = int(page_end) if page_end else None
-            source_text, total_pages = extract_pdf_text(upload_path, start, end)
+            if request.form.get("stream"):
+                # Skips the preview: pages are extracted by the generation task and each chunk goes to
+                # the LLM as soon as it is parsed, with the default settings.
+                pages = count_pdf_pages(upload_path, start, end)
+                upload = {"path": upload_path, "page_start": start, "page_end": end, "pages": pages}
+                if not pages:
+                    discard_upload(upload)
+                    flash("No pages in the selected range", "error")
+                    return render_template("deck_new.html")
+                deck = Deck(
+                    user_id=get_actor().id,
+                    title=title,
+                    card_style=card_style,
+                    status="processing",
+                    source_type=source_type,
+                    source_text="",
+                    settings_json=dict(DEFAULT_GENERATION_SETTINGS, pdf_upload=upload),
+                )
+                db.session.add(deck)
+                db.session.commit()
+                queue_task(generate_deck_task, (deck.id,))
+                return redirect(url_for("main.status", deck_id=deck.id))
+            try:
+                source_text, total_pages = extract_pdf_text(upload_path, start, end)
+            finally:
+                discard_upload({"path": upload_path})
         if not source_text:
             flash("No text could be extracted", "error")
             return render_template("deck_new.html")
@@ -99,8 +154,13 @@ def new_deck():
             source_text=source_text,
             settings_json={},
         )
+        speculative = current_app.config.get("SPECULATIVE_GENERATION")
+        if speculative:
+            deck.settings_json = dict(DEFAULT_GENERATION_SETTINGS, speculative=True)
         db.session.add(deck)
         db.session.commit()
+        if speculative:
+            queue_task(speculate_deck_task, (deck.id,))
         return redirect(url_for("main.preview_deck", deck_id=deck.id))
     return render_template("deck_new.html")
 
@@ -116,33 +176,139 @@ def preview_deck(deck_id):
             "focus": request.form.get("focus", ""),
             "exclude": request.form.get("exclude", ""),
             "glossary": request.form.get("glossary", ""),
-            "max_chars": int(request.form.get("max_chars") or 3500),
+            "max_chars": int(request.form.get("max_chars") or DEFAULT_GENERATION_SETTINGS["max_chars"]),
         }
+        split_sources = (deck.settings_json or {}).get("split_sources")
+        if split_sources:
+            settings["split_sources"] = split_sources
         deck.settings_json = settings
+        deck.status = "processing"
         db.session.commit()
-        try:
-            generate_deck_task.delay(deck.id)
-        except Exception:
-            generate_deck_task.apply(args=(deck.id,))
+        queue_task(generate_deck_task, (deck.id,))
         return redirect(url_for("main.status", deck_id=deck.id))
     return render_template("deck_preview.html", deck=deck)
 
 
+@bp.route("/decks/<int:deck_id>/resume", methods=["POST"])
+def resume_deck(deck_id):
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    user = get_actor()
+    if deck.user_id != user.id:
+        flash("Not authorized to resume this deck", "error")
+        return redirect(url_for("main.decks"))
+    updated_settings = dict(deck.settings_json or {})
+    updated_settings.pop("retry_round", None)
+    deck.settings_json = updated_settings
+    deck.status = "processing"
+    db.session.commit()
+    queue_task(resume_deck_task, (deck.id,))
+    return redirect(url_for("main.status", deck_id=deck.id))
+
+
+@bp.route("/decks/<int:deck_id>/cancel", methods=["POST"])
+def cancel_deck(deck_id):
+    # Running generation notices the status between chunks and aborts its in-flight requests.
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    user = get_actor()
+    wants_json = request.accept_mimetypes.best == "application/json"
+    if deck.user_id != user.id:
+        if wants_json:
+            return jsonify(error="Not authorized to cancel this deck"), 403
+        flash("Not authorized to cancel this deck", "error")
+        return redirect(url_for("main.decks"))
+    if deck.status == "processing":
+        deck.status = "cancelled"
+        db.session.commit()
+    if wants_json:
+        return jsonify(deck_id=deck.id, status=deck.status)
+    return redirect(url_for("main.status", deck_id=deck.id))
+
+
 @bp.route("/decks/<int:deck_id>/status")
 def status(deck_id):
     redirect_resp = guard_auth()
     if redirect_resp:
         return redirect_resp
     deck = Deck.query.get_or_404(deck_id)
-    total_sources = Source.query.filter_by(deck_id=deck_id).count()
-    done_sources = min(LLMRun.query.filter_by(deck_id=deck_id).count(), total_sources)
+    progress = progress_snapshot(deck_id)
+    if progress:
+        total_sources = progress["total_chunks"]
+        done_sources = progress["done_chunks"]
+    else:
+        # Decks generated before progress counters existed.
+        total_sources = Source.query.filter_by(deck_id=deck_id).count()
+        done_sources = min(
+            LLMRun.query.filter_by(deck_id=deck_id, error=None).with_entities(LLMRun.source_id).distinct().count(),
+            total_sources,
+        )
     failure_message = (deck.settings_json or {}).get("last_error") or "Generation failed."
     return render_template(
         "deck_status.html",
         deck=deck,
         total_sources=total_sources,
         done_sources=done_sources,
+        progress=progress,
         failure_message=failure_message,
+        poll_seconds=float(current_app.config.get("PROGRESS_POLL_SECONDS", 5)),
+    )
+
+
+def deck_progress(deck):
+    return progress_snapshot(deck.id) or {"deck_id": deck.id, "status": deck.status}
+
+
+@bp.route("/decks/<int:deck_id>/progress")
+def progress_json(deck_id):
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    return jsonify(deck_progress(deck))
+
+
+@bp.route("/decks/<int:deck_id>/progress/stream")
+def progress_stream(deck_id):
+    # Server-Sent Events: a progress snapshot whenever it changes, and a comment line as heartbeat
+    # otherwise, until the deck leaves processing. Each stream is short (PROGRESS_STREAM_MAX_SECONDS)
+    # so it never pins a worker; EventSource reconnects after the `retry` delay.
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    interval = max(0.1, float(current_app.config.get("PROGRESS_STREAM_INTERVAL_SECONDS", 2)))
+    heartbeat = float(current_app.config.get("PROGRESS_STREAM_HEARTBEAT_SECONDS", 15))
+    max_seconds = float(current_app.config.get("PROGRESS_STREAM_MAX_SECONDS", 30))
+    retry_ms = int(float(current_app.config.get("PROGRESS_POLL_SECONDS", 5)) * 1000)
+
+    @stream_with_context
+    def events():
+        deadline = time.monotonic() + max_seconds
+        last, last_sent = None, time.monotonic()
+        yield f"retry: {retry_ms}\n\n"
+        while True:
+            snapshot = deck_progress(deck)
+            # Hands the connection back to the pool while sleeping.
+            db.session.rollback()
+            if snapshot != last:
+                last, last_sent = snapshot, time.monotonic()
+                yield f"data: {json.dumps(snapshot)}\n\n"
+            elif time.monotonic() - last_sent >= heartbeat:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            if snapshot["status"] != "processing" or time.monotonic() + interval > deadline:
+                return
+            time.sleep(interval)
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
@@ -179,7 +345,47 @@ def deck_editor(deck_id):
     if status:
         query = query.filter_by(status=status)
     cards = query.order_by(Card.created_at.desc()).all()
-    return render_template("deck_editor.html", deck=deck, cards=cards, q=q, card_type=card_type, status=status)
+    return render_template(
+        "deck_editor.html",
+        deck=deck,
+        cards=cards,
+        q=q,
+        card_type=card_type,
+        status=status,
+        jobs=deck_jobs(deck_id),
+        last_card_id=db.session.query(func.max(Card.id)).filter(Card.deck_id == deck_id).scalar() or 0,
+    )
+
+
+@bp.route("/decks/<int:deck_id>/cards/live")
+def live_cards(deck_id):
+    # Cards persisted since `after`, newest first, plus an out-of-band poller carrying the new cursor.
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    after = request.args.get("after", 0, type=int)
+    cards = Card.query.filter(Card.deck_id == deck_id, Card.id > after).order_by(Card.id.desc()).all()
+    last_card_id = cards[0].id if cards else after
+    return render_template("partials/live_cards.html", deck=deck, cards=cards, last_card_id=last_card_id, oob=True)
+
+
+@bp.route("/decks/<int:deck_id>/jobs")
+def deck_job_progress(deck_id):
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    deck = Deck.query.get_or_404(deck_id)
+    return render_template("partials/job_progress.html", deck=deck, jobs=deck_jobs(deck_id))
+
+
+@bp.route("/queue")
+def queue_depth():
+    redirect_resp = guard_auth()
+    if redirect_resp:
+        return redirect_resp
+    user = get_actor()
+    return jsonify(user_id=user.id, **chunk_queue.queue_depth(user.id))
 
 
 @bp.route("/cards/<int:card_id>", methods=["POST"])
@@ -225,10 +431,18 @@ def bulk_cards():
     elif action == "restore":
         for card in cards:
             card.status = "ok"
-    elif action == "regenerate":
-        source_ids = {card.source_id for card in cards if card.source_id}
-        for source_id in source_ids:
-            regenerate_source(source_id)
+    elif action == "regenerate" and cards:
+        deck_id = cards[0].deck_id
+        source_ids = sorted({card.source_id for card in cards if card.source_id and card.deck_id == deck_id})
+        job = create_job(deck_id, "regenerate", total=len(source_ids))
+        queue_task(regenerate_sources_task, (job.id, source_ids))
+        flash(f"Regenerating {len(source_ids)} sections in the background.", "info")
+    elif action == "improve" and cards:
+        deck_id = cards[0].deck_id
+        card_ids = [card.id for card in cards if card.deck_id == deck_id and card.status != "deleted"]
+        job = create_job(deck_id, "improve", total=len(card_ids))
+        queue_task(improve_cards_task, (job.id, card_ids))
+        flash(f"Improving {len(card_ids)} cards in the background.", "info")
     db.session.commit()
     return redirect(request.referrer or url_for("main.decks"))
 
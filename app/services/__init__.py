@@ -1 +1 @@
-__all__ = ["chunking", "deckgen", "export", "llm", "pdf", "schemas", "validators"]
+__all__ = ["cache", "chunk_queue", "chunking", "deckgen", "export", "jobs", "llm", "locks", "pdf", "progress", "ratelimit", "routing", "runner", "scheduler", "schemas", "validators"]
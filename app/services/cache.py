@@ -0,0 +1,121 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from .chunking import hash_text
+from ..extensions import db
+from ..models import LLMCache
+
+
+CACHE_SETTING_KEYS = ("focus", "exclude", "glossary")
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def _bump(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def cache_enabled():
+    return bool(current_app.config.get("LLM_CACHE_ENABLED", True))
+
+
+def settings_fingerprint(prompt_version, model, card_style, settings):
+    # Everything besides the chunk text that changes what the LLM is asked to produce.
+    material = {
+        "prompt_version": prompt_version,
+        "model": model,
+        "card_style": card_style,
+        "settings": {key: (settings or {}).get(key, "") for key in CACHE_SETTING_KEYS},
+    }
+    return hash_text(json.dumps(material, sort_keys=True))
+
+
+def cache_key(source_hash, prompt_version, model, card_style, settings):
+    return hash_text(f"{source_hash}:{settings_fingerprint(prompt_version, model, card_style, settings)}")
+
+
+def _expiry_cutoff():
+    ttl_seconds = float(current_app.config.get("LLM_CACHE_TTL_SECONDS", 0))
+    if ttl_seconds <= 0:
+        return None
+    return datetime.utcnow() - timedelta(seconds=ttl_seconds)
+
+
+def get_cached(key):
+    if not cache_enabled():
+        return None
+    entry = LLMCache.query.filter_by(key=key).first()
+    if entry is None:
+        _bump("misses")
+        return None
+    cutoff = _expiry_cutoff()
+    if cutoff and entry.created_at and entry.created_at < cutoff:
+        db.session.delete(entry)
+        db.session.commit()
+        _bump("misses")
+        _bump("evictions")
+        return None
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = datetime.utcnow()
+    db.session.commit()
+    _bump("hits")
+    return entry
+
+
+def store_cached(key, model, prompt_version, response_text, parsed_json, usage=None):
+    if not cache_enabled():
+        return None
+    usage = usage or {}
+    entry = LLMCache.query.filter_by(key=key).first()
+    if entry is None:
+        entry = LLMCache(key=key, hits=0)
+        try:
+            with db.session.begin_nested():
+                db.session.add(entry)
+        except IntegrityError:
+            # Another worker stored the same chunk concurrently; keep its entry.
+            return LLMCache.query.filter_by(key=key).first()
+    entry.model = model
+    entry.prompt_version = prompt_version
+    entry.response_text = response_text
+    entry.parsed_json = parsed_json
+    entry.input_tokens = usage.get("prompt_tokens")
+    entry.output_tokens = usage.get("completion_tokens")
+    entry.created_at = datetime.utcnow()
+    entry.last_used_at = entry.created_at
+    db.session.commit()
+    _bump("stores")
+    evict_cache()
+    return entry
+
+
+def evict_cache():
+    removed = 0
+    cutoff = _expiry_cutoff()
+    if cutoff:
+        removed += LLMCache.query.filter(LLMCache.created_at < cutoff).delete(synchronize_session=False)
+    max_entries = int(current_app.config.get("LLM_CACHE_MAX_ENTRIES", 0))
+    if max_entries > 0:
+        overflow = LLMCache.query.count() - max_entries
+        if overflow > 0:
+            stale_ids = [
+                row.id
+                for row in LLMCache.query.with_entities(LLMCache.id)
+                .order_by(LLMCache.last_used_at.asc())
+                .limit(overflow)
+                .all()
+            ]
+            removed += LLMCache.query.filter(LLMCache.id.in_(stale_ids)).delete(synchronize_session=False)
+    if removed:
+        db.session.commit()
+        _bump("evictions", removed)
+    return removed
@@ -0,0 +1,174 @@
+from collections import deque
+from datetime import datetime, timedelta
+from flask import current_app
+from .locks import acquire_lock, release_lock
+from .scheduler import priority_rank, priority_weight
+from ..extensions import db
+from ..models import ChunkDispatch, Deck, GenerationProgress, ResourceLock
+
+
+# Dispatch-time fairness for distributed runs (GENERATION_SUBTASKS): chunk work is recorded in the
+# chunk_dispatch table instead of being pushed onto the broker all at once, and only admitted (sent
+# as a Celery task) while the cluster-wide and per-user caps have room. Each free slot goes to the
+# waiting user with the lowest weighted share of running chunks, so one large deck cannot fill the
+# FIFO queue ahead of everyone else. The table is shared by every process, so it is also where the
+# queue depth is read from.
+
+DISPATCH_LOCK_NAME = "chunk-dispatch"
+DISPATCH_LOCK_TTL_SECONDS = 30
+
+
+def enqueue_chunks(deck, sources, priority, lock_name, run_token):
+    db.session.add_all(
+        [
+            ChunkDispatch(
+                deck_id=deck.id,
+                source_id=source.id,
+                user_id=deck.user_id,
+                priority=priority,
+                run_token=run_token,
+                lock_name=lock_name,
+            )
+            for source in sources
+        ]
+    )
+    db.session.commit()
+
+
+def _pick(waiting, running, per_user):
+    # waiting: first waiting row per user; running: running count per user.
+    eligible = [row for row in waiting if running.get(row.user_id, 0) < per_user]
+    if not eligible:
+        return None
+    return min(
+        eligible,
+        key=lambda row: (
+            priority_rank(row.priority),
+            running.get(row.user_id, 0) / priority_weight(row.priority),
+            row.id,
+        ),
+    )
+
+
+def admit_chunks():
+    # Marks the rows to send next as dispatched and returns them; the caller queues their tasks.
+    # Serialised by a lock row so two processes never admit past the caps.
+    config = current_app.config
+    max_running = max(1, int(config.get("SCHEDULER_DISPATCH_CONCURRENCY", 32)))
+    per_user = max(1, int(config.get("SCHEDULER_USER_CONCURRENCY", 8)))
+    token = acquire_lock(DISPATCH_LOCK_NAME, DISPATCH_LOCK_TTL_SECONDS)
+    if not token:
+        return None
+    try:
+        running = dict(
+            db.session.query(ChunkDispatch.user_id, db.func.count(ChunkDispatch.id))
+            .filter(ChunkDispatch.status == "dispatched")
+            .group_by(ChunkDispatch.user_id)
+            .all()
+        )
+        total = sum(running.values())
+        # The waiting rows that can still be admitted are read once per pump: at most the free
+        # slots per user, oldest first, so a large backlog is never loaded in full.
+        queues = {}
+        for (user_id,) in (
+            db.session.query(ChunkDispatch.user_id).filter(ChunkDispatch.status == "waiting").distinct().all()
+        ):
+            room = min(per_user - running.get(user_id, 0), max_running - total)
+            if room > 0:
+                queues[user_id] = deque(
+                    ChunkDispatch.query.filter_by(status="waiting", user_id=user_id)
+                    .order_by(ChunkDispatch.id)
+                    .limit(room)
+                    .all()
+                )
+        admitted = []
+        now = datetime.utcnow()
+        while total < max_running:
+            row = _pick([rows[0] for rows in queues.values() if rows], running, per_user)
+            if row is None:
+                break
+            queues[row.user_id].popleft()
+            row.status = "dispatched"
+            row.dispatched_at = now
+            running[row.user_id] = running.get(row.user_id, 0) + 1
+            total += 1
+            admitted.append(row)
+        db.session.commit()
+        return admitted
+    finally:
+        release_lock(DISPATCH_LOCK_NAME, token)
+
+
+def complete_chunk(run_token, source_id, errors=None, auto_deleted=0):
+    ChunkDispatch.query.filter_by(run_token=run_token, source_id=source_id).update(
+        {
+            ChunkDispatch.status: "done",
+            ChunkDispatch.errors: list(errors or []),
+            ChunkDispatch.auto_deleted: int(auto_deleted or 0),
+            ChunkDispatch.finished_at: datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def reclaim_stale_chunks(stale_seconds):
+    # Chunk tasks killed by the hard time limit or a dying worker never report back; count them as
+    # failed once they have been dispatched for longer than any task may run. Returns the run tokens.
+    cutoff = datetime.utcnow() - timedelta(seconds=stale_seconds)
+    stale = ChunkDispatch.query.filter(
+        ChunkDispatch.status == "dispatched", ChunkDispatch.dispatched_at < cutoff
+    ).all()
+    for row in stale:
+        complete_chunk(row.run_token, row.source_id, ["The chunk task stopped unexpectedly."])
+    return {row.run_token for row in stale}
+
+
+def claim_finished_run(run_token):
+    # Returns (deck_id, chunk_errors, auto_deleted) exactly once, for whoever completes the run's
+    # last chunk: the run's single-flight lock is released by that caller only.
+    rows = ChunkDispatch.query.filter_by(run_token=run_token).all()
+    if not rows or any(row.status != "done" for row in rows):
+        return None
+    claimed = ResourceLock.query.filter_by(name=rows[0].lock_name, token=run_token).delete(synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    deck_id = rows[0].deck_id
+    chunk_errors = [error for row in sorted(rows, key=lambda row: row.id) for error in row.errors or []]
+    auto_deleted = sum(row.auto_deleted for row in rows)
+    ChunkDispatch.query.filter_by(run_token=run_token).delete(synchronize_session=False)
+    db.session.commit()
+    return deck_id, chunk_errors, auto_deleted
+
+
+def run_pending(run_token):
+    return ChunkDispatch.query.filter_by(run_token=run_token).first() is not None
+
+
+def queue_depth(user_id):
+    # Waiting/running chunks of the user's runs, read from shared tables so any process can serve it:
+    # distributed runs from the dispatch queue, single-task runs (one worker per deck) from their
+    # progress rows, where every chunk not yet finished counts as running.
+    depth = {"waiting": 0, "running": 0}
+    counts = (
+        db.session.query(ChunkDispatch.status, db.func.count(ChunkDispatch.id))
+        .filter(ChunkDispatch.user_id == user_id, ChunkDispatch.status.in_(("waiting", "dispatched")))
+        .group_by(ChunkDispatch.status)
+        .all()
+    )
+    for status, count in counts:
+        depth["waiting" if status == "waiting" else "running"] += count
+    single_task = (
+        db.session.query(GenerationProgress)
+        .join(Deck, Deck.id == GenerationProgress.deck_id)
+        .filter(
+            Deck.user_id == user_id,
+            Deck.status == "processing",
+            ~db.exists().where(ChunkDispatch.deck_id == Deck.id),
+        )
+        .all()
+    )
+    for progress in single_task:
+        depth["running"] += max(0, progress.total_chunks - progress.done_chunks - progress.failed_chunks)
+    return depth
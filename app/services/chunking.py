@@ -29,32 +29,60 @@ def guess_title(paragraph):
     return None
 
 
-def chunk_text(text, max_chars=3500):
-    paragraphs = [p.strip() for p in re.split(r"\n\s*\n+", text) if p.strip()]
-    chunks = []
+def iter_chunks(texts, max_chars=3500):
+    # Chunks a stream of text pieces (e.g. PDF pages, taken as separated by a blank line) and yields
+    # each chunk as soon as the next paragraph no longer fits, without waiting for the whole text.
     current = []
     current_len = 0
     current_title = None
-    for para in paragraphs:
-        title = guess_title(para)
-        if title and not current:
-            current_title = title
-            continue
-        if current_len + len(para) + 1 > max_chars and current:
-            chunk_text = "\n".join(current)
-            chunks.append((current_title, chunk_text))
-            current = []
-            current_len = 0
-            current_title = title
-            if title:
+    for text in texts:
+        for para in re.split(r"\n\s*\n+", text or ""):
+            para = para.strip()
+            if not para:
+                continue
+            title = guess_title(para)
+            if title and not current:
+                current_title = title
                 continue
-        current.append(para)
-        current_len += len(para) + 1
+            if current_len + len(para) + 1 > max_chars and current:
+                yield (current_title, "\n".join(current))
+                current = []
+                current_len = 0
+                current_title = title
+                if title:
+                    continue
+            current.append(para)
+            current_len += len(para) + 1
     if current:
-        chunk_text = "\n".join(current)
-        chunks.append((current_title, chunk_text))
-    return chunks
+        yield (current_title, "\n".join(current))
+
+
+def chunk_text(text, max_chars=3500):
+    return list(iter_chunks([text], max_chars))
 
 
 def hash_text(text):
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+MIN_SPLIT_CHARS = 200
+
+
+def estimate_tokens(text):
+    return len(text or "") // 4 + 1
+
+
+def split_text(text):
+    # Halves a chunk near its middle, preferring paragraph, then line, then sentence, then word breaks.
+    text = (text or "").strip()
+    if len(text) < MIN_SPLIT_CHARS:
+        return None
+    middle = len(text) // 2
+    for pattern in (r"\n\s*\n", r"\n", r"(?<=[.!?])\s+", r"\s+"):
+        breaks = [m for m in re.finditer(pattern, text) if 0 < m.start() < len(text)]
+        if breaks:
+            best = min(breaks, key=lambda m: abs(m.start() - middle))
+            left, right = text[: best.start()].strip(), text[best.end() :].strip()
+            if left and right:
+                return left, right
+    return text[:middle].strip(), text[middle:].strip()
@@ -1,46 +1,112 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 from flask import current_app
-from .chunking import clean_text, chunk_text, hash_text
-from .llm import OpenRouterError, extract_json, openrouter_chat, repair_json
-from .schemas import ChunkSchema
+from pydantic import ValidationError
+from .cache import cache_key, cache_stats, get_cached, settings_fingerprint, store_cached
+from .chunking import clean_text, chunk_text, estimate_tokens, hash_text, iter_chunks, split_text
+from .jobs import bump_job, finish_job, start_job
+from .locks import (
+    FlightInProgress,
+    SingleFlightTimeout,
+    acquire_lock,
+    await_flight,
+    finish_flight,
+    flight_key,
+    flight_name,
+    release_lock,
+    renew_flights,
+    single_flight,
+    source_lock_name,
+    wait_for_flights,
+)
+from .pdf import iter_pdf_pages
+from .progress import bump_progress, start_progress
+from .llm import (
+    HedgeBudget,
+    OpenRouterError,
+    extract_json,
+    finish_reason,
+    merge_usage,
+    openrouter_chat,
+    record_recovery,
+    recover_json,
+    recovery_stats,
+    repair_json,
+)
+from .routing import fallback_models, route_model
+from .scheduler import PRIORITY_INTERACTIVE, deck_priority, run_scheduled
+from .schemas import CardSchema, ChunkSchema
 from .validators import is_valid_cloze, normalize_text, normalize_math, is_math_valid, is_in_scope
 from ..extensions import db
-from ..models import Card, Deck, LLMRun, Source
+from ..models import BulkJob, Card, Deck, LLMRun, Source
 
 
 PROMPT_VERSION = "v3"
+HEDGE_SAMPLE_RUNS = 200
+CANCEL_POLL_SECONDS = 1.0
+_stats_log_lock = threading.Lock()
+_stats_logged_at = None
+CONTEXT_LENGTH_MARKERS = ("context length", "context_length_exceeded", "maximum context", "context window")
+GENERATION_SETTING_KEYS = ("focus", "exclude", "glossary", "max_chars")
+DEFAULT_GENERATION_SETTINGS = {"focus": "", "exclude": "", "glossary": "", "max_chars": 3500}
+
+
+class GenerationCancelled(Exception):
+    def __init__(self, superseded=False):
+        super().__init__()
+        self.superseded = superseded
 
 
 def tagify(text):
     return "".join([c if c.isalnum() or c in ("-", "_") else "_" for c in text.lower()]).strip("_")
 
 
+PROMPT_RULES = [
+    "Output strict JSON only.",
+    "Scope: ONLY use facts explicitly stated in the chunk.",
+    "Coverage: be exhaustive for all main topics and key details; exam prep.",
+    "Atomicity: prefer small, single-idea cards; one fact/concept/step per card whenever possible.",
+    "Keep answers short: target 1-3 concise bullets or 1-2 sentences unless absolutely necessary.",
+    "Cards are self-contained; no references to tables/figures/diagrams.",
+    "Style: clean, minimal formatting, consistent wording.",
+    "Input may include Markdown headings/lists from PDF conversion; use that structure for coverage.",
+    "Basic: concise Q -> A. Cloze: use {{c1::...}} (1–2 deletions).",
+    "Math: only \\( ... \\) inline and \\[ ... \\] display.",
+    "Avoid ambiguity; include subject, scope, conditions; no vague pronouns.",
+    "If a list is long, split it into multiple atomic cards instead of one heavy list card.",
+    "Use full-list cards only when the list is short and should be memorized as one unit.",
+    "Cover: definitions, equations + variable meanings, steps, constraints, edge cases, contrasts, pitfalls.",
+]
+
+CARD_SCHEMA = (
+    "{\"type\": \"basic|cloze\", "
+    "\"front\": string?, \"back\": string?, "
+    "\"cloze_text\": string?, \"extra\": string?, \"tags\": [string]}"
+)
+
+PACKED_SCHEMA_HINT = "{\"sections\": {\"<section id>\": [" + CARD_SCHEMA + "]}}"
+
+IMPROVE_SCHEMA_HINT = (
+    "{\"cards\": {\"<card id>\": {\"front\": string, \"back\": string} "
+    "| {\"cloze_text\": string, \"extra\": string}}}"
+)
+
+CONTINUE_PROMPT = (
+    "Your previous reply was cut off by the output limit. Continue exactly where it stopped: "
+    "output only the remaining JSON text, without repeating anything and without code fences."
+)
+
+
 def build_prompt(chunk_title, chunk_text, settings, card_style):
     focus = settings.get("focus", "")
     exclude = settings.get("exclude", "")
     glossary = settings.get("glossary", "")
-    rules = "\n".join(
-        [
-            "Output strict JSON only.",
-            "Scope: ONLY use facts explicitly stated in the chunk.",
-            "Coverage: be exhaustive for all main topics and key details; exam prep.",
-            "Atomicity: prefer small, single-idea cards; one fact/concept/step per card whenever possible.",
-            "Keep answers short: target 1-3 concise bullets or 1-2 sentences unless absolutely necessary.",
-            "Cards are self-contained; no references to tables/figures/diagrams.",
-            "Style: clean, minimal formatting, consistent wording.",
-            "Input may include Markdown headings/lists from PDF conversion; use that structure for coverage.",
-            "Basic: concise Q -> A. Cloze: use {{c1::...}} (1–2 deletions).",
-            "Math: only \\( ... \\) inline and \\[ ... \\] display.",
-            "Avoid ambiguity; include subject, scope, conditions; no vague pronouns.",
-            "If a list is long, split it into multiple atomic cards instead of one heavy list card.",
-            "Use full-list cards only when the list is short and should be memorized as one unit.",
-            "Cover: definitions, equations + variable meanings, steps, constraints, edge cases, contrasts, pitfalls.",
-        ]
-    )
-    schema = (
-        "Return only JSON: {\"cards\": [{\"type\": \"basic|cloze\", "
-        "\"front\": string?, \"back\": string?, "
-        "\"cloze_text\": string?, \"extra\": string?, \"tags\": [string]}]}"
-    )
+    rules = "\n".join(PROMPT_RULES)
+    schema = "Return only JSON: {\"cards\": [" + CARD_SCHEMA + "]}"
     user_prompt = f"""Generate Anki cards from this chunk.
 
 Title: {chunk_title or "Untitled"}
@@ -64,7 +130,79 @@ Rules:
     return messages
 
 
-def parse_cards(
+def section_id(position):
+    # Labels are positions within the pack, fixed when the prompt is built: a bisection elsewhere in
+    # the deck renumbers Source.idx while the pack is in flight.
+    return f"S{position + 1}"
+
+
+def build_packed_prompt(sources, settings, card_style):
+    # Several small chunks in one request; every section is a separate chunk for scope purposes.
+    focus = settings.get("focus", "")
+    exclude = settings.get("exclude", "")
+    glossary = settings.get("glossary", "")
+    rules = "\n".join(
+        PROMPT_RULES + ["Each section is an independent chunk: cards for a section may only use that section's facts."]
+    )
+    sections = "\n\n".join(
+        f"[Section {section_id(position)}]\nTitle: {source.title or 'Untitled'}\nContent:\n{source.text}"
+        for position, source in enumerate(sources)
+    )
+    ids = ", ".join(section_id(position) for position in range(len(sources)))
+    schema = f"Return only JSON: {PACKED_SCHEMA_HINT} with one key per section id ({ids})."
+    user_prompt = f"""Generate Anki cards for each of these sections.
+
+{sections}
+
+Card style: {card_style}
+Focus: {focus or "general coverage"}
+Exclude: {exclude or "none"}
+Glossary: {glossary or "none"}
+
+Rules:
+{rules}
+
+{schema}
+"""
+    messages = [
+        {"role": "system", "content": "You output strict JSON only. No prose. Prefer atomic cards."},
+        {"role": "user", "content": user_prompt.strip()},
+    ]
+    return messages
+
+
+def pack_sources(sources, max_tokens, small_tokens):
+    # Groups runs of adjacent small sources up to a token budget; large sources stay alone.
+    groups = []
+    current = []
+    current_tokens = 0
+    for source in sources:
+        tokens = estimate_tokens(source.text)
+        small = max_tokens > 0 and tokens <= small_tokens
+        if (
+            small
+            and current
+            and source.idx == current[-1].idx + 1
+            and current_tokens + tokens <= max_tokens
+        ):
+            current.append(source)
+            current_tokens += tokens
+            continue
+        if current:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        if small:
+            current = [source]
+            current_tokens = tokens
+        else:
+            groups.append([source])
+    if current:
+        groups.append(current)
+    return groups
+
+
+def load_llm_json(
     raw_text,
     model,
     api_key,
@@ -73,11 +211,26 @@ def parse_cards(
     max_retries=2,
     backoff_seconds=1.5,
     timeout_seconds=120,
+    schema_hint=None,
+    validate=None,
 ):
+    # `validate` raises ValueError when locally recovered data has nothing usable (e.g. every card
+    # salvaged from truncated output is invalid), so the LLM repair is tried instead.
     try:
         data = extract_json(raw_text)
+        record_recovery("direct")
+        return data
     except Exception:
-        data = repair_json(
+        pass
+    try:
+        data = recover_json(raw_text)
+        if validate is not None:
+            validate(data)
+        return data
+    except ValueError:
+        record_recovery("llm_repair")
+        kwargs = {"schema_hint": schema_hint} if schema_hint else {}
+        return repair_json(
             raw_text,
             model,
             api_key,
@@ -86,9 +239,85 @@ def parse_cards(
             max_retries=max_retries,
             backoff_seconds=backoff_seconds,
             timeout_seconds=timeout_seconds,
+            **kwargs,
         )
-    parsed = ChunkSchema.model_validate(data)
-    return parsed.cards, data
+
+
+def validation_message(exc):
+    return "; ".join(error.get("msg", "") for error in exc.errors()) or str(exc)
+
+
+def salvage_cards(raw_cards):
+    # Validates cards one at a time so a single bad card does not sink the chunk.
+    if not isinstance(raw_cards, list):
+        raise ValueError("LLM response did not contain a list of cards.")
+    cards = []
+    kept = []
+    rejected = []
+    for index, raw in enumerate(raw_cards):
+        try:
+            cards.append(CardSchema.model_validate(raw))
+            kept.append(raw)
+        except ValidationError as exc:
+            rejected.append({"index": index, "card": raw, "error": validation_message(exc)})
+    if rejected and not cards:
+        raise ValueError(f"No valid cards in LLM response: {rejected[0]['error']}")
+    return cards, kept, rejected
+
+
+def raw_card_list(data):
+    if isinstance(data, list):
+        return data
+    if not isinstance(data, dict):
+        raise ValueError("LLM response was not a JSON object.")
+    return data.get("cards")
+
+
+def check_sections(data):
+    raw_sections = data.get("sections") if isinstance(data, dict) else None
+    if not isinstance(raw_sections, dict):
+        raise ValueError("LLM response did not contain a sections object.")
+    errors = []
+    for raw_cards in raw_sections.values():
+        try:
+            salvage_cards(raw_cards)
+            return
+        except ValueError as exc:
+            errors.append(str(exc))
+    raise ValueError(errors[0] if errors else "LLM response contained no sections.")
+
+
+def parse_cards(
+    raw_text,
+    model,
+    api_key,
+    site_url,
+    app_name,
+    max_retries=2,
+    backoff_seconds=1.5,
+    timeout_seconds=120,
+):
+    data = load_llm_json(
+        raw_text,
+        model,
+        api_key,
+        site_url,
+        app_name,
+        max_retries=max_retries,
+        backoff_seconds=backoff_seconds,
+        timeout_seconds=timeout_seconds,
+        validate=lambda data: salvage_cards(raw_card_list(data)),
+    )
+    if isinstance(data, list):
+        data = {"cards": data}
+    if not isinstance(data, dict):
+        raise ValueError("LLM response was not a JSON object.")
+    cards, kept, rejected = salvage_cards(data.get("cards"))
+    parsed_json = dict(data)
+    parsed_json["cards"] = kept
+    if rejected:
+        parsed_json["rejected_cards"] = rejected
+    return cards, parsed_json
 
 
 def normalize_card(card):
@@ -136,6 +365,15 @@ def apply_validation_tags(tags, issues):
     return deduped
 
 
+def is_context_length_error(exc):
+    if not isinstance(exc, OpenRouterError) or exc.status_code != 400:
+        return False
+    # Only the prompt overflowing the model's window; output-token (max_tokens) limits also mention
+    # tokens but are not fixed by splitting the chunk.
+    detail = (exc.response_body or "").lower()
+    return any(marker in detail for marker in CONTEXT_LENGTH_MARKERS)
+
+
 def format_generation_error(exc):
     if isinstance(exc, OpenRouterError):
         status = exc.status_code
@@ -147,7 +385,7 @@ def format_generation_error(exc):
         if status in (401, 403):
             return "OpenRouter authentication failed. Check your API key and model access."
         if status == 400:
-            if "context" in detail or "token" in detail or "too long" in detail:
+            if is_context_length_error(exc):
                 return "OpenRouter rejected this request because the chunk is too large. Lower chunk size and retry."
             return "OpenRouter rejected this request. Try reducing chunk size or splitting the source text."
         if status and status >= 500:
@@ -156,217 +394,247 @@ def format_generation_error(exc):
     return str(exc)
 
 
-def generate_deck(deck_id):
-    deck = Deck.query.get(deck_id)
-    if not deck:
-        return None
-    settings = deck.settings_json or {}
-    llm_max_retries = int(current_app.config.get("OPENROUTER_MAX_RETRIES", 2))
-    llm_backoff_seconds = float(current_app.config.get("OPENROUTER_RETRY_BACKOFF_SECONDS", 1.5))
-    llm_timeout_seconds = float(current_app.config.get("OPENROUTER_TIMEOUT_SECONDS", 120))
-    updated_settings = dict(settings)
-    updated_settings.pop("last_error", None)
-    deck.settings_json = updated_settings
-    deck.status = "processing"
-    db.session.commit()
+def llm_options():
+    config = current_app.config
+    return {
+        "model": config["OPENROUTER_MODEL"],
+        "api_key": config["OPENROUTER_API_KEY"],
+        "site_url": config["OPENROUTER_SITE_URL"],
+        "app_name": config["OPENROUTER_APP_NAME"],
+        "max_retries": int(config.get("OPENROUTER_MAX_RETRIES", 2)),
+        "backoff_seconds": float(config.get("OPENROUTER_RETRY_BACKOFF_SECONDS", 1.5)),
+        "timeout_seconds": float(config.get("OPENROUTER_TIMEOUT_SECONDS", 120)),
+        "stream": bool(config.get("OPENROUTER_STREAMING", True)),
+        "max_output_tokens": int(config.get("GENERATION_MAX_OUTPUT_TOKENS", 8192)),
+        "max_continuations": int(config.get("GENERATION_MAX_CONTINUATIONS", 2)),
+        "repair_model": route_model("repair"),
+        "fallback_models": fallback_models(config["OPENROUTER_MODEL"]),
+    }
 
-    Card.query.filter_by(deck_id=deck_id).delete()
-    Source.query.filter_by(deck_id=deck_id).delete()
-    LLMRun.query.filter_by(deck_id=deck_id).delete()
-    db.session.commit()
 
-    cleaned = clean_text(deck.source_text)
-    max_chars = int(settings.get("max_chars", 3500))
-    chunks = chunk_text(cleaned, max_chars=max_chars)
-    sources = []
-    for idx, (title, text) in enumerate(chunks):
-        source = Source(
-            deck_id=deck_id,
-            idx=idx,
-            title=title,
-            text=text,
-            hash=hash_text(text),
-        )
-        sources.append(source)
-    db.session.add_all(sources)
-    db.session.commit()
+def routed_options(options, text):
+    # Per-call copy of `options` with the model chosen for this chunk's size and content.
+    model = route_model("chunk", text)
+    return dict(options, model=model, fallback_models=fallback_models(model))
 
-    model = current_app.config["OPENROUTER_MODEL"]
-    api_key = current_app.config["OPENROUTER_API_KEY"]
-    site_url = current_app.config["OPENROUTER_SITE_URL"]
-    app_name = current_app.config["OPENROUTER_APP_NAME"]
 
-    created_cards = []
-    auto_deleted_cards = 0
-    for source in sources:
-        messages = build_prompt(source.title, source.text, settings, deck.card_style)
-        try:
-            response = openrouter_chat(
-                messages,
-                model,
-                api_key,
-                site_url,
-                app_name,
-                max_retries=llm_max_retries,
-                backoff_seconds=llm_backoff_seconds,
-                timeout_seconds=llm_timeout_seconds,
-            )
-            content = response["choices"][0]["message"]["content"]
-            usage = response.get("usage", {})
-            cards, parsed_json = parse_cards(
-                content,
-                model,
-                api_key,
-                site_url,
-                app_name,
-                max_retries=llm_max_retries,
-                backoff_seconds=llm_backoff_seconds,
-                timeout_seconds=llm_timeout_seconds,
-            )
-            for card in cards:
-                normalized = normalize_card(card)
-                issues = validation_issues(normalized, source.text)
-                status = "deleted" if issues else "ok"
-                if issues:
-                    auto_deleted_cards += 1
-                tags = list(card.tags or [])
-                tags.append(f"section:{source.idx + 1}")
-                if source.title:
-                    tags.append(f"title:{tagify(source.title)}")
-                tags = apply_validation_tags(tags, issues)
-                created_cards.append(
-                    Card(
-                        deck_id=deck_id,
-                        source_id=source.id,
-                        type=normalized["type"],
-                        front=normalized.get("front"),
-                        back=normalized.get("back"),
-                        cloze_text=normalized.get("cloze_text"),
-                        extra=normalized.get("extra"),
-                        tags=tags,
-                        status=status,
-                    )
-                )
-            llm_run = LLMRun(
-                deck_id=deck_id,
-                source_id=source.id,
-                model=model,
-                prompt_version=PROMPT_VERSION,
-                input_tokens=usage.get("prompt_tokens"),
-                output_tokens=usage.get("completion_tokens"),
-                cost_estimate=usage.get("total_cost"),
-                request_json={"messages": messages, "model": model},
-                response_text=content,
-                parsed_json=parsed_json,
-            )
-            db.session.add(llm_run)
-            db.session.commit()
-        except Exception as exc:
-            user_error = format_generation_error(exc)
-            chunk_error = f"Chunk {source.idx + 1}: {user_error}"
-            llm_run = LLMRun(
-                deck_id=deck_id,
-                source_id=source.id,
-                model=model,
-                prompt_version=PROMPT_VERSION,
-                request_json={"messages": messages, "model": model},
-                error=chunk_error,
-            )
-            db.session.add(llm_run)
-            updated_settings = dict(deck.settings_json or {})
-            updated_settings["last_error"] = chunk_error
-            deck.settings_json = updated_settings
-            deck.status = "failed"
-            db.session.commit()
-            return None
-
-    if created_cards:
-        db.session.add_all(created_cards)
-        db.session.commit()
-
-    dedupe_cards(deck_id)
-    updated_settings = dict(deck.settings_json or {})
-    if auto_deleted_cards:
-        updated_settings["auto_deleted_cards"] = auto_deleted_cards
-    else:
-        updated_settings.pop("auto_deleted_cards", None)
-    updated_settings.pop("dropped_cards", None)
-    deck.settings_json = updated_settings
-    deck.status = "ready"
-    db.session.commit()
-    return deck_id
+def hedge_options():
+    # Hedge delay comes from the configured percentile of recent first-response latencies
+    # recorded on successful LLMRuns; too little history disables hedging.
+    config = current_app.config
+    if not config.get("OPENROUTER_HEDGE_ENABLED"):
+        return {}
+    # Only the latency is read from the JSON column; the stored prompts are not loaded.
+    rows = (
+        LLMRun.query.with_entities(LLMRun.request_json["latency_seconds"].as_float())
+        .filter(LLMRun.error.is_(None))
+        .order_by(LLMRun.id.desc())
+        .limit(HEDGE_SAMPLE_RUNS)
+        .all()
+    )
+    latencies = sorted(latency for (latency,) in rows if latency)
+    if not latencies or len(latencies) < int(config.get("OPENROUTER_HEDGE_MIN_SAMPLES", 20)):
+        return {}
+    percentile = min(100.0, max(0.0, float(config.get("OPENROUTER_HEDGE_PERCENTILE", 95))))
+    index = min(len(latencies) - 1, int(round(percentile / 100 * (len(latencies) - 1))))
+    return {
+        "hedge_after_seconds": max(0.5, latencies[index]),
+        "hedge_model": config.get("OPENROUTER_HEDGE_MODEL") or None,
+        "hedge_budget": HedgeBudget(config.get("GENERATION_MAX_HEDGES", 4)),
+    }
 
 
-def dedupe_cards(deck_id):
-    cards = Card.query.filter_by(deck_id=deck_id, status="ok").all()
-    seen = set()
-    for card in cards:
-        key = (
-            card.type,
-            (card.front or "").lower().strip(),
-            (card.back or "").lower().strip(),
-            (card.cloze_text or "").lower().strip(),
-        )
-        if key in seen:
-            card.status = "deleted"
-        else:
-            seen.add(key)
-    db.session.commit()
+def output_token_budget(text, options):
+    # Dense chunks yield more cards; budget roughly 2x the input plus headroom, within the cap.
+    cap = options["max_output_tokens"]
+    if cap <= 0:
+        return None
+    return min(cap, max(1024, estimate_tokens(text) * 2 + 512))
 
 
-def regenerate_source(source_id):
-    source = Source.query.get(source_id)
-    if not source:
-        return None
-    deck = Deck.query.get(source.deck_id)
-    if not deck:
-        return None
-    Card.query.filter_by(source_id=source_id).delete()
-    db.session.commit()
-    settings = deck.settings_json or {}
-    llm_max_retries = int(current_app.config.get("OPENROUTER_MAX_RETRIES", 2))
-    llm_backoff_seconds = float(current_app.config.get("OPENROUTER_RETRY_BACKOFF_SECONDS", 1.5))
-    llm_timeout_seconds = float(current_app.config.get("OPENROUTER_TIMEOUT_SECONDS", 120))
-    model = current_app.config["OPENROUTER_MODEL"]
-    api_key = current_app.config["OPENROUTER_API_KEY"]
-    site_url = current_app.config["OPENROUTER_SITE_URL"]
-    app_name = current_app.config["OPENROUTER_APP_NAME"]
-    messages = build_prompt(source.title, source.text, settings, deck.card_style)
+def complete_chat(messages, options, max_tokens=None, on_card=None):
+    # Calls OpenRouter and, when the reply stops on the output limit, asks the model to
+    # continue from where it stopped so dense chunks still produce complete JSON.
+    started = time.monotonic()
     response = openrouter_chat(
         messages,
-        model,
-        api_key,
-        site_url,
-        app_name,
-        max_retries=llm_max_retries,
-        backoff_seconds=llm_backoff_seconds,
-        timeout_seconds=llm_timeout_seconds,
+        options["model"],
+        options["api_key"],
+        options["site_url"],
+        options["app_name"],
+        max_retries=options["max_retries"],
+        backoff_seconds=options["backoff_seconds"],
+        timeout_seconds=options["timeout_seconds"],
+        stream=options["stream"] and on_card is not None,
+        on_card=on_card,
+        max_tokens=max_tokens,
+        hedge_after_seconds=options.get("hedge_after_seconds"),
+        hedge_model=options.get("hedge_model"),
+        hedge_budget=options.get("hedge_budget"),
+        cancel_event=options.get("cancel_event"),
+        fallback_models=options.get("fallback_models"),
     )
-    content = response["choices"][0]["message"]["content"]
+    latency = round(time.monotonic() - started, 3)
+    hedge = response.get("hedge") or {}
+    model = response.get("routed_model") or options["model"]
+    content = response["choices"][0]["message"]["content"] or ""
+    usage = response.get("usage") or {}
+    reason = finish_reason(response)
+    continuations = 0
+    while reason == "length" and continuations < options["max_continuations"]:
+        continuations += 1
+        follow_up = messages + [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+        response = openrouter_chat(
+            follow_up,
+            model,
+            options["api_key"],
+            options["site_url"],
+            options["app_name"],
+            max_retries=options["max_retries"],
+            backoff_seconds=options["backoff_seconds"],
+            timeout_seconds=options["timeout_seconds"],
+            max_tokens=max_tokens,
+            cancel_event=options.get("cancel_event"),
+            fallback_models=[name for name in options.get("fallback_models") or [] if name != model],
+        )
+        content += response["choices"][0]["message"]["content"] or ""
+        usage = merge_usage(usage, response.get("usage"))
+        reason = finish_reason(response)
+    meta = {
+        "max_tokens": max_tokens,
+        "finish_reason": reason,
+        "continuations": continuations,
+        "latency_seconds": latency,
+        "model": model,
+    }
+    if hedge.get("hedged"):
+        meta["hedged"] = True
+        meta["hedge_winner"] = hedge["winner"]
+    return content, usage, meta
+
+
+def generate_chunk(messages, options, on_card=None, max_tokens=None):
+    # Runs on worker threads: network and parsing only, no app context or DB session access.
+    content, usage, meta = complete_chat(messages, options, max_tokens=max_tokens, on_card=on_card)
     cards, parsed_json = parse_cards(
         content,
-        model,
-        api_key,
-        site_url,
-        app_name,
-        max_retries=llm_max_retries,
-        backoff_seconds=llm_backoff_seconds,
-        timeout_seconds=llm_timeout_seconds,
+        options["repair_model"],
+        options["api_key"],
+        options["site_url"],
+        options["app_name"],
+        max_retries=options["max_retries"],
+        backoff_seconds=options["backoff_seconds"],
+        timeout_seconds=options["timeout_seconds"],
+    )
+    return {
+        "content": content,
+        "usage": usage,
+        "cards": cards,
+        "parsed_json": parsed_json,
+        "meta": meta,
+    }
+
+
+def generate_packed_chunk(messages, options, max_tokens=None):
+    # Worker-thread counterpart of generate_chunk for packed multi-section requests (not streamed).
+    content, usage, meta = complete_chat(messages, options, max_tokens=max_tokens)
+    data = load_llm_json(
+        content,
+        options["repair_model"],
+        options["api_key"],
+        options["site_url"],
+        options["app_name"],
+        max_retries=options["max_retries"],
+        backoff_seconds=options["backoff_seconds"],
+        timeout_seconds=options["timeout_seconds"],
+        schema_hint=PACKED_SCHEMA_HINT,
+        validate=check_sections,
     )
+    raw_sections = data.get("sections") if isinstance(data, dict) else None
+    if not isinstance(raw_sections, dict):
+        raise ValueError("LLM response did not contain a sections object.")
+    sections = {}
+    parsed_json = {"sections": {}, "rejected_cards": {}}
+    for sid, raw_cards in raw_sections.items():
+        try:
+            cards, kept, rejected = salvage_cards(raw_cards)
+        except ValueError:
+            # Leave the section out so only that chunk is marked failed.
+            continue
+        sections[sid] = cards
+        parsed_json["sections"][sid] = kept
+        if rejected:
+            parsed_json["rejected_cards"][sid] = rejected
+    return {
+        "content": content,
+        "usage": usage,
+        "sections": sections,
+        "parsed_json": parsed_json,
+        "meta": meta,
+    }
+
+
+def split_chunk_result(sources, result):
+    # Maps a (possibly packed) result back to one per-source result; None marks a missing section.
+    if "sections" not in result:
+        return [(sources[0], result)]
+    raw_sections = (result["parsed_json"] or {}).get("sections") or {}
+    rejected_sections = (result["parsed_json"] or {}).get("rejected_cards") or {}
+    split = []
+    for position, source in enumerate(sources):
+        sid = section_id(position)
+        if sid not in result["sections"]:
+            split.append((source, None))
+            continue
+        raw_cards = raw_sections.get(sid) or []
+        parsed_json = {"cards": raw_cards}
+        if rejected_sections.get(sid):
+            parsed_json["rejected_cards"] = rejected_sections[sid]
+        split.append(
+            (
+                source,
+                {
+                    "content": json.dumps({"cards": raw_cards}),
+                    # Usage is billed once for the whole pack; attribute it to the first section.
+                    "usage": result["usage"] if position == 0 else {},
+                    "cards": result["sections"][sid],
+                    "parsed_json": parsed_json,
+                    "meta": result.get("meta"),
+                },
+            )
+        )
+    return split
+
+
+def cached_chunk(entry):
+    return {
+        "content": entry.response_text,
+        "usage": {},
+        "cards": ChunkSchema.model_validate(entry.parsed_json).cards,
+        "parsed_json": entry.parsed_json,
+        "meta": {"model": entry.model},
+        "cached": True,
+    }
+
+
+def build_cards(deck_id, source, cards):
     created_cards = []
+    auto_deleted_cards = 0
     for card in cards:
         normalized = normalize_card(card)
         issues = validation_issues(normalized, source.text)
         status = "deleted" if issues else "ok"
-        tags = list(card.tags or [])
-        tags.append(f"section:{source.idx + 1}")
-        if source.title:
-            tags.append(f"title:{tagify(source.title)}")
+        if issues:
+            auto_deleted_cards += 1
+        tags = list(card.tags or []) + section_tags(source)
         tags = apply_validation_tags(tags, issues)
         created_cards.append(
             Card(
-                deck_id=deck.id,
-                source_id=source_id,
+                deck_id=deck_id,
+                source_id=source.id,
                 type=normalized["type"],
                 front=normalized.get("front"),
                 back=normalized.get("back"),
@@ -376,31 +644,958 @@ def regenerate_source(source_id):
                 status=status,
             )
         )
+    return created_cards, auto_deleted_cards
+
+
+def persist_streamed_cards(deck_id, card_queue, streamed, seen=None):
+    # Drains cards emitted by streaming workers and inserts them right away.
+    pending = []
+    auto_deleted_cards = 0
+    while True:
+        try:
+            source, card_data = card_queue.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            card = CardSchema.model_validate(card_data)
+        except ValidationError:
+            continue
+        chunk_cards, chunk_auto_deleted = build_cards(deck_id, source, [card])
+        dedupe_new_cards(chunk_cards, seen)
+        entry = streamed.setdefault(source.id, {"cards": [], "auto_deleted": 0})
+        entry["cards"].append(card_data)
+        entry["auto_deleted"] += chunk_auto_deleted
+        auto_deleted_cards += chunk_auto_deleted
+        pending.extend(chunk_cards)
+    if pending:
+        db.session.add_all(pending)
+        db.session.commit()
+    return auto_deleted_cards
+
+
+def persist_chunk_cards(deck_id, source, result, streamed, seen=None):
+    # Inserts whatever the stream has not already persisted; if the final parse diverged
+    # from the streamed cards (e.g. after a JSON repair), the chunk's cards are replaced.
+    entry = streamed.pop(source.id, None)
+    cards = list(result["cards"])
+    auto_deleted_delta = 0
+    if entry:
+        final_cards = (result["parsed_json"] or {}).get("cards") or []
+        already = len(entry["cards"])
+        if final_cards[:already] == entry["cards"]:
+            cards = cards[already:]
+        else:
+            drop_source_cards(source.id, seen)
+            auto_deleted_delta -= entry["auto_deleted"]
+    created_cards, chunk_auto_deleted = build_cards(deck_id, source, cards)
+    dedupe_new_cards(created_cards, seen)
     if created_cards:
         db.session.add_all(created_cards)
-        db.session.commit()
+    return auto_deleted_delta + chunk_auto_deleted
+
+
+def wait_for_chunk(future, on_idle, poll_seconds=0.25):
+    while True:
+        try:
+            return future.result(timeout=poll_seconds)
+        except FutureTimeoutError:
+            on_idle()
+
+
+def record_chunk_run(deck_id, source, messages, model, result, key, fingerprint=None):
+    # `model` is the routed model; the meta's model wins when a fallback or hedge answered instead.
+    usage = result["usage"]
+    request_json = {"messages": messages, "model": model, "fingerprint": fingerprint}
+    request_json.update(result.get("meta") or {})
+    model = request_json.get("model") or model
+    if result.get("cached"):
+        request_json["cache_key"] = key
+    else:
+        store_cached(key, model, PROMPT_VERSION, result["content"], result["parsed_json"], result["usage"])
     llm_run = LLMRun(
-        deck_id=deck.id,
-        source_id=source_id,
+        deck_id=deck_id,
+        source_id=source.id,
+        model=model,
+        prompt_version=PROMPT_VERSION,
+        input_tokens=usage.get("prompt_tokens"),
+        output_tokens=usage.get("completion_tokens"),
+        cost_estimate=usage.get("total_cost"),
+        request_json=request_json,
+        response_text=result["content"],
+        parsed_json=result["parsed_json"],
+    )
+    db.session.add(llm_run)
+    return llm_run
+
+
+def record_chunk_error(deck_id, source, messages, model, user_error):
+    chunk_error = f"Chunk {source.idx + 1}: {user_error}"
+    llm_run = LLMRun(
+        deck_id=deck_id,
+        source_id=source.id,
         model=model,
         prompt_version=PROMPT_VERSION,
         request_json={"messages": messages, "model": model},
-        response_text=content,
-        parsed_json=parsed_json,
+        error=chunk_error,
     )
     db.session.add(llm_run)
+    return chunk_error
+
+
+def pending_sources(deck_id):
+    # Sources still needing a call: those without a successful (error-free) LLMRun.
+    done_ids = {
+        row.source_id
+        for row in LLMRun.query.filter_by(deck_id=deck_id, error=None).with_entities(LLMRun.source_id)
+    }
+    sources = Source.query.filter_by(deck_id=deck_id).order_by(Source.idx).all()
+    return [source for source in sources if source.id not in done_ids]
+
+
+def section_tags(source):
+    tags = [f"section:{source.idx + 1}"]
+    if source.title:
+        tags.append(f"title:{tagify(source.title)}")
+    return tags
+
+
+def retag_source_cards(source, old_tags):
+    new_tags = section_tags(source)
+    if new_tags == old_tags:
+        return
+    for card in source.cards:
+        tags = [tag for tag in (card.tags or []) if tag not in old_tags]
+        card.tags = tags + [tag for tag in new_tags if tag not in tags]
+
+
+def sync_sources(deck_id, chunks, splits=None):
+    # Keeps Sources (with their cards and runs) whose text hash is unchanged, re-indexing
+    # them to the new chunk order; only new or edited chunks become fresh Sources.
+    # `splits` maps a chunk hash to the hashes it was bisected into, so bisected chunks are kept too.
+    splits = splits or {}
+    existing = {}
+    for source in Source.query.filter_by(deck_id=deck_id).order_by(Source.idx).all():
+        existing.setdefault(source.hash, []).append(source)
+
+    def claim(digest):
+        matches = existing.get(digest)
+        if matches:
+            return [matches.pop(0)]
+        if digest not in splits:
+            return None
+        claimed = []
+        for child in splits[digest]:
+            parts = claim(child)
+            if parts is None:
+                for source in reversed(claimed):
+                    existing.setdefault(source.hash, []).insert(0, source)
+                return None
+            claimed.extend(parts)
+        return claimed
+
+    sources = []
+    for title, text in chunks:
+        digest = hash_text(text)
+        kept = claim(digest)
+        if kept is None:
+            kept = [Source(deck_id=deck_id, title=title, text=text, hash=digest)]
+            db.session.add(kept[0])
+        for source in kept:
+            old_tags = section_tags(source) if source.id else None
+            source.idx = len(sources)
+            source.title = title
+            if old_tags is not None:
+                retag_source_cards(source, old_tags)
+            sources.append(source)
+    for stale in [source for group in existing.values() for source in group]:
+        LLMRun.query.filter_by(source_id=stale.id).delete()
+        db.session.delete(stale)
+    db.session.commit()
+    return sources
+
+
+def split_depth(splits, source_hash):
+    # How many bisections produced this source, following split_sources back to the original chunk.
+    parents = {child: parent for parent, children in splits.items() for child in children}
+    depth = 0
+    while source_hash in parents and depth < len(parents):
+        source_hash = parents[source_hash]
+        depth += 1
+    return depth
+
+
+def bisect_source(deck, source):
+    # Replaces an over-long source with two halves in place, shifting later sources down by one.
+    # Returns None once the source is too small to split or has been split
+    # GENERATION_BISECT_MAX_DEPTH times, so the chunk fails instead of fanning out further.
+    # Settings may have been written since the run loaded the deck.
+    db.session.refresh(deck)
+    settings = dict(deck.settings_json or {})
+    splits = dict(settings.get("split_sources") or {})
+    if split_depth(splits, source.hash) >= int(current_app.config.get("GENERATION_BISECT_MAX_DEPTH", 3)):
+        return None
+    halves = split_text(source.text)
+    if not halves:
+        return None
+    later = (
+        Source.query.filter(Source.deck_id == deck.id, Source.idx > source.idx)
+        .order_by(Source.idx.desc())
+        .all()
+    )
+    for other in later:
+        old_tags = section_tags(other)
+        other.idx += len(halves) - 1
+        retag_source_cards(other, old_tags)
+    children = [
+        Source(deck_id=deck.id, idx=source.idx + offset, title=source.title, text=text, hash=hash_text(text))
+        for offset, text in enumerate(halves)
+    ]
+    splits[source.hash] = [child.hash for child in children]
+    settings["split_sources"] = splits
+    deck.settings_json = settings
+    LLMRun.query.filter_by(source_id=source.id).delete()
+    Card.query.filter_by(source_id=source.id).delete()
+    db.session.delete(source)
+    db.session.add_all(children)
+    db.session.commit()
+    bump_progress(deck.id, total_chunks=len(children) - 1)
+    return children
+
+
+def settings_changed(deck_id, fingerprint):
+    runs = LLMRun.query.filter_by(deck_id=deck_id, error=None).with_entities(LLMRun.request_json).all()
+    return any((row.request_json or {}).get("fingerprint") != fingerprint for row in runs)
+
+
+def generation_settings(settings):
+    return {key: (settings or {}).get(key, "") for key in GENERATION_SETTING_KEYS}
+
+
+def generation_key(deck):
+    return flight_key(deck.card_style, hash_text(deck.source_text or ""), generation_settings(deck.settings_json))
+
+
+def generation_priority(deck, source_count=None):
+    # Decks with few chunks are weighted ahead of large ones so they are not stuck behind them.
+    if source_count is None:
+        source_count = Source.query.filter_by(deck_id=deck.id).count()
+    return deck_priority(source_count, int(current_app.config.get("SCHEDULER_SMALL_DECK_CHUNKS", 10)))
+
+
+def generate_deck(deck_id, resume=False, speculative=False, wait=True):
+    # Duplicate submissions (double clicks, two tabs) share one run instead of racing. A submit whose
+    # settings match a speculative run in flight joins it the same way, adopting its results.
+    # With wait=False, FlightInProgress is raised instead of blocking while another run holds the deck.
+    deck = Deck.query.get(deck_id)
+    if not deck:
+        return None
+    operation = "resume" if resume else "generate"
+    key = generation_key(deck)
+
+    def run():
+        # A run under other settings stops at its next chunk boundary; let it finish before taking over.
+        wait_for_flights(("generate", "resume"), deck_id, exclude=flight_name(operation, deck_id, key), wait=wait)
+        return _generate_deck(deck_id, resume, speculative)
+
+    result = single_flight(operation, deck_id, key, run, wait=wait)
+    if wait and not speculative and db.session.query(Deck.status).filter_by(id=deck_id).scalar() == "processing":
+        # Joined a speculative run that finished as a draft just before the submit; its chunks
+        # are done, so this run only finalises the deck.
+        result = single_flight(operation, deck_id, key, run)
+    return result
+
+
+def speculate_deck(deck_id):
+    # Opt-in (SPECULATIVE_GENERATION): generates with the default settings while the user is still
+    # on the preview page. The deck stays a draft until the user submits.
+    # Speculation is best effort: it never waits for another run of the deck.
+    try:
+        return generate_deck(deck_id, speculative=True, wait=False)
+    except FlightInProgress:
+        return None
+
+
+def deck_cancelled(deck_id):
+    # Reads the committed status, so a cancel from another request or process is seen.
+    return db.session.query(Deck.status).filter_by(id=deck_id).scalar() == "cancelled"
+
+
+def generation_state(deck_id, run_settings):
+    # "cancelled" by the user, "superseded" once the deck was resubmitted with other settings.
+    row = db.session.query(Deck.status, Deck.settings_json).filter_by(id=deck_id).first()
+    if row is None or row.status == "cancelled":
+        return "cancelled"
+    if generation_settings(row.settings_json) != run_settings:
+        return "superseded"
+    return None
+
+
+def pending_upload(deck):
+    # A PDF saved by the new-deck form for extraction during generation (see streamed_sources).
+    return (deck.settings_json or {}).get("pdf_upload")
+
+
+def discard_upload(upload):
+    # Uploads are only kept until their text has been extracted.
+    if not upload:
+        return
+    try:
+        os.remove(upload["path"])
+    except FileNotFoundError:
+        pass
+
+
+def store_upload_text(deck, text):
+    # Settings are re-read so a concurrent change is not overwritten.
+    db.session.refresh(deck)
+    updated_settings = dict(deck.settings_json or {})
+    upload = updated_settings.pop("pdf_upload", None)
+    deck.source_text = text
+    deck.settings_json = updated_settings
+    db.session.commit()
+    discard_upload(upload)
+
+
+def streamed_sources(deck, upload, max_chars):
+    # Parses the upload page by page and yields each chunk's Source as soon as the chunk closes;
+    # the deck's source text is stored once the last page is parsed.
+    pages = []
+
+    def cleaned_pages():
+        for page in iter_pdf_pages(upload["path"], upload.get("page_start"), upload.get("page_end")):
+            pages.append(page)
+            yield clean_text(page)
+
+    try:
+        for title, text in iter_chunks(cleaned_pages(), max_chars):
+            # Counted rather than tracked locally: bisection may have shifted the indexes.
+            idx = Source.query.filter_by(deck_id=deck.id).count()
+            source = Source(deck_id=deck.id, idx=idx, title=title, text=text, hash=hash_text(text))
+            db.session.add(source)
+            db.session.commit()
+            bump_progress(deck.id, total_chunks=1)
+            yield source
+    except Exception:
+        # A broken file keeps the pages parsed so far; a cancelled run (GeneratorExit) keeps the
+        # upload so resuming can finish extracting it.
+        db.session.rollback()
+        store_upload_text(deck, "\n\n".join(pages))
+        raise
+    store_upload_text(deck, "\n\n".join(pages))
+
+
+def begin_generation(deck, resume=False, speculative=False, stream=False):
+    # Resets run state, marks the deck processing and syncs its Sources with the current text.
+    # Returns the Sources that still need an LLM call, or None if the deck was cancelled first.
+    # With `stream`, Sources come from streamed_sources instead and none are returned here.
+    deck_id = deck.id
+    if deck_cancelled(deck_id):
+        return None
+    settings = deck.settings_json or {}
+    updated_settings = dict(settings)
+    updated_settings.pop("last_error", None)
+    updated_settings.pop("failed_chunks", None)
+    if not resume:
+        updated_settings.pop("retry_round", None)
+        updated_settings.pop("auto_deleted_cards", None)
+    deck.settings_json = updated_settings
+    if not speculative:
+        deck.status = "processing"
+    db.session.commit()
+
+    if stream:
+        start_progress(deck_id, 0, 0)
+        return []
+    upload = pending_upload(deck)
+    if upload:
+        # Resumed or distributed runs extract the whole upload before chunking.
+        pages = []
+        try:
+            pages.extend(iter_pdf_pages(upload["path"], upload.get("page_start"), upload.get("page_end")))
+        finally:
+            store_upload_text(deck, "\n\n".join(pages))
+
+    fingerprint = settings_fingerprint(PROMPT_VERSION, current_app.config["OPENROUTER_MODEL"], deck.card_style, settings)
+    if upload or not (resume and Source.query.filter_by(deck_id=deck_id).count()):
+        if settings_changed(deck_id, fingerprint):
+            # Existing cards were generated under other settings; start over (the cache still applies).
+            Card.query.filter_by(deck_id=deck_id).delete(synchronize_session="fetch")
+            LLMRun.query.filter_by(deck_id=deck_id).delete(synchronize_session="fetch")
+            Source.query.filter_by(deck_id=deck_id).delete(synchronize_session="fetch")
+            db.session.commit()
+        cleaned = clean_text(deck.source_text)
+        max_chars = int(settings.get("max_chars", 3500))
+        sync_sources(deck_id, chunk_text(cleaned, max_chars=max_chars), settings.get("split_sources"))
+    sources = pending_sources(deck_id)
+    total = Source.query.filter_by(deck_id=deck_id).count()
+    start_progress(deck_id, total, done=total - len(sources))
+    return sources
+
+
+def finish_generation(deck_id, chunk_errors, auto_deleted_cards=0, dedupe=True, speculative=False):
+    # Sets the final status from the chunk errors of this run; `dedupe` runs a full pass for
+    # runs whose chunks were persisted in parallel processes and not deduped incrementally.
+    # A speculative run the user has not submitted yet leaves the deck a draft.
+    deck = Deck.query.get(deck_id)
+    if not deck:
+        return None
+    # Settings may have been submitted since the run loaded the deck.
+    db.session.refresh(deck)
+    current_status = deck.status
+    cancelled = current_status == "cancelled"
+    draft = speculative and current_status == "draft"
+    if dedupe:
+        dedupe_cards(deck_id)
+    updated_settings = dict(deck.settings_json or {})
+    auto_deleted_cards += int(updated_settings.get("auto_deleted_cards") or 0)
+    if auto_deleted_cards:
+        updated_settings["auto_deleted_cards"] = auto_deleted_cards
+    else:
+        updated_settings.pop("auto_deleted_cards", None)
+    updated_settings.pop("dropped_cards", None)
+    total_sources = Source.query.filter_by(deck_id=deck_id).count()
+    if chunk_errors:
+        updated_settings["last_error"] = chunk_errors[0]
+        updated_settings["failed_chunks"] = len(chunk_errors)
+        deck.status = "failed" if len(chunk_errors) >= total_sources else "partial"
+    elif not total_sources:
+        # Only reachable for uploads, whose text is extracted during generation.
+        updated_settings["last_error"] = "No text could be extracted"
+        deck.status = "failed"
+    else:
+        deck.status = "ready"
+    if cancelled:
+        # Completed chunks are kept; resuming later picks up the rest.
+        deck.status = "cancelled"
+    elif draft:
+        deck.status = "draft"
+    deck.settings_json = updated_settings
+    db.session.commit()
+    log_llm_stats()
+    return deck_id if not chunk_errors else None
+
+
+def log_llm_stats():
+    # The counters are per process (web, worker or runner), so each logs its own totals, at most
+    # every STATS_LOG_SECONDS.
+    global _stats_logged_at
+    interval = float(current_app.config.get("STATS_LOG_SECONDS", 300))
+    if interval <= 0:
+        return
+    with _stats_log_lock:
+        now = time.monotonic()
+        if _stats_logged_at is not None and now - _stats_logged_at < interval:
+            return
+        _stats_logged_at = now
+    current_app.logger.info("LLM cache totals for this process: %s", cache_stats())
+    current_app.logger.info("JSON recovery totals for this process: %s", recovery_stats())
+
+
+def abort_generation(deck_id, error):
+    # Finalises a distributed run that failed before its chunk tasks could finish it: every chunk
+    # still without a successful run counts as failed.
+    chunk_errors = [f"Chunk {source.idx + 1}: {error}" for source in pending_sources(deck_id)]
+    return finish_generation(deck_id, chunk_errors)
+
+
+def _generate_deck(deck_id, resume=False, speculative=False):
+    deck = Deck.query.get(deck_id)
+    if not deck:
+        return None
+    # A fresh upload is parsed while its first chunks are already with the LLM.
+    upload = pending_upload(deck)
+    stream = bool(upload) and not Source.query.filter_by(deck_id=deck_id).count()
+    sources = begin_generation(deck, resume, speculative, stream=stream)
+    if sources is None:
+        return None
+    settings = deck.settings_json or {}
+    run_settings = generation_settings(settings)
+    options = llm_options()
+    model = options["model"]
+    options.update(hedge_options())
+    cancel_event = threading.Event()
+    options["cancel_event"] = cancel_event
+    fingerprint = settings_fingerprint(PROMPT_VERSION, model, deck.card_style, settings)
+
+    concurrency = max(1, int(current_app.config.get("GENERATION_CONCURRENCY", 4)))
+    # Streamed uploads are weighted by page count until their chunk count is known.
+    priority = generation_priority(deck, int(upload.get("pages") or 0) if stream else len(sources))
+    pack_max_tokens = int(current_app.config.get("GENERATION_PACK_MAX_TOKENS", 1500))
+    pack_small_tokens = int(current_app.config.get("GENERATION_PACK_SMALL_TOKENS", 300))
+
+    auto_deleted_cards = 0
+    reported_auto_deleted = 0
+    chunk_errors = []
+    card_queue = queue.Queue()
+    streamed = {}
+    # Cards are deduped per chunk as they are persisted, so the editor is usable mid-run.
+    seen = dedupe_keys(deck_id)
+
+    def stream_to(source):
+        return lambda card_data: card_queue.put((source, card_data))
+
+    last_cancel_check = time.monotonic()
+
+    def flush_streamed():
+        nonlocal auto_deleted_cards
+        auto_deleted_cards += persist_streamed_cards(deck_id, card_queue, streamed, seen)
+
+    superseded = False
+
+    def check_cancelled():
+        nonlocal last_cancel_check, superseded
+        if not cancel_event.is_set() and time.monotonic() - last_cancel_check >= CANCEL_POLL_SECONDS:
+            last_cancel_check = time.monotonic()
+            renew_flights()
+            state = generation_state(deck_id, run_settings)
+            if state:
+                # Aborts in-flight streams; workers still waiting for a slot skip their call.
+                superseded = state == "superseded"
+                cancel_event.set()
+        if cancel_event.is_set():
+            raise GenerationCancelled(superseded)
+
+    def on_idle():
+        flush_streamed()
+        check_cancelled()
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        jobs = []
+        keys = {}
+        models = {}
+
+        def submit(group):
+            # A packed group is routed on its combined text, so its results are cached and recorded
+            # under the group's model rather than the one each source would get on its own.
+            text = "".join(source.text for source in group)
+            job_options = routed_options(options, text)
+            for source in group:
+                models[source.id] = job_options["model"]
+                keys[source.id] = cache_key(source.hash, PROMPT_VERSION, models[source.id], deck.card_style, settings)
+            if len(group) == 1:
+                source = group[0]
+                messages = build_prompt(source.title, source.text, settings, deck.card_style)
+                max_tokens = output_token_budget(text, job_options)
+                future = executor.submit(
+                    run_scheduled,
+                    deck.user_id,
+                    priority,
+                    generate_chunk,
+                    messages,
+                    job_options,
+                    stream_to(source),
+                    max_tokens,
+                )
+            else:
+                messages = build_packed_prompt(group, settings, deck.card_style)
+                max_tokens = output_token_budget(text, job_options)
+                future = executor.submit(
+                    run_scheduled, deck.user_id, priority, generate_packed_chunk, messages, job_options, max_tokens
+                )
+            return (group, messages, None, future)
+
+        def add_sources(batch):
+            added = []
+            misses = []
+            for source in batch:
+                models[source.id] = route_model("chunk", source.text)
+                keys[source.id] = cache_key(source.hash, PROMPT_VERSION, models[source.id], deck.card_style, settings)
+                entry = get_cached(keys[source.id])
+                if entry is not None:
+                    messages = build_prompt(source.title, source.text, settings, deck.card_style)
+                    added.append(([source], messages, cached_chunk(entry), None))
+                else:
+                    misses.append(source)
+            for group in pack_sources(misses, pack_max_tokens, pack_small_tokens):
+                added.append(submit(group))
+            added.sort(key=lambda job: job[0][0].idx)
+            jobs.extend(added)
+
+        add_sources(sources)
+        # Streamed chunks are sent one by one as they close; packing needs the neighbours up front.
+        feed = streamed_sources(deck, upload, int(settings.get("max_chars", 3500))) if stream else None
+        backlog = concurrency * 2
+
+        settled = set()
+
+        def fail_group(group, messages, user_error):
+            for source in group:
+                if streamed.pop(source.id, None):
+                    drop_source_cards(source.id, seen)
+                chunk_errors.append(record_chunk_error(deck_id, source, messages, models[source.id], user_error))
+            db.session.commit()
+            settled.add(group[0].id)
+            bump_progress(deck_id, failed_chunks=len(group), last_error=chunk_errors[-1])
+
+        def commit_group(group, messages, result):
+            nonlocal auto_deleted_cards, reported_auto_deleted
+            done, failed = [], []
+            deleted_before = auto_deleted_cards
+            try:
+                for source, source_result in split_chunk_result(group, result):
+                    if source_result is None:
+                        user_error = "Section was missing from the packed response."
+                        failed.append(record_chunk_error(deck_id, source, messages, models[source.id], user_error))
+                        continue
+                    auto_deleted_cards += persist_chunk_cards(deck_id, source, source_result, streamed, seen)
+                    record_chunk_run(
+                        deck_id, source, messages, models[source.id], source_result, keys[source.id], fingerprint
+                    )
+                    done.append(source)
+                db.session.commit()
+            except Exception as exc:
+                # A result that cannot be stored fails its chunks like an LLM error would.
+                current_app.logger.exception("Storing chunk results of deck %s failed", deck_id)
+                db.session.rollback()
+                auto_deleted_cards = deleted_before
+                seen.clear()
+                seen.update(dedupe_keys(deck_id))
+                fail_group(group, messages, format_generation_error(exc))
+                return
+            settled.add(group[0].id)
+            chunk_errors.extend(failed)
+            bump_progress(
+                deck_id,
+                done_chunks=len(done),
+                failed_chunks=len(failed),
+                cards_created=created_card_count(done),
+                cards_auto_deleted=auto_deleted_cards - reported_auto_deleted,
+                last_error=failed[-1] if failed else None,
+            )
+            reported_auto_deleted = auto_deleted_cards
+
+        # Chunks run concurrently but results are committed in chunk order;
+        # streamed cards are persisted as they arrive while waiting. Each chunk is
+        # checkpointed by its LLMRun, so a failed chunk never discards the others.
+        position = 0
+        while position < len(jobs) or feed is not None:
+            check_cancelled()
+            if feed is not None:
+                # Parse further while the next result is not ready and the backlog has room.
+                head = jobs[position] if position < len(jobs) else None
+                if head is None or (head[2] is None and not head[3].done() and len(jobs) - position < backlog):
+                    try:
+                        source = next(feed, None)
+                    except Exception as exc:
+                        # streamed_sources has kept the pages parsed so far and removed the upload.
+                        current_app.logger.exception("PDF extraction failed for deck %s", deck_id)
+                        chunk_errors.append(f"PDF extraction stopped early: {format_generation_error(exc)}")
+                        source = None
+                    if source is None:
+                        feed = None
+                    else:
+                        add_sources([source])
+                    flush_streamed()
+                    continue
+            group, messages, result, future = jobs[position]
+            position += 1
+            try:
+                if result is None:
+                    result = wait_for_chunk(future, on_idle)
+            except GenerationCancelled:
+                raise
+            except Exception as exc:
+                flush_streamed()
+                if cancel_event.is_set():
+                    raise GenerationCancelled(superseded) from exc
+                if is_context_length_error(exc):
+                    # Too large for the model's context: split packs into their sources and
+                    # bisect single sources, then retry the pieces right after this position.
+                    if len(group) > 1:
+                        middle = len(group) // 2
+                        pieces = [group[:middle], group[middle:]]
+                    else:
+                        streamed.pop(group[0].id, None)
+                        children = bisect_source(deck, group[0])
+                        pieces = [[child] for child in children] if children else None
+                    if pieces:
+                        jobs[position:position] = [submit(piece) for piece in pieces]
+                        continue
+                fail_group(group, messages, format_generation_error(exc))
+                continue
+
+            flush_streamed()
+            commit_group(group, messages, result)
+    except GenerationCancelled:
+        # Chunks that finished while queued behind an earlier one are committed too, so resume does
+        # not pay for them again; cards streamed by unfinished chunks are dropped.
+        flush_streamed()
+        for group, messages, result, future in jobs:
+            if group[0].id in settled:
+                continue
+            if result is None:
+                if not future.done() or future.cancelled() or future.exception() is not None:
+                    continue
+                result = future.result()
+            commit_group(group, messages, result)
+        for source_id in list(streamed):
+            drop_source_cards(source_id, seen)
+        streamed.clear()
+        db.session.commit()
+    except Exception as exc:
+        # Nothing may leave the deck in processing: chunks without a successful run count as failed
+        # and the run is finalised below like any other.
+        current_app.logger.exception("Generation of deck %s failed", deck_id)
+        db.session.rollback()
+        user_error = format_generation_error(exc)
+        reported = {error.split(":", 1)[0] for error in chunk_errors}
+        for source in pending_sources(deck_id):
+            if f"Chunk {source.idx + 1}" not in reported:
+                chunk_errors.append(f"Chunk {source.idx + 1}: {user_error}")
+        if not chunk_errors:
+            chunk_errors.append(user_error)
+    finally:
+        # On cancel, queued chunks are dropped and the task returns without waiting for workers.
+        executor.shutdown(wait=not cancel_event.is_set(), cancel_futures=True)
+
+    if superseded or generation_state(deck_id, run_settings) == "superseded":
+        # The run for the new settings owns the deck now; finished chunks stay in the LLM cache.
+        return None
+    return finish_generation(deck_id, chunk_errors, auto_deleted_cards, dedupe=False, speculative=speculative)
+
+
+def is_retryable_error(exc):
+    if not isinstance(exc, OpenRouterError):
+        return False
+    return exc.status_code is None or exc.status_code == 429 or exc.status_code >= 500
+
+
+def generate_source(deck_id, source_id, final_attempt=True):
+    # One chunk of a distributed run (a Celery subtask): cache lookup, LLM call, context-length
+    # bisection and checkpoint, under the source's lock. Sources that already have a successful run
+    # are skipped, so duplicate or re-delivered tasks are harmless. Retryable errors are raised
+    # unless this is the final attempt; other errors are recorded and returned.
+    outcome = {"source_id": source_id, "auto_deleted": 0, "errors": []}
+    deck = Deck.query.get(deck_id)
+    source = Source.query.get(source_id)
+    if not deck or not source or source.deck_id != deck_id:
+        return outcome
+    lock_name = source_lock_name(source_id)
+    token = acquire_lock(lock_name)
+    if not token:
+        outcome["skipped"] = True
+        return outcome
+    try:
+        settings = deck.settings_json or {}
+        options = llm_options()
+        fingerprint = settings_fingerprint(PROMPT_VERSION, options["model"], deck.card_style, settings)
+        priority = generation_priority(deck)
+        pending = [source]
+        while pending:
+            if deck_cancelled(deck_id):
+                outcome["skipped"] = True
+                break
+            source = pending.pop(0)
+            if LLMRun.query.filter_by(source_id=source.id, error=None).first():
+                continue
+            source_options = routed_options(options, source.text)
+            messages = build_prompt(source.title, source.text, settings, deck.card_style)
+            key = cache_key(source.hash, PROMPT_VERSION, source_options["model"], deck.card_style, settings)
+            entry = get_cached(key)
+            try:
+                if entry is not None:
+                    result = cached_chunk(entry)
+                else:
+                    max_tokens = output_token_budget(source.text, source_options)
+                    result = run_scheduled(
+                        deck.user_id, priority, generate_chunk, messages, source_options, max_tokens=max_tokens
+                    )
+            except Exception as exc:
+                if is_context_length_error(exc):
+                    children = bisect_source(deck, source)
+                    if children:
+                        pending = children + pending
+                        continue
+                if not final_attempt and is_retryable_error(exc):
+                    raise
+                user_error = format_generation_error(exc)
+                outcome["errors"].append(
+                    record_chunk_error(deck_id, source, messages, source_options["model"], user_error)
+                )
+                db.session.commit()
+                bump_progress(deck_id, failed_chunks=1, last_error=outcome["errors"][-1])
+                continue
+            auto_deleted = persist_chunk_cards(deck_id, source, result, {}, dedupe_keys(deck_id))
+            record_chunk_run(deck_id, source, messages, source_options["model"], result, key, fingerprint)
+            db.session.commit()
+            outcome["auto_deleted"] += auto_deleted
+            bump_progress(
+                deck_id, done_chunks=1, cards_created=created_card_count([source]), cards_auto_deleted=auto_deleted
+            )
+    finally:
+        release_lock(lock_name, token)
+    log_llm_stats()
+    return outcome
+
+
+def card_key(card):
+    return (
+        card.type,
+        (card.front or "").lower().strip(),
+        (card.back or "").lower().strip(),
+        (card.cloze_text or "").lower().strip(),
+    )
+
+
+def dedupe_keys(deck_id):
+    return {card_key(card) for card in Card.query.filter_by(deck_id=deck_id, status="ok")}
+
+
+def dedupe_new_cards(cards, seen):
+    # Incremental dedupe: new cards repeating a key in `seen` are marked deleted before insert.
+    if seen is None:
+        return
+    for card in cards:
+        if card.status != "ok":
+            continue
+        key = card_key(card)
+        if key in seen:
+            card.status = "deleted"
+        else:
+            seen.add(key)
+
+
+def drop_source_cards(source_id, seen=None):
+    if seen is not None:
+        for card in Card.query.filter_by(source_id=source_id, status="ok"):
+            seen.discard(card_key(card))
+    Card.query.filter_by(source_id=source_id).delete()
+
+
+def created_card_count(sources):
+    if not sources:
+        return 0
+    return Card.query.filter(Card.source_id.in_([source.id for source in sources]), Card.status != "deleted").count()
+
+
+def dedupe_cards(deck_id):
+    cards = Card.query.filter_by(deck_id=deck_id, status="ok").all()
+    seen = set()
+    for card in cards:
+        key = card_key(card)
+        if key in seen:
+            card.status = "deleted"
+        else:
+            seen.add(key)
+    db.session.commit()
+
+
+def plan_regeneration(deck, source, options):
+    # Regenerating asks for a fresh answer, so the cache is not read (the new result replaces it).
+    settings = deck.settings_json or {}
+    fingerprint = settings_fingerprint(PROMPT_VERSION, options["model"], deck.card_style, settings)
+    source_options = routed_options(options, source.text)
+    return {
+        "messages": build_prompt(source.title, source.text, settings, deck.card_style),
+        "options": source_options,
+        "max_tokens": output_token_budget(source.text, source_options),
+        "key": cache_key(source.hash, PROMPT_VERSION, source_options["model"], deck.card_style, settings),
+        "fingerprint": fingerprint,
+    }
+
+
+def apply_regeneration(deck, source, plan, result):
+    # Old cards are only replaced once the new ones are in hand.
+    Card.query.filter_by(source_id=source.id).delete()
+    created_cards, _ = build_cards(deck.id, source, result["cards"])
+    if created_cards:
+        db.session.add_all(created_cards)
+    record_chunk_run(deck.id, source, plan["messages"], plan["options"]["model"], result, plan["key"], plan["fingerprint"])
     db.session.commit()
-    return source_id
+
+
+def regenerate_sources(job_id, source_ids):
+    # Bulk regenerate: one unit per source, each holding that source's lock, with the LLM calls
+    # running concurrently under GENERATION_CONCURRENCY like deck generation. A source whose
+    # regeneration under the same settings is already in flight (e.g. a double-clicked Regenerate)
+    # is not sent again; this job waits for that run and shares its outcome.
+    job = BulkJob.query.get(job_id)
+    if not job:
+        return None
+    deck = Deck.query.get(job.deck_id)
+    start_job(job, total=len(source_ids))
+    options = llm_options()
+    concurrency = max(1, int(current_app.config.get("GENERATION_CONCURRENCY", 4)))
+    ttl = float(current_app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", 900))
+    settings_key = generation_key(deck)
+    errors = []
+    joined = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for source_id in source_ids:
+            source = Source.query.get(source_id)
+            if not source or source.deck_id != job.deck_id:
+                bump_job(job.id, done=1, failed=1)
+                continue
+            flight = flight_name("regenerate", source_id, flight_key(source.hash, settings_key))
+            flight_token = acquire_lock(flight, ttl)
+            if not flight_token:
+                joined.append(flight)
+                continue
+            token = acquire_lock(source_lock_name(source_id))
+            if not token:
+                # The source is being generated by a deck run.
+                release_lock(flight, flight_token)
+                bump_job(job.id, done=1, rejected=1)
+                continue
+            plan = plan_regeneration(deck, source, options)
+            future = executor.submit(
+                run_scheduled,
+                deck.user_id,
+                PRIORITY_INTERACTIVE,
+                generate_chunk,
+                plan["messages"],
+                plan["options"],
+                None,
+                plan["max_tokens"],
+            )
+            futures[future] = (source, plan, token, flight, flight_token)
+        for future in as_completed(futures):
+            source, plan, token, flight, flight_token = futures[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                user_error = format_generation_error(exc)
+                errors.append(
+                    record_chunk_error(deck.id, source, plan["messages"], plan["options"]["model"], user_error)
+                )
+                db.session.commit()
+                release_lock(flight, flight_token)
+                bump_job(job.id, done=1, failed=1)
+            else:
+                apply_regeneration(deck, source, plan, result)
+                finish_flight(flight, flight_token, source.id)
+                bump_job(job.id, done=1, applied=1)
+            finally:
+                release_lock(source_lock_name(source.id), token)
+    for flight in joined:
+        try:
+            shared = await_flight(flight, ttl)
+        except SingleFlightTimeout:
+            shared = None
+        bump_job(job.id, done=1, applied=1 if shared else 0, failed=0 if shared else 1)
+    dedupe_cards(deck.id)
+    finish_job(job, errors[0] if errors else None)
+    return job_id
 
 
 def improve_card(card_id):
+    card = Card.query.get(card_id)
+    if not card:
+        return None
+    key = flight_key(card.type, card.front, card.back, card.cloze_text, card.extra)
+    return single_flight("improve", card_id, key, lambda: _improve_card(card_id))
+
+
+def _improve_card(card_id):
     card = Card.query.get(card_id)
     if not card:
         return None
     deck = Deck.query.get(card.deck_id)
     if not deck:
         return None
-    model = current_app.config["OPENROUTER_MODEL"]
+    model = route_model("improve")
     api_key = current_app.config["OPENROUTER_API_KEY"]
     site_url = current_app.config["OPENROUTER_SITE_URL"]
     app_name = current_app.config["OPENROUTER_APP_NAME"]
@@ -424,7 +1619,10 @@ def improve_card(card_id):
         {"role": "system", "content": "You output strict JSON only. No prose."},
         {"role": "user", "content": prompt},
     ]
-    response = openrouter_chat(
+    response = run_scheduled(
+        deck.user_id,
+        PRIORITY_INTERACTIVE,
+        openrouter_chat,
         messages,
         model,
         api_key,
@@ -433,6 +1631,7 @@ def improve_card(card_id):
         max_retries=llm_max_retries,
         backoff_seconds=llm_backoff_seconds,
         timeout_seconds=llm_timeout_seconds,
+        fallback_models=fallback_models(model),
     )
     content = response["choices"][0]["message"]["content"]
     data = extract_json(content)
@@ -450,3 +1649,104 @@ def improve_card(card_id):
         "Scope: ONLY use facts explicitly stated in the chunk content. "
         "Do not add external knowledge or assumptions."
     )
+
+
+def build_improve_prompt(cards):
+    items = []
+    for card in cards:
+        if card.type == "basic":
+            items.append({"id": str(card.id), "type": "basic", "front": card.front, "back": card.back})
+        else:
+            items.append({"id": str(card.id), "type": "cloze", "cloze_text": card.cloze_text, "extra": card.extra or ""})
+    prompt = (
+        "Improve these Anki cards for clarity and concision. "
+        "Preserve valid cloze syntax and keep math in \\( \\) or \\[ \\] delimiters. "
+        f"Return only JSON keyed by card id: {IMPROVE_SCHEMA_HINT}. "
+        "Basic cards return front/back, cloze cards return cloze_text/extra.\n\n"
+        f"Cards:\n{json.dumps(items, ensure_ascii=False, indent=2)}"
+    )
+    return [
+        {"role": "system", "content": "You output strict JSON only. No prose."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def improve_batch(messages, options):
+    # Runs on worker threads: network and parsing only.
+    content, _, _ = complete_chat(messages, options)
+    data = load_llm_json(
+        content,
+        options["repair_model"],
+        options["api_key"],
+        options["site_url"],
+        options["app_name"],
+        max_retries=options["max_retries"],
+        backoff_seconds=options["backoff_seconds"],
+        timeout_seconds=options["timeout_seconds"],
+        schema_hint=IMPROVE_SCHEMA_HINT,
+    )
+    improved = data.get("cards") if isinstance(data, dict) else None
+    if not isinstance(improved, dict):
+        raise ValueError("LLM response did not contain a cards object keyed by id.")
+    return improved
+
+
+def apply_improvement(card, fields):
+    # Applies an improved version only if it still passes the card checks; otherwise keeps the card.
+    if not isinstance(fields, dict):
+        return False
+    if card.type == "basic":
+        front = normalize_math(normalize_text(fields.get("front") or ""))
+        back = normalize_math(normalize_text(fields.get("back") or ""))
+        if not front or not back or not is_math_valid(front) or not is_math_valid(back):
+            return False
+        card.front, card.back = front, back
+    else:
+        cloze_text = normalize_math(normalize_text(fields.get("cloze_text") or ""))
+        extra = normalize_math(normalize_text(fields.get("extra") or ""))
+        if not is_valid_cloze(cloze_text) or not is_math_valid(cloze_text) or not is_math_valid(extra):
+            return False
+        card.cloze_text, card.extra = cloze_text, extra
+    return True
+
+
+def improve_cards(job_id, card_ids):
+    # Bulk improve: cards are sent in batches of IMPROVE_BATCH_SIZE, batches run concurrently,
+    # and results are validated and applied on this thread as each batch completes.
+    job = BulkJob.query.get(job_id)
+    if not job:
+        return None
+    cards = (
+        Card.query.filter(Card.deck_id == job.deck_id, Card.id.in_(card_ids), Card.status != "deleted")
+        .order_by(Card.id)
+        .all()
+    )
+    start_job(job, total=len(cards))
+    options = llm_options()
+    model = route_model("improve")
+    options = dict(options, model=model, fallback_models=fallback_models(model))
+    batch_size = max(1, int(current_app.config.get("IMPROVE_BATCH_SIZE", 20)))
+    concurrency = max(1, int(current_app.config.get("GENERATION_CONCURRENCY", 4)))
+    batches = [cards[start : start + batch_size] for start in range(0, len(cards), batch_size)]
+    user_id = Deck.query.get(job.deck_id).user_id
+    errors = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                run_scheduled, user_id, PRIORITY_INTERACTIVE, improve_batch, build_improve_prompt(batch), options
+            ): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                improved = future.result()
+            except Exception as exc:
+                errors.append(format_generation_error(exc))
+                bump_job(job.id, done=len(batch), failed=len(batch))
+                continue
+            applied = sum(1 for card in batch if apply_improvement(card, improved.get(str(card.id))))
+            db.session.commit()
+            bump_job(job.id, done=len(batch), applied=applied, rejected=len(batch) - applied)
+    finish_job(job, errors[0] if errors else None)
+    return job_id
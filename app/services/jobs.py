@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+from ..extensions import db
+from ..models import BulkJob
+
+
+ACTIVE_STATUSES = ("queued", "running")
+RECENT_JOB_MINUTES = 10
+
+
+def create_job(deck_id, kind, total=0):
+    job = BulkJob(deck_id=deck_id, kind=kind, total=total)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def start_job(job, total=None):
+    job.status = "running"
+    if total is not None:
+        job.total = total
+    db.session.commit()
+
+
+def bump_job(job_id, **counts):
+    # Counter updates are applied in SQL so concurrent workers never overwrite each other's progress.
+    values = {getattr(BulkJob, name): getattr(BulkJob, name) + amount for name, amount in counts.items() if amount}
+    if not values:
+        return
+    values[BulkJob.updated_at] = datetime.utcnow()
+    BulkJob.query.filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def finish_job(job, error=None):
+    db.session.refresh(job)
+    if error and not job.applied:
+        job.status = "failed"
+    else:
+        job.status = "done"
+    job.error = error
+    db.session.commit()
+
+
+def deck_jobs(deck_id):
+    # Running jobs plus recently finished ones, so the editor can show their outcome.
+    recent = datetime.utcnow() - timedelta(minutes=RECENT_JOB_MINUTES)
+    return (
+        BulkJob.query.filter(BulkJob.deck_id == deck_id)
+        .filter(BulkJob.status.in_(ACTIVE_STATUSES) | (BulkJob.updated_at >= recent))
+        .order_by(BulkJob.created_at.desc())
+        .all()
+    )
@@ -1,11 +1,49 @@
+import functools
 import json
+import os
+import queue
+import re
+import socket
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from .ratelimit import RateLimitTimeout, get_rate_limiter
 
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 _HEX_CHARS = set("0123456789abcdefABCDEF")
 
+CARDS_SCHEMA_HINT = (
+    "{\"cards\": [{\"type\": \"basic|cloze\", "
+    "\"front\": string?, \"back\": string?, \"cloze_text\": string?, "
+    "\"extra\": string?, \"tags\": [string]}]}"
+)
+
+_CODE_FENCE = re.compile(r"```[A-Za-z]*[ \t]*\n?(.*?)(?:```|$)", re.DOTALL)
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+_recovery_lock = threading.Lock()
+_recovery_stats = {
+    "direct": 0,
+    "code_fence": 0,
+    "prose": 0,
+    "single_quotes": 0,
+    "python_literals": 0,
+    "trailing_commas": 0,
+    "escapes": 0,
+    "truncated": 0,
+    "recovered": 0,
+    "llm_repair": 0,
+}
+
+_session_lock = threading.Lock()
+_session = None
+_session_pid = None
+_pool_settings = {"pool_size": 16, "keepalive": True}
+
 
 class OpenRouterError(RuntimeError):
     def __init__(self, message, status_code=None, error_code=None, response_body=None):
@@ -15,6 +53,25 @@ class OpenRouterError(RuntimeError):
         self.response_body = response_body
 
 
+class HedgeCancelled(OpenRouterError):
+    pass
+
+
+class HedgeBudget:
+    # Caps how many duplicate (hedge) requests one generation run may fire.
+    def __init__(self, limit):
+        self.limit = max(0, int(limit))
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+
 def build_headers(api_key, site_url, app_name):
     headers = {"Authorization": f"Bearer {api_key}"}
     if site_url:
@@ -24,6 +81,52 @@ def build_headers(api_key, site_url, app_name):
     return headers
 
 
+class _PooledAdapter(HTTPAdapter):
+    def __init__(self, keepalive=True, **kwargs):
+        self._keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._keepalive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def configure_http_pool(pool_size=None, keepalive=None):
+    global _session
+    with _session_lock:
+        if pool_size is not None:
+            _pool_settings["pool_size"] = max(1, int(pool_size))
+        if keepalive is not None:
+            _pool_settings["keepalive"] = bool(keepalive)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    # One pooled session per process: forked Celery workers build their own instead of sharing sockets.
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            session = requests.Session()
+            adapter = _PooledAdapter(
+                keepalive=_pool_settings["keepalive"],
+                pool_connections=1,
+                pool_maxsize=_pool_settings["pool_size"],
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = pid
+    return _session
+
+
 def _parse_error_response(response):
     detail = ""
     error_code = None
@@ -44,16 +147,22 @@ def _parse_error_response(response):
 
 
 def _retry_delay_seconds(attempt, backoff_seconds, retry_after_header):
-    if retry_after_header:
-        try:
-            value = float(retry_after_header)
-            if value >= 0:
-                return min(value, 60.0)
-        except ValueError:
-            pass
+    retry_after = _retry_after_seconds(retry_after_header)
+    if retry_after is not None:
+        return retry_after
     return min(backoff_seconds * (2**attempt), 60.0)
 
 
+def _retry_after_seconds(retry_after_header):
+    if not retry_after_header:
+        return None
+    try:
+        value = float(retry_after_header)
+    except ValueError:
+        return None
+    return min(value, 60.0) if value >= 0 else None
+
+
 def _should_retry(status_code, detail):
     if status_code in {500, 502, 503, 504}:
         return True
@@ -74,35 +183,105 @@ def openrouter_chat(
     max_retries=2,
     backoff_seconds=1.5,
     timeout_seconds=120,
+    stream=False,
+    on_card=None,
+    max_tokens=None,
+    hedge_after_seconds=None,
+    hedge_model=None,
+    hedge_budget=None,
+    cancel_event=None,
+    fallback_models=None,
 ):
     if not api_key:
         raise RuntimeError("OPENROUTER_API_KEY is not set")
+    if hedge_after_seconds or fallback_models:
+        call = functools.partial(
+            openrouter_chat,
+            messages,
+            api_key=api_key,
+            site_url=site_url,
+            app_name=app_name,
+            temperature=temperature,
+            max_retries=max_retries,
+            backoff_seconds=backoff_seconds,
+            timeout_seconds=timeout_seconds,
+            stream=stream,
+            max_tokens=max_tokens,
+            fallback_models=fallback_models,
+        )
+        if hedge_after_seconds:
+            return _hedged_chat(
+                call, model, hedge_model or model, hedge_after_seconds, hedge_budget, on_card, cancel_event
+            )
+        try:
+            return call(model=model, on_card=on_card, cancel_event=cancel_event, fallback_models=None)
+        except OpenRouterError as exc:
+            # Rate-limited or failing upstream after retries: move on to the next model.
+            if isinstance(exc, HedgeCancelled) or not (exc.status_code == 429 or (exc.status_code or 0) >= 500):
+                raise
+            return call(
+                model=fallback_models[0],
+                on_card=on_card,
+                cancel_event=cancel_event,
+                fallback_models=fallback_models[1:],
+            )
     payload = {
         "model": model,
         "messages": messages,
         "temperature": temperature,
     }
+    if max_tokens:
+        payload["max_tokens"] = int(max_tokens)
+    # Streamed requests can be abandoned between SSE events; others are checked between attempts
+    # and bounded by the request timeout.
+    if stream:
+        payload["stream"] = True
     headers = build_headers(api_key, site_url, app_name)
     attempts = max(0, int(max_retries)) + 1
+    limiter = get_rate_limiter()
     for attempt in range(attempts):
+        if cancel_event is not None and cancel_event.is_set():
+            raise HedgeCancelled("OpenRouter request cancelled.")
+        slot = None
+        if limiter is not None:
+            try:
+                slot = limiter.acquire(timeout=timeout_seconds)
+            except RateLimitTimeout as exc:
+                raise OpenRouterError(str(exc), status_code=429) from exc
         try:
-            response = requests.post(OPENROUTER_URL, json=payload, headers=headers, timeout=timeout_seconds)
-        except (requests.Timeout, requests.ConnectionError) as exc:
-            if attempt < attempts - 1:
-                time.sleep(_retry_delay_seconds(attempt, backoff_seconds, None))
-                continue
-            raise OpenRouterError(f"OpenRouter request failed: {exc}") from exc
-        except requests.RequestException as exc:
-            raise OpenRouterError(f"OpenRouter request failed: {exc}") from exc
-
-        if response.status_code < 400:
             try:
-                return response.json()
-            except ValueError as exc:
-                raise OpenRouterError("OpenRouter returned invalid JSON.") from exc
+                response = get_session().post(
+                    OPENROUTER_URL, json=payload, headers=headers, timeout=timeout_seconds, stream=stream
+                )
+            except (requests.Timeout, requests.ConnectionError) as exc:
+                if attempt < attempts - 1:
+                    _retry_wait(_retry_delay_seconds(attempt, backoff_seconds, None), cancel_event)
+                    continue
+                raise OpenRouterError(f"OpenRouter request failed: {exc}") from exc
+            except requests.RequestException as exc:
+                raise OpenRouterError(f"OpenRouter request failed: {exc}") from exc
 
-        detail, error_code = _parse_error_response(response)
-        status_code = response.status_code
+            if response.status_code < 400:
+                if limiter is not None:
+                    limiter.record_success()
+                if stream:
+                    result = _read_stream(response, on_card, cancel_event)
+                else:
+                    try:
+                        result = response.json()
+                    except ValueError as exc:
+                        raise OpenRouterError("OpenRouter returned invalid JSON.") from exc
+                result["routed_model"] = model
+                return result
+
+            detail, error_code = _parse_error_response(response)
+            status_code = response.status_code
+            retry_after = response.headers.get("Retry-After")
+            if status_code == 429 and limiter is not None:
+                limiter.record_throttle(_retry_after_seconds(retry_after))
+        finally:
+            if limiter is not None:
+                limiter.release(slot)
         parts = [f"OpenRouter error {status_code}"]
         if error_code:
             parts.append(f"({error_code})")
@@ -110,14 +289,203 @@ def openrouter_chat(
             parts.append(f": {detail}")
         message = " ".join(parts)
         if _should_retry(status_code, detail) and attempt < attempts - 1:
-            retry_after = response.headers.get("Retry-After")
-            time.sleep(_retry_delay_seconds(attempt, backoff_seconds, retry_after))
+            _retry_wait(_retry_delay_seconds(attempt, backoff_seconds, retry_after), cancel_event)
             continue
         raise OpenRouterError(message, status_code=status_code, error_code=error_code, response_body=detail)
 
     raise OpenRouterError("OpenRouter request failed after retries.")
 
 
+def _retry_wait(seconds, cancel_event=None):
+    if cancel_event is None:
+        time.sleep(seconds)
+    elif cancel_event.wait(seconds):
+        raise HedgeCancelled("OpenRouter request cancelled.")
+
+
+def _hedged_chat(call, model, hedge_model, hedge_after_seconds, hedge_budget, on_card, cancel_event=None):
+    # Fires a duplicate request (optionally to another model) once the first has run longer
+    # than `hedge_after_seconds`; the first successful reply wins and the other is cancelled.
+    # Only one racer may stream cards, so `on_card` never sees the same chunk twice.
+    outcomes = queue.Queue()
+    stream_owner = []
+    owner_lock = threading.Lock()
+
+    def race(name, racer_model, cancel_event):
+        card_sink = None
+        if on_card is not None:
+
+            def card_sink(card):
+                with owner_lock:
+                    if not stream_owner:
+                        stream_owner.append(name)
+                    if stream_owner[0] != name:
+                        return
+                on_card(card)
+
+        try:
+            outcomes.put((name, call(model=racer_model, on_card=card_sink, cancel_event=cancel_event), None))
+        except Exception as exc:
+            outcomes.put((name, None, exc))
+
+    def next_outcome(timeout=None):
+        # Waits for a racer while passing an outside cancellation on to every racer.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                for _, racer_event in racers.values():
+                    racer_event.set()
+                raise HedgeCancelled("OpenRouter request cancelled.")
+            wait = 0.25 if deadline is None else min(0.25, deadline - time.monotonic())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return outcomes.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    racers = {"primary": (model, threading.Event())}
+    threading.Thread(target=race, args=("primary", model, racers["primary"][1]), daemon=True).start()
+    try:
+        first = next_outcome(hedge_after_seconds)
+    except queue.Empty:
+        first = None
+        if hedge_budget is None or hedge_budget.take():
+            racers["hedge"] = (hedge_model, threading.Event())
+            threading.Thread(target=race, args=("hedge", hedge_model, racers["hedge"][1]), daemon=True).start()
+
+    remaining = len(racers)
+    error = None
+    while True:
+        name, response, exc = first if first is not None else next_outcome()
+        first = None
+        remaining -= 1
+        if exc is None:
+            break
+        error = error or exc
+        if not remaining:
+            raise error
+    for other, (_, cancel_event) in racers.items():
+        if other != name:
+            cancel_event.set()
+    response["hedge"] = {"hedged": "hedge" in racers, "winner": name, "model": response.get("routed_model")}
+    return response
+
+
+class CardStreamParser:
+    # Incrementally scans {"cards": [...]} output and emits each card object as soon as it closes.
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._card_start = None
+
+    def feed(self, chunk):
+        self.text += chunk or ""
+        cards = []
+        text = self.text
+        while self._pos < len(text):
+            ch = text[self._pos]
+            if not self._stack:
+                if ch == "{":
+                    self._stack.append(ch)
+                self._pos += 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and self._stack == ["{", "["]:
+                    self._card_start = self._pos
+                self._stack.append(ch)
+            elif ch in "}]":
+                self._stack.pop()
+                if ch == "}" and self._stack == ["{", "["] and self._card_start is not None:
+                    fragment = text[self._card_start : self._pos + 1]
+                    self._card_start = None
+                    try:
+                        card = _json_load_with_repair(fragment)
+                    except json.JSONDecodeError:
+                        card = None
+                    if isinstance(card, dict):
+                        cards.append(card)
+            self._pos += 1
+        return cards
+
+
+def _read_stream(response, on_card=None, cancel_event=None):
+    # Consumes an OpenRouter SSE stream and returns a response shaped like the non-streaming API.
+    parser = CardStreamParser()
+    finish_reason = None
+    usage = {}
+    response.encoding = "utf-8"
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if cancel_event is not None and cancel_event.is_set():
+                raise HedgeCancelled("OpenRouter stream cancelled.")
+            if not line or line.startswith(":") or not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                # Keep reading to the end of the body so the pooled connection can be reused.
+                continue
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            err = event.get("error")
+            if err:
+                detail = str(err.get("message") or err) if isinstance(err, dict) else str(err)
+                code = err.get("code") if isinstance(err, dict) else None
+                status_code = code if isinstance(code, int) else None
+                raise OpenRouterError(
+                    f"OpenRouter stream error: {detail}",
+                    status_code=status_code,
+                    error_code=code,
+                    response_body=detail,
+                )
+            if event.get("usage"):
+                usage = event["usage"]
+            for choice in event.get("choices") or []:
+                delta = choice.get("delta") or {}
+                for card in parser.feed(delta.get("content") or ""):
+                    if on_card is not None:
+                        on_card(card)
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+    except requests.RequestException as exc:
+        raise OpenRouterError(f"OpenRouter stream interrupted: {exc}") from exc
+    finally:
+        response.close()
+    return {
+        "choices": [{"message": {"content": parser.text}, "finish_reason": finish_reason}],
+        "usage": usage,
+    }
+
+
+def finish_reason(response):
+    choices = (response or {}).get("choices") or [{}]
+    return choices[0].get("finish_reason") or choices[0].get("native_finish_reason")
+
+
+def merge_usage(total, usage):
+    merged = dict(total or {})
+    for key, value in (usage or {}).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            merged[key] = (merged.get(key) or 0) + value
+        elif key not in merged:
+            merged[key] = value
+    return merged
+
+
 def _sanitize_json_string_escapes(text):
     # Repair common LLM JSON mistakes: invalid backslash escapes and raw control chars in strings.
     out = []
@@ -200,6 +568,125 @@ def extract_json(text):
         raise
 
 
+def record_recovery(*paths):
+    with _recovery_lock:
+        for path in paths:
+            _recovery_stats[path] = _recovery_stats.get(path, 0) + 1
+
+
+def recovery_stats():
+    with _recovery_lock:
+        return dict(_recovery_stats)
+
+
+def _rewrite_json(body, start, paths):
+    # Single pass over the candidate JSON: converts single-quoted strings and Python literals,
+    # drops trailing commas and stray text after the top-level value, and remembers the last
+    # point where a list item object (a card) completed so truncated output can be cut back to it
+    # without keeping a half-finished card.
+    out = []
+    stack = []
+    safe_cut = None
+    in_string = False
+    quote = '"'
+    escape = False
+    i = start
+    n = len(body)
+    while i < n:
+        ch = body[i]
+        if in_string:
+            if escape:
+                escape = False
+                if quote == "'" and ch == "'":
+                    out[-1] = "'"
+                else:
+                    out.append(ch)
+            elif ch == "\\":
+                out.append(ch)
+                escape = True
+            elif ch == quote:
+                out.append('"')
+                in_string = False
+            elif ch == '"':
+                out.append('\\"')
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        if ch in "\"'":
+            if ch == "'":
+                paths.add("single_quotes")
+            in_string = True
+            quote = ch
+            out.append('"')
+        elif ch in "{[":
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "}]":
+            j = len(out) - 1
+            while j >= 0 and out[j].isspace():
+                j -= 1
+            if j >= 0 and out[j] == ",":
+                del out[j]
+                paths.add("trailing_commas")
+            if not stack:
+                break
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                if body[i + 1 :].strip(" \t\r\n`"):
+                    paths.add("prose")
+                break
+            # Item objects: list entries ({"cards": [{...}]}, packed sections) or values of an
+            # id-keyed map ({"cards": {"12": {...}}}). Inner lists and objects of a card never count.
+            if ch == "}" and (stack[-1] == "[" or stack == ["{", "{"]):
+                safe_cut = (len(out), list(stack))
+        elif ch.isalpha():
+            match = re.match(r"[A-Za-z]+", body[i:])
+            word = match.group(0)
+            if word in _PY_LITERALS:
+                paths.add("python_literals")
+                word = _PY_LITERALS[word]
+            out.append(word)
+            i += len(match.group(0))
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    if not stack:
+        return "".join(out)
+    paths.add("truncated")
+    if safe_cut is None:
+        raise ValueError("Truncated JSON has no complete item to keep.")
+    length, open_stack = safe_cut
+    kept = "".join(out[:length]).rstrip().rstrip(",")
+    return kept + "".join(_CLOSERS[opener] for opener in reversed(open_stack))
+
+
+def recover_json(text):
+    # Local recovery for common LLM JSON failures, tried before paying for an LLM repair call.
+    paths = set()
+    body = text or ""
+    fence = _CODE_FENCE.search(body)
+    if fence and ("{" in fence.group(1) or "[" in fence.group(1)):
+        body = fence.group(1)
+        paths.add("code_fence")
+    starts = [pos for pos in (body.find("{"), body.find("[")) if pos != -1]
+    if not starts:
+        raise ValueError("No JSON object found.")
+    start = min(starts)
+    if body[:start].strip():
+        paths.add("prose")
+    candidate = _rewrite_json(body, start, paths)
+    try:
+        data = json.loads(candidate)
+    except json.JSONDecodeError:
+        data = json.loads(_sanitize_json_string_escapes(candidate))
+        paths.add("escapes")
+    record_recovery("recovered", *sorted(paths))
+    return data
+
+
 def repair_json(
     raw_text,
     model,
@@ -209,13 +696,9 @@ def repair_json(
     max_retries=2,
     backoff_seconds=1.5,
     timeout_seconds=120,
+    schema_hint=CARDS_SCHEMA_HINT,
 ):
-    prompt = (
-        "Fix the JSON to match this schema: {\"cards\": [{\"type\": \"basic|cloze\", "
-        "\"front\": string?, \"back\": string?, \"cloze_text\": string?, "
-        "\"extra\": string?, \"tags\": [string]}]}. "
-        "Return only valid JSON."
-    )
+    prompt = f"Fix the JSON to match this schema: {schema_hint}. Return only valid JSON."
     messages = [
         {"role": "system", "content": "You fix invalid JSON outputs."},
         {"role": "user", "content": prompt + "\n\nInvalid JSON:\n" + raw_text},
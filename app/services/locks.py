@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from .chunking import hash_text
+from ..extensions import db
+from ..models import ResourceLock
+
+
+DEFAULT_LOCK_TTL_SECONDS = 900
+FLIGHT_POLL_SECONDS = 0.5
+
+
+class SingleFlightTimeout(RuntimeError):
+    pass
+
+
+class FlightInProgress(RuntimeError):
+    # Raised instead of waiting when the caller asked not to block (e.g. a task that re-enqueues).
+    pass
+
+
+_held = threading.local()
+
+
+def acquire_lock(name, ttl_seconds=DEFAULT_LOCK_TTL_SECONDS):
+    # Cross-process mutex backed by a unique row; expired locks (from crashed workers) are taken over.
+    # Call at a commit boundary: a lost race rolls back the session.
+    now = datetime.utcnow()
+    ResourceLock.query.filter(ResourceLock.name == name, ResourceLock.expires_at < now).delete(
+        synchronize_session="fetch"
+    )
+    token = uuid.uuid4().hex
+    db.session.add(ResourceLock(name=name, token=token, expires_at=now + timedelta(seconds=ttl_seconds)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return token
+
+
+def renew_lock(name, token, ttl_seconds=DEFAULT_LOCK_TTL_SECONDS):
+    # Extends a held lock; returns False if it was lost (expired and taken over, or released).
+    if not token:
+        return False
+    renewed = ResourceLock.query.filter(
+        ResourceLock.name == name, ResourceLock.token == token, ResourceLock.finished_at.is_(None)
+    ).update({ResourceLock.expires_at: datetime.utcnow() + timedelta(seconds=ttl_seconds)}, synchronize_session=False)
+    db.session.commit()
+    return bool(renewed)
+
+
+def renew_flights():
+    # Called from long-running flights (once per chunk or poll): keeps the single-flight locks held
+    # by this thread alive past their TTL, at most every third of the TTL.
+    now = time.monotonic()
+    for flight in getattr(_held, "flights", []):
+        if now - flight["renewed_at"] >= flight["ttl"] / 3:
+            renew_lock(flight["name"], flight["token"], flight["ttl"])
+            flight["renewed_at"] = now
+
+
+def release_lock(name, token):
+    if not token:
+        return
+    ResourceLock.query.filter_by(name=name, token=token).delete(synchronize_session="fetch")
+    db.session.commit()
+
+
+def source_lock_name(source_id):
+    return f"source:{source_id}"
+
+
+def flight_key(*parts):
+    return hash_text(json.dumps(parts, sort_keys=True, default=str))
+
+
+def flight_name(operation, target_id, key):
+    return f"flight:{operation}:{target_id}:{key}"
+
+
+def wait_for_flights(operations, target_id, exclude=None, timeout_seconds=None, wait=True):
+    # Waits until no other unfinished flight of `operations` on the target is held (e.g. a deck run
+    # under superseded settings that is still stopping). Returns False on timeout; with wait=False
+    # raises FlightInProgress instead of polling.
+    if timeout_seconds is None:
+        timeout_seconds = float(current_app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", DEFAULT_LOCK_TTL_SECONDS))
+    prefixes = [flight_name(operation, target_id, "") for operation in operations]
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        query = ResourceLock.query.filter(
+            db.or_(*[ResourceLock.name.startswith(prefix) for prefix in prefixes]),
+            ResourceLock.finished_at.is_(None),
+            ResourceLock.expires_at > datetime.utcnow(),
+        )
+        if exclude:
+            query = query.filter(ResourceLock.name != exclude)
+        if query.first() is None:
+            return True
+        if not wait:
+            raise FlightInProgress(f"Another run on {target_id} is in progress.")
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(FLIGHT_POLL_SECONDS)
+
+
+def single_flight(operation, target_id, key, fn, timeout_seconds=None, wait=True):
+    # Runs fn() once per (operation, target, key) across threads, processes and workers: the first
+    # caller holds the lock and stores fn's (JSON-serialisable) result on the lock row, and callers
+    # that were waiting on that run get the same result instead of starting their own. With
+    # wait=False a caller that finds the flight held gets FlightInProgress instead of blocking.
+    # fn() keeps the lock past its TTL by calling renew_flights().
+    if timeout_seconds is None:
+        timeout_seconds = float(current_app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", DEFAULT_LOCK_TTL_SECONDS))
+    name = flight_name(operation, target_id, key)
+    deadline = time.monotonic() + timeout_seconds
+    waiting_on = None
+    while True:
+        lock = ResourceLock.query.filter_by(name=name).populate_existing().first()
+        if lock is not None and lock.finished_at is not None and lock.token == waiting_on:
+            return lock.result
+        if lock is None or lock.expires_at < datetime.utcnow():
+            # Free, finished before we arrived, or abandoned by a crashed worker: run it ourselves.
+            token = acquire_lock(name, timeout_seconds)
+            if token:
+                break
+            continue
+        if not wait:
+            raise FlightInProgress(f"{operation} of {target_id} is already in progress.")
+        waiting_on = lock.token
+        if time.monotonic() >= deadline:
+            raise SingleFlightTimeout(f"Timed out waiting for in-flight {operation} of {target_id}.")
+        time.sleep(FLIGHT_POLL_SECONDS)
+    flights = _held.__dict__.setdefault("flights", [])
+    flight = {"name": name, "token": token, "ttl": timeout_seconds, "renewed_at": time.monotonic()}
+    flights.append(flight)
+    try:
+        result = fn()
+    except Exception:
+        db.session.rollback()
+        release_lock(name, token)
+        raise
+    finally:
+        flights.remove(flight)
+    finish_flight(name, token, result)
+    return result
+
+
+def finish_flight(name, token, result):
+    # The finished row expires at once; it only lingers so waiting callers can read the result.
+    now = datetime.utcnow()
+    ResourceLock.query.filter_by(name=name, token=token).update(
+        {ResourceLock.finished_at: now, ResourceLock.result: result, ResourceLock.expires_at: now},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def await_flight(name, timeout_seconds=None):
+    # Waits for a flight held by another caller (see single_flight) and returns its result, or None
+    # if that run failed or was abandoned.
+    if timeout_seconds is None:
+        timeout_seconds = float(current_app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", DEFAULT_LOCK_TTL_SECONDS))
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        lock = ResourceLock.query.filter_by(name=name).populate_existing().first()
+        if lock is None or lock.finished_at is not None:
+            return lock.result if lock is not None else None
+        if lock.expires_at < datetime.utcnow():
+            return None
+        if time.monotonic() >= deadline:
+            raise SingleFlightTimeout(f"Timed out waiting for {name}.")
+        time.sleep(FLIGHT_POLL_SECONDS)
@@ -129,7 +129,9 @@ def _result_to_markdown(raw):
     return ""
 
 
-def _extract_markdown_with_pymupdf4llm(file_path, start, end, total_pages):
+def _load_pymupdf4llm():
+    # Returns (to_markdown, pymupdf, params), or None when pymupdf4llm is unavailable. pymupdf is
+    # None when only pymupdf4llm is installed; params are to_markdown's keyword names.
     try:
         # Enables advanced page layout analysis used by pymupdf4llm.
         import pymupdf.layout  # noqa: F401
@@ -141,7 +143,7 @@ def _extract_markdown_with_pymupdf4llm(file_path, start, end, total_pages):
     try:
         import pymupdf4llm
     except ImportError:
-        return ""
+        return None
     try:
         import pymupdf
     except ImportError:
@@ -149,16 +151,24 @@ def _extract_markdown_with_pymupdf4llm(file_path, start, end, total_pages):
 
     to_markdown = getattr(pymupdf4llm, "to_markdown", None)
     if to_markdown is None:
-        return ""
-
-    page_indexes = list(range(start, end))
-    if not page_indexes:
-        return ""
+        return None
 
     try:
         params = set(inspect.signature(to_markdown).parameters)
     except (TypeError, ValueError):
         params = set()
+    return to_markdown, pymupdf, params
+
+
+def _extract_markdown_with_pymupdf4llm(file_path, start, end, total_pages):
+    loaded = _load_pymupdf4llm()
+    if loaded is None:
+        return ""
+    to_markdown, pymupdf, params = loaded
+
+    page_indexes = list(range(start, end))
+    if not page_indexes:
+        return ""
 
     def run_to_markdown(**kwargs):
         if pymupdf is None:
@@ -184,13 +194,64 @@ def _extract_markdown_with_pymupdf4llm(file_path, start, end, total_pages):
     return ""
 
 
+def _iter_pymupdf4llm_pages(file_path, start, end):
+    # Page-at-a-time variant of _extract_markdown_with_pymupdf4llm. Yields "" for pages it cannot
+    # convert and nothing at all when pymupdf4llm is missing or cannot select pages.
+    loaded = _load_pymupdf4llm()
+    if loaded is None:
+        return
+    to_markdown, pymupdf, params = loaded
+    if "pages" not in params:
+        return
+
+    def convert(doc, index):
+        try:
+            return _normalize_pdf_text(_result_to_markdown(to_markdown(doc, pages=[index])))
+        except Exception:
+            return ""
+
+    if pymupdf is None:
+        for index in range(start, end):
+            yield convert(file_path, index)
+        return
+    with pymupdf.open(file_path) as doc:
+        for index in range(start, end):
+            yield convert(doc, index)
+
+
+def pdf_page_range(total, page_start=None, page_end=None):
+    start = max(0, (page_start or 1) - 1)
+    end = min(total, page_end or total)
+    return start, end
+
+
+def count_pdf_pages(file_path, page_start=None, page_end=None):
+    with open(file_path, "rb") as fh:
+        start, end = pdf_page_range(len(PdfReader(fh).pages), page_start, page_end)
+    return max(0, end - start)
+
+
+def iter_pdf_pages(file_path, page_start=None, page_end=None):
+    # Yields the Markdown of each non-empty page as soon as it is converted, so chunking and
+    # generation can start on the first pages of a long document.
+    with open(file_path, "rb") as fh:
+        reader = PdfReader(fh)
+        start, end = pdf_page_range(len(reader.pages), page_start, page_end)
+        converted = _iter_pymupdf4llm_pages(file_path, start, end)
+        for index in range(start, end):
+            markdown = next(converted, "")
+            if not markdown:
+                markdown = _format_plain_text_as_markdown(reader.pages[index].extract_text() or "")
+            if markdown:
+                yield markdown
+
+
 def extract_pdf_text(file_path, page_start=None, page_end=None):
     with open(file_path, "rb") as fh:
         reader = PdfReader(fh)
         pages = reader.pages
         total = len(pages)
-        start = max(0, (page_start or 1) - 1)
-        end = min(total, page_end or total)
+        start, end = pdf_page_range(total, page_start, page_end)
 
         markdown = _extract_markdown_with_pymupdf4llm(file_path, start, end, total)
         if markdown:
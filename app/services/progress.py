@@ -0,0 +1,63 @@
+from datetime import datetime
+from ..extensions import db
+from ..models import Card, Deck, GenerationProgress
+
+
+def start_progress(deck_id, total, done=0):
+    # One row per deck, reset at the start of every run; resumed runs start from the chunks already done.
+    progress = GenerationProgress.query.get(deck_id)
+    if progress is None:
+        progress = GenerationProgress(deck_id=deck_id)
+        db.session.add(progress)
+    now = datetime.utcnow()
+    progress.total_chunks = total
+    progress.done_chunks = done
+    progress.initial_done = done
+    progress.failed_chunks = 0
+    progress.cards_created = Card.query.filter(Card.deck_id == deck_id, Card.status != "deleted").count()
+    progress.cards_auto_deleted = 0
+    progress.last_error = None
+    progress.started_at = now
+    progress.updated_at = now
+    db.session.commit()
+
+
+def bump_progress(deck_id, last_error=None, **counts):
+    # Counter updates are applied in SQL, like bump_job, so parallel chunk tasks never lose updates.
+    values = {
+        getattr(GenerationProgress, name): getattr(GenerationProgress, name) + amount
+        for name, amount in counts.items()
+        if amount
+    }
+    if last_error:
+        values[GenerationProgress.last_error] = last_error
+    if not values:
+        return
+    values[GenerationProgress.updated_at] = datetime.utcnow()
+    GenerationProgress.query.filter_by(deck_id=deck_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def progress_snapshot(deck_id):
+    status = db.session.query(Deck.status).filter_by(id=deck_id).scalar()
+    progress = db.session.query(GenerationProgress).populate_existing().filter_by(deck_id=deck_id).first()
+    if status is None or progress is None:
+        return None
+    remaining = max(0, progress.total_chunks - progress.done_chunks - progress.failed_chunks)
+    run_done = progress.done_chunks + progress.failed_chunks - progress.initial_done
+    eta_seconds = None
+    if status == "processing" and remaining and run_done > 0:
+        elapsed = (datetime.utcnow() - progress.started_at).total_seconds()
+        eta_seconds = round(elapsed / run_done * remaining)
+    return {
+        "deck_id": deck_id,
+        "status": status,
+        "total_chunks": progress.total_chunks,
+        "done_chunks": progress.done_chunks,
+        "failed_chunks": progress.failed_chunks,
+        "cards_created": progress.cards_created,
+        "cards_auto_deleted": progress.cards_auto_deleted,
+        "eta_seconds": eta_seconds,
+        "last_error": progress.last_error,
+        "updated_at": progress.updated_at.isoformat() if progress.updated_at else None,
+    }
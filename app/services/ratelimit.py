@@ -0,0 +1,264 @@
+import os
+import threading
+import time
+import uuid
+
+
+# Shared across processes through Redis when a Redis broker is configured; otherwise each
+# process keeps its own bucket. Both follow the same rules:
+#   - token bucket: `rate` requests/second with bursts up to `burst`
+#   - AIMD concurrency: the in-flight limit grows by 1/limit per success and is multiplied
+#     by `decrease_factor` on a 429, bounded to [min_concurrency, max_concurrency]
+#   - Retry-After: a 429 blocks every caller until the provider's retry time has passed
+
+KEY_PREFIX = "ankigpt:ratelimit"
+
+_ACQUIRE_SCRIPT = """
+local bucket, inflight, limit_key, blocked_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local default_limit = tonumber(ARGV[4])
+local stale_before = tonumber(ARGV[5])
+local member = ARGV[6]
+
+local blocked_until = tonumber(redis.call('GET', blocked_key) or '0')
+if blocked_until > now then
+  return tostring(blocked_until - now)
+end
+
+redis.call('ZREMRANGEBYSCORE', inflight, '-inf', stale_before)
+local limit = tonumber(redis.call('GET', limit_key) or default_limit)
+if redis.call('ZCARD', inflight) >= math.max(1, math.floor(limit)) then
+  return '0.05'
+end
+
+local state = redis.call('HMGET', bucket, 'tokens', 'ts')
+local tokens = tonumber(state[1] or burst)
+local ts = tonumber(state[2] or now)
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+if tokens < 1 then
+  redis.call('HSET', bucket, 'tokens', tokens, 'ts', now)
+  return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', bucket, 'tokens', tokens - 1, 'ts', now)
+redis.call('EXPIRE', bucket, 3600)
+redis.call('ZADD', inflight, now, member)
+redis.call('EXPIRE', inflight, 3600)
+return '0'
+"""
+
+_ADJUST_SCRIPT = """
+local limit_key, blocked_key = KEYS[1], KEYS[2]
+local default_limit = tonumber(ARGV[1])
+local min_limit = tonumber(ARGV[2])
+local max_limit = tonumber(ARGV[3])
+local throttled = ARGV[4] == '1'
+local factor = tonumber(ARGV[5])
+local blocked_until = tonumber(ARGV[6])
+local limit = tonumber(redis.call('GET', limit_key) or default_limit)
+if throttled then
+  limit = math.max(min_limit, limit * factor)
+  local current = tonumber(redis.call('GET', blocked_key) or '0')
+  if blocked_until > current then
+    redis.call('SET', blocked_key, blocked_until, 'EX', 3600)
+  end
+else
+  limit = math.min(max_limit, limit + 1 / limit)
+end
+redis.call('SET', limit_key, limit, 'EX', 86400)
+return tostring(limit)
+"""
+
+
+class RateLimitTimeout(RuntimeError):
+    pass
+
+
+class LocalRateLimiter:
+    def __init__(
+        self,
+        rate=10.0,
+        burst=20,
+        initial_concurrency=8,
+        min_concurrency=1,
+        max_concurrency=64,
+        decrease_factor=0.5,
+    ):
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.min_concurrency = max(1.0, float(min_concurrency))
+        self.max_concurrency = max(self.min_concurrency, float(max_concurrency))
+        self.decrease_factor = float(decrease_factor)
+        self.limit = min(self.max_concurrency, max(self.min_concurrency, float(initial_concurrency)))
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._inflight = 0
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def _try_acquire(self, now):
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        if self._inflight >= max(1, int(self.limit)):
+            return None
+        self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+        self._ts = now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        self._tokens -= 1
+        self._inflight += 1
+        return 0
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._try_acquire(now)
+                if wait == 0:
+                    return object()
+                if deadline is not None and now >= deadline:
+                    raise RateLimitTimeout("Timed out waiting for an OpenRouter rate-limit slot.")
+                if deadline is not None:
+                    wait = min(wait or 1.0, deadline - now)
+                self._cond.wait(wait)
+
+    def release(self, slot):
+        with self._cond:
+            self._inflight = max(0, self._inflight - 1)
+            self._cond.notify_all()
+
+    def record_success(self):
+        with self._cond:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def record_throttle(self, retry_after=None):
+        with self._cond:
+            self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+
+class RedisRateLimiter:
+    def __init__(
+        self,
+        redis_url,
+        rate=10.0,
+        burst=20,
+        initial_concurrency=8,
+        min_concurrency=1,
+        max_concurrency=64,
+        decrease_factor=0.5,
+        slot_ttl_seconds=600,
+    ):
+        self.redis_url = redis_url
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.initial_concurrency = float(initial_concurrency)
+        self.min_concurrency = max(1.0, float(min_concurrency))
+        self.max_concurrency = max(self.min_concurrency, float(max_concurrency))
+        self.decrease_factor = float(decrease_factor)
+        self.slot_ttl_seconds = float(slot_ttl_seconds)
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._lock:
+                if self._client is None or self._client_pid != pid:
+                    import redis
+
+                    client = redis.Redis.from_url(self.redis_url)
+                    self._acquire_script = client.register_script(_ACQUIRE_SCRIPT)
+                    self._adjust_script = client.register_script(_ADJUST_SCRIPT)
+                    self._client = client
+                    self._client_pid = pid
+        return self._client
+
+    def _keys(self, *names):
+        return [f"{KEY_PREFIX}:{name}" for name in names]
+
+    def acquire(self, timeout=None):
+        from redis.exceptions import RedisError
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        member = uuid.uuid4().hex
+        while True:
+            now = time.time()
+            try:
+                self._redis()
+                wait = float(
+                    self._acquire_script(
+                        keys=self._keys("bucket", "inflight", "limit", "blocked_until"),
+                        args=[now, self.rate, self.burst, self.initial_concurrency, now - self.slot_ttl_seconds, member],
+                    )
+                )
+            except RedisError:
+                # Limiter state is unavailable; let the request through rather than failing generation.
+                return None
+            if wait <= 0:
+                return member
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RateLimitTimeout("Timed out waiting for an OpenRouter rate-limit slot.")
+                wait = min(wait, remaining)
+            time.sleep(min(wait, 1.0))
+
+    def release(self, slot):
+        from redis.exceptions import RedisError
+
+        if slot is None:
+            return
+        try:
+            self._redis().zrem(self._keys("inflight")[0], slot)
+        except RedisError:
+            pass
+
+    def _adjust(self, throttled, retry_after=None):
+        from redis.exceptions import RedisError
+
+        blocked_until = time.time() + retry_after if retry_after else 0
+        try:
+            self._redis()
+            self._adjust_script(
+                keys=self._keys("limit", "blocked_until"),
+                args=[
+                    self.initial_concurrency,
+                    self.min_concurrency,
+                    self.max_concurrency,
+                    "1" if throttled else "0",
+                    self.decrease_factor,
+                    blocked_until,
+                ],
+            )
+        except RedisError:
+            pass
+
+    def record_success(self):
+        self._adjust(False)
+
+    def record_throttle(self, retry_after=None):
+        self._adjust(True, retry_after)
+
+
+_limiter = None
+
+
+def configure_rate_limiter(enabled=True, redis_url="", **kwargs):
+    global _limiter
+    if not enabled:
+        _limiter = None
+    elif redis_url and redis_url.startswith(("redis://", "rediss://", "unix://")):
+        _limiter = RedisRateLimiter(redis_url, **kwargs)
+    else:
+        _limiter = LocalRateLimiter(**kwargs)
+    return _limiter
+
+
+def get_rate_limiter():
+    return _limiter
@@ -0,0 +1,28 @@
+from flask import current_app
+from .chunking import estimate_tokens
+from .validators import count_math
+
+
+def route_model(task, text=""):
+    # Fast model for JSON repair, single-card improve and short chunks; strong model for long or
+    # math-heavy chunks; OPENROUTER_MODEL otherwise. Unset tiers fall back to OPENROUTER_MODEL.
+    config = current_app.config
+    default = config["OPENROUTER_MODEL"]
+    fast = config.get("OPENROUTER_FAST_MODEL") or default
+    strong = config.get("OPENROUTER_STRONG_MODEL") or default
+    if task in ("repair", "improve"):
+        return fast
+    tokens = estimate_tokens(text)
+    if tokens >= int(config.get("ROUTING_LONG_CHUNK_TOKENS", 1500)):
+        return strong
+    if count_math(text) >= int(config.get("ROUTING_MATH_MIN_EXPRESSIONS", 3)):
+        return strong
+    if tokens <= int(config.get("ROUTING_SHORT_CHUNK_TOKENS", 300)):
+        return fast
+    return default
+
+
+def fallback_models(model):
+    # Models tried in order when `model` keeps failing with 429/5xx.
+    configured = current_app.config.get("OPENROUTER_FALLBACK_MODELS") or ""
+    return [name.strip() for name in configured.split(",") if name.strip() and name.strip() != model]
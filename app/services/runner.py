@@ -0,0 +1,172 @@
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from ..extensions import db
+from ..models import BackgroundTask
+
+
+# Runs Celery tasks on a local thread pool when no broker is configured. Tasks are stored in the
+# BackgroundTask table (queued -> running -> done/failed) and claimed with a conditional UPDATE, so
+# several processes sharing the database never run the same task twice. Running tasks carry a
+# heartbeat from their process; tasks whose heartbeat goes stale (the process died) are requeued,
+# up to max_attempts, by whichever runner polls next, including the restarted process.
+
+_runner = None
+
+
+class LocalRunner:
+    def __init__(self, app, workers=2, poll_seconds=1.0, stale_seconds=60.0, max_attempts=3):
+        self.app = app
+        self.workers = max(1, int(workers))
+        self.poll_seconds = max(0.1, float(poll_seconds))
+        self.stale_seconds = max(self.poll_seconds * 3, float(stale_seconds))
+        self.max_attempts = max(1, int(max_attempts))
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="runner")
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = set()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="runner-dispatch", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread and wait:
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def enqueue(self, name, args=(), countdown=None):
+        run_after = datetime.utcnow()
+        if countdown:
+            run_after += timedelta(seconds=float(countdown))
+        task = BackgroundTask(name=name, args=list(args), run_after=run_after)
+        db.session.add(task)
+        db.session.commit()
+        self._wake.set()
+        return task.id
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self._heartbeat()
+                    self._recover()
+                    self._claim()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception("Background runner poll failed")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _heartbeat(self):
+        with self._lock:
+            running = list(self._running)
+        if not running:
+            return
+        BackgroundTask.query.filter(BackgroundTask.id.in_(running)).update(
+            {BackgroundTask.heartbeat_at: datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+
+    def _recover(self):
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        orphaned = BackgroundTask.query.filter(
+            BackgroundTask.status == "running", BackgroundTask.heartbeat_at < stale
+        ).all()
+        for task in orphaned:
+            values = {BackgroundTask.owner: None, BackgroundTask.heartbeat_at: None}
+            if task.attempts >= self.max_attempts:
+                values.update(
+                    {
+                        BackgroundTask.status: "failed",
+                        BackgroundTask.error: "Worker stopped while running this task.",
+                        BackgroundTask.finished_at: datetime.utcnow(),
+                    }
+                )
+            else:
+                values.update({BackgroundTask.status: "queued", BackgroundTask.run_after: datetime.utcnow()})
+            # Conditional on the stale heartbeat so a task that just checked in is left alone.
+            BackgroundTask.query.filter(
+                BackgroundTask.id == task.id, BackgroundTask.status == "running", BackgroundTask.heartbeat_at < stale
+            ).update(values, synchronize_session=False)
+            self.app.logger.warning("Recovered background task %s (%s) from a stopped worker", task.id, task.name)
+        if orphaned:
+            db.session.commit()
+
+    def _claim(self):
+        with self._lock:
+            free = self.workers - len(self._running)
+        if free <= 0:
+            return
+        now = datetime.utcnow()
+        candidates = (
+            BackgroundTask.query.filter(BackgroundTask.status == "queued", BackgroundTask.run_after <= now)
+            .order_by(BackgroundTask.run_after, BackgroundTask.id)
+            .limit(free)
+            .all()
+        )
+        for task in candidates:
+            claimed = BackgroundTask.query.filter_by(id=task.id, status="queued").update(
+                {
+                    BackgroundTask.status: "running",
+                    BackgroundTask.owner: self.owner,
+                    BackgroundTask.attempts: BackgroundTask.attempts + 1,
+                    BackgroundTask.started_at: now,
+                    BackgroundTask.heartbeat_at: now,
+                },
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if not claimed:
+                continue
+            with self._lock:
+                self._running.add(task.id)
+            self._executor.submit(self._run, task.id, task.name, list(task.args or []))
+
+    def _run(self, task_id, name, args):
+        from ..tasks import celery
+
+        error = None
+        try:
+            with self.app.app_context():
+                celery.tasks[name].apply(args=args)
+        except Exception as exc:
+            self.app.logger.exception("Background task %s (%s) failed", task_id, name)
+            error = str(exc) or exc.__class__.__name__
+        finally:
+            with self._lock:
+                self._running.discard(task_id)
+        with self.app.app_context():
+            BackgroundTask.query.filter_by(id=task_id, owner=self.owner).update(
+                {
+                    BackgroundTask.status: "failed" if error else "done",
+                    BackgroundTask.error: error,
+                    BackgroundTask.finished_at: datetime.utcnow(),
+                },
+                synchronize_session=False,
+            )
+            db.session.commit()
+            db.session.remove()
+        self._wake.set()
+
+
+def configure_runner(app, enabled=False, **kwargs):
+    global _runner
+    if _runner is not None:
+        _runner.stop(wait=False)
+        _runner = None
+    if enabled:
+        _runner = LocalRunner(app, **kwargs)
+        _runner.start()
+    return _runner
+
+
+def get_runner():
+    return _runner
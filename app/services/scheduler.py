@@ -0,0 +1,138 @@
+import itertools
+import threading
+from contextlib import contextmanager
+
+
+# Arbitrates chunk-level LLM calls between users sharing this process:
+#   - interactive work (improve/regenerate) is granted before any deck generation
+#   - otherwise users are served by stride scheduling: each grant advances the user's pass by
+#     1/weight and the waiting user with the lowest pass goes next, so small decks (higher
+#     weight) interleave ahead of a large deck instead of queueing behind all of it
+#   - each user may hold at most `per_user_concurrency` slots out of `max_concurrency`
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_SMALL = "small"
+PRIORITY_BULK = "bulk"
+
+_RANKS = {PRIORITY_INTERACTIVE: 0, PRIORITY_SMALL: 1, PRIORITY_BULK: 1}
+_WEIGHTS = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_SMALL: 4.0, PRIORITY_BULK: 1.0}
+
+
+class FairScheduler:
+    def __init__(self, max_concurrency=16, per_user_concurrency=8):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.per_user_concurrency = max(1, int(per_user_concurrency))
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = {}
+        self._passes = {}
+        self._active = 0
+
+    def _virtual_time(self):
+        busy = {ticket["tenant"] for ticket in self._waiting} | set(self._running)
+        return min((self._passes[tenant] for tenant in busy if tenant in self._passes), default=0.0)
+
+    def _pick(self):
+        eligible = [
+            ticket
+            for ticket in self._waiting
+            if self._running.get(ticket["tenant"], 0) < self.per_user_concurrency
+        ]
+        if not eligible:
+            return None
+        return min(eligible, key=lambda t: (_RANKS.get(t["priority"], 1), self._passes[t["tenant"]], t["seq"]))
+
+    def _dispatch(self):
+        granted = False
+        while self._active < self.max_concurrency:
+            ticket = self._pick()
+            if ticket is None:
+                break
+            tenant = ticket["tenant"]
+            self._waiting.remove(ticket)
+            self._active += 1
+            self._running[tenant] = self._running.get(tenant, 0) + 1
+            self._passes[tenant] += 1.0 / _WEIGHTS.get(ticket["priority"], 1.0)
+            ticket["granted"] = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def acquire(self, tenant, priority=PRIORITY_BULK):
+        with self._cond:
+            if tenant not in self._passes:
+                # New or idle users join at the current virtual time rather than with banked credit.
+                self._passes[tenant] = self._virtual_time()
+            ticket = {"tenant": tenant, "priority": priority, "seq": next(self._seq), "granted": False}
+            self._waiting.append(ticket)
+            self._dispatch()
+            while not ticket["granted"]:
+                self._cond.wait()
+            return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            tenant = ticket["tenant"]
+            self._active -= 1
+            self._running[tenant] -= 1
+            if not self._running[tenant]:
+                del self._running[tenant]
+                if not any(t["tenant"] == tenant for t in self._waiting):
+                    self._passes.pop(tenant, None)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, tenant, priority=PRIORITY_BULK):
+        ticket = self.acquire(tenant, priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def queue_depth(self, tenant=None):
+        with self._cond:
+            tenants = {ticket["tenant"] for ticket in self._waiting} | set(self._running)
+            depth = {
+                key: {
+                    "waiting": sum(1 for ticket in self._waiting if ticket["tenant"] == key),
+                    "running": self._running.get(key, 0),
+                }
+                for key in tenants
+            }
+        if tenant is not None:
+            return depth.get(tenant, {"waiting": 0, "running": 0})
+        return depth
+
+
+_scheduler = None
+
+
+def configure_scheduler(enabled=True, **kwargs):
+    global _scheduler
+    _scheduler = FairScheduler(**kwargs) if enabled else None
+    return _scheduler
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def run_scheduled(tenant, priority, fn, *args, **kwargs):
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return fn(*args, **kwargs)
+    with scheduler.slot(tenant, priority):
+        return fn(*args, **kwargs)
+
+
+def priority_rank(priority):
+    return _RANKS.get(priority, 1)
+
+
+def priority_weight(priority):
+    return _WEIGHTS.get(priority, 1.0)
+
+
+def deck_priority(source_count, small_deck_chunks):
+    return PRIORITY_SMALL if source_count <= small_deck_chunks else PRIORITY_BULK
@@ -35,6 +35,18 @@ def is_math_valid(text):
     return True
 
 
+def count_math(text):
+    if not text:
+        return 0
+    return (
+        len(BLOCK_MATH_PATTERN.findall(text))
+        + len(INLINE_MATH_PATTERN.findall(text))
+        + len(EQUATION_ENV_PATTERN.findall(text))
+        + text.count("\\(")
+        + text.count("\\[")
+    )
+
+
 def is_in_scope(card_text, chunk_text):
     if not card_text:
         return True
@@ -1,3 +1,5 @@
+import threading
+import time
 from celery import Celery
 
 celery = Celery(__name__)
@@ -22,11 +24,280 @@ def init_celery(app):
     return celery
 
 
-@celery.task
-def generate_deck_task(deck_id):
+def queue_task(task, args=(), countdown=None, **options):
+    # Without a broker, tasks go to the local background runner instead of running inline.
+    # Extra options (e.g. time limits) only apply to Celery.
+    from .services.runner import get_runner
+
+    runner = get_runner()
+    if runner is not None:
+        return runner.enqueue(task.name, args, countdown)
+    try:
+        return task.apply_async(args=args, countdown=countdown, **options)
+    except Exception:
+        return task.apply(args=args)
+
+
+def can_defer():
+    # Eager Celery without the local runner runs "queued" tasks inline, so nothing can be deferred.
+    from .services.runner import get_runner
+
+    return get_runner() is not None or not celery.conf.task_always_eager
+
+
+def requeue_deck_task(task, deck_id):
+    # Another run holds the deck: try again later instead of blocking this worker for the whole run.
+    # A duplicate whose run has finished meanwhile (deck no longer processing) is dropped then.
+    from flask import current_app
+
+    if not can_defer():
+        current_app.logger.info("Dropped duplicate run of deck %s; another run holds it", deck_id)
+        return None
+    queue_task(task, (deck_id, True), countdown=float(current_app.config.get("SINGLE_FLIGHT_RETRY_SECONDS", 5)))
+    return None
+
+
+def schedule_chunk_retries(deck_id):
+    # Failed chunks are retried by a delayed resume rather than failing the whole deck.
+    from flask import current_app
+    from .extensions import db
+    from .models import Deck
+
+    deck = Deck.query.get(deck_id)
+    if not deck or deck.status not in ("partial", "failed"):
+        return False
+    settings = dict(deck.settings_json or {})
+    retry_round = int(settings.get("retry_round") or 0)
+    if retry_round >= int(current_app.config.get("GENERATION_RETRY_ROUNDS", 2)):
+        return False
+    settings["retry_round"] = retry_round + 1
+    deck.settings_json = settings
+    db.session.commit()
+    delay = float(current_app.config.get("GENERATION_RETRY_DELAY_SECONDS", 30)) * (2**retry_round)
+    queue_task(resume_deck_task, (deck_id,), countdown=delay)
+    return True
+
+
+def chunk_stale_seconds(config):
+    # A dispatched chunk that has not reported back after this long was lost with its worker.
+    if config.get("CHUNK_TASK_TIME_LIMIT"):
+        return float(config["CHUNK_TASK_TIME_LIMIT"]) + 60
+    return float(config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", 900))
+
+
+def dispatch_generation(deck_id, resume=False):
+    # Fans a deck out as one Celery task per pending Source. The chunks are recorded in the shared
+    # dispatch queue and sent by pump_chunks as the fairness caps allow; whichever chunk task
+    # finishes last finalises the deck. The deck's single-flight lock is held from the fan-out until
+    # then, so a duplicate dispatch cannot re-sync Sources under running chunk tasks.
+    from flask import current_app
+    from .models import Deck
+    from .services.chunk_queue import enqueue_chunks
+    from .services.deckgen import abort_generation, begin_generation, generation_key, generation_priority
+    from .services.locks import FlightInProgress, acquire_lock, flight_name, release_lock, wait_for_flights
+
+    deck = Deck.query.get(deck_id)
+    if not deck:
+        return None
+    config = current_app.config
+    lock_name = flight_name("resume" if resume else "generate", deck_id, generation_key(deck))
+    lock_token = acquire_lock(lock_name, float(config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", 900)))
+    if not lock_token:
+        raise FlightInProgress(f"Generation of deck {deck_id} is already in progress.")
+    try:
+        wait_for_flights(("generate", "resume"), deck_id, exclude=lock_name, wait=False)
+    except FlightInProgress:
+        release_lock(lock_name, lock_token)
+        raise
+    try:
+        sources = begin_generation(deck, resume)
+        if sources is None:
+            release_lock(lock_name, lock_token)
+            return None
+        if not sources:
+            return finalize_deck_task.delay([], deck_id, lock_name, lock_token)
+        enqueue_chunks(deck, sources, generation_priority(deck, len(sources)), lock_name, lock_token)
+    except Exception as exc:
+        current_app.logger.exception("Generation of deck %s failed", deck_id)
+        abort_generation(deck_id, str(exc) or exc.__class__.__name__)
+        release_lock(lock_name, lock_token)
+        raise
+    if can_defer():
+        queue_task(watch_chunks_task, (lock_token,), countdown=chunk_stale_seconds(config))
+    pump_chunks()
+    return deck_id
+
+
+_pumping = threading.local()
+
+
+def pump_chunks():
+    # Sends every chunk the dispatch queue admits. Eager chunk tasks run inside queue_task and pump
+    # again when they finish, so nested calls return at once and the outer loop picks up the slots.
+    from flask import current_app
+    from .services.chunk_queue import admit_chunks, reclaim_stale_chunks
+
+    if getattr(_pumping, "active", False):
+        _pumping.again = True
+        return
+    config = current_app.config
+    limits = {}
+    if config.get("CHUNK_TASK_SOFT_TIME_LIMIT"):
+        limits["soft_time_limit"] = float(config["CHUNK_TASK_SOFT_TIME_LIMIT"])
+    if config.get("CHUNK_TASK_TIME_LIMIT"):
+        limits["time_limit"] = float(config["CHUNK_TASK_TIME_LIMIT"])
+    _pumping.active = True
+    try:
+        for run_token in reclaim_stale_chunks(chunk_stale_seconds(config)):
+            finalize_chunk_run(run_token)
+        while True:
+            _pumping.again = False
+            admitted = admit_chunks()
+            if admitted is None:
+                # Another process is admitting; it sees the same free slots.
+                return
+            jobs = [(row.deck_id, row.source_id, row.lock_name, row.run_token) for row in admitted]
+            for args in jobs:
+                queue_task(generate_chunk_task, args, **limits)
+            if not admitted and not _pumping.again:
+                return
+    finally:
+        _pumping.active = False
+
+
+def finalize_chunk_run(run_token):
+    # Finishes the deck once every chunk of the run is done; only one caller gets the claim.
+    from .services.chunk_queue import claim_finished_run
+    from .services.deckgen import finish_generation
+
+    claimed = claim_finished_run(run_token)
+    if claimed is None:
+        return None
+    deck_id, chunk_errors, auto_deleted_cards = claimed
+    result = finish_generation(deck_id, chunk_errors, auto_deleted_cards)
+    schedule_chunk_retries(deck_id)
+    return result
+
+
+def run_deck_task(task, deck_id, resume=False, requeued=False):
+    from flask import current_app
+    from .models import Deck
     from .services.deckgen import generate_deck
+    from .services.locks import FlightInProgress
+
+    deck = Deck.query.get(deck_id)
+    if not deck or (requeued and deck.status != "processing"):
+        # The run this task deferred to has finished the deck (or it was cancelled) meanwhile.
+        return None
+    try:
+        if current_app.config.get("GENERATION_SUBTASKS"):
+            dispatch_generation(deck_id, resume=resume)
+            return deck_id
+        result = generate_deck(deck_id, resume=resume, wait=not can_defer())
+    except FlightInProgress:
+        return requeue_deck_task(task, deck_id)
+    schedule_chunk_retries(deck_id)
+    return result
+
+
+@celery.task
+def generate_deck_task(deck_id, requeued=False):
+    return run_deck_task(generate_deck_task, deck_id, requeued=requeued)
+
+
+@celery.task
+def resume_deck_task(deck_id, requeued=False):
+    return run_deck_task(resume_deck_task, deck_id, resume=True, requeued=requeued)
+
+
+@celery.task
+def speculate_deck_task(deck_id):
+    # No retry scheduling: failed chunks are picked up when the user submits the deck.
+    from .services.deckgen import speculate_deck
+
+    return speculate_deck(deck_id)
+
+
+@celery.task(bind=True)
+def generate_chunk_task(self, deck_id, source_id, lock_name=None, run_token=None):
+    from celery.exceptions import Retry
+    from flask import current_app
+    from .extensions import db
+    from .services.chunk_queue import complete_chunk
+    from .services.deckgen import generate_source
+    from .services.locks import renew_lock
+
+    max_retries = int(current_app.config.get("CHUNK_TASK_MAX_RETRIES", 2))
+    retries = self.request.retries
+    # Every chunk task extends the fan-out's lock, so it outlives SINGLE_FLIGHT_TIMEOUT_SECONDS
+    # for as long as chunks keep running.
+    renew_lock(lock_name, run_token, float(current_app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS", 900)))
+    while True:
+        try:
+            result = generate_source(deck_id, source_id, final_attempt=retries >= max_retries)
+            break
+        except Retry:
+            raise
+        except Exception as exc:
+            if retries >= max_retries:
+                db.session.rollback()
+                current_app.logger.exception("Chunk task for source %s of deck %s failed", source_id, deck_id)
+                result = {"errors": ["The chunk task stopped unexpectedly."]}
+                break
+            delay = float(current_app.config.get("CHUNK_TASK_RETRY_DELAY_SECONDS", 10)) * (2**retries)
+            if not self.request.is_eager:
+                raise self.retry(exc=exc, countdown=delay, max_retries=max_retries)
+            # Eager runs propagate Retry instead of re-applying the task, so retry in place.
+            retries += 1
+            time.sleep(delay)
+    result = result or {}
+    complete_chunk(run_token, source_id, result.get("errors"), result.get("auto_deleted"))
+    finalize_chunk_run(run_token)
+    pump_chunks()
+    return result
+
+
+@celery.task
+def watch_chunks_task(run_token):
+    # Watchdog for one distributed run: reclaims chunks whose task was lost (hard time limit, dead
+    # worker), so the run still finalises, and keeps the queue moving if no chunk task pumps it.
+    from flask import current_app
+    from .services.chunk_queue import run_pending
+
+    pump_chunks()
+    if run_pending(run_token):
+        queue_task(watch_chunks_task, (run_token,), countdown=chunk_stale_seconds(current_app.config))
+    return None
+
+
+@celery.task
+def finalize_deck_task(results, deck_id, lock_name=None, lock_token=None):
+    from .services.deckgen import finish_generation
+    from .services.locks import release_lock
+
+    results = [result for result in results or [] if result]
+    chunk_errors = [error for result in results for error in result.get("errors", [])]
+    auto_deleted_cards = sum(int(result.get("auto_deleted") or 0) for result in results)
+    try:
+        result = finish_generation(deck_id, chunk_errors, auto_deleted_cards)
+    finally:
+        release_lock(lock_name, lock_token)
+    schedule_chunk_retries(deck_id)
+    return result
+
+
+@celery.task
+def improve_cards_task(job_id, card_ids):
+    from .services.deckgen import improve_cards
+
+    return improve_cards(job_id, card_ids)
+
+
+@celery.task
+def regenerate_sources_task(job_id, source_ids):
+    from .services.deckgen import regenerate_sources
 
-    return generate_deck(deck_id)
+    return regenerate_sources(job_id, source_ids)
 
 
 @celery.task
@@ -0,0 +1,216 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import create_app
+from app.config import Config
+from app.extensions import db
+from app.models import Deck, User
+from app.services import llm
+
+
+def section_cards(text, count=2):
+    # Deterministic basic cards built from the words of a prompt's "Content:" block; numbered words
+    # (markers such as "Marker3") keep cards of otherwise identical sections apart.
+    match = re.search(r"Content:\n(.*?)\n\nCard style", text, re.S)
+    content = match.group(1) if match else text
+    words = re.findall(r"[A-Za-z]{4,}", content)[:4] + re.findall(r"[A-Za-z]+\d+", content) or ["alpha"]
+    return [
+        {"type": "basic", "front": f"What about {' '.join(words)} {index}?", "back": " ".join(words), "tags": []}
+        for index in range(count)
+    ]
+
+
+def completion(content, finish_reason="stop"):
+    return {
+        "choices": [{"message": {"content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+    }
+
+
+class StubOpenRouter:
+    # Local stand-in for the OpenRouter chat completions API. `respond(body)` returns
+    # (status, payload); streamed requests get the payload's content back as SSE deltas.
+
+    def __init__(self):
+        self.requests = []
+        self.respond = self.default_response
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with stub.lock:
+                    stub.requests.append(body)
+                status, payload = stub.respond(body)
+                try:
+                    if body.get("stream") and status == 200:
+                        self.send_stream(payload)
+                    else:
+                        self.send_json(status, payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_json(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, payload):
+                choice = payload["choices"][0]
+                content = choice["message"]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [
+                    {"choices": [{"delta": {"content": content[i : i + 7]}, "finish_reason": None}]}
+                    for i in range(0, len(content), 7)
+                ]
+                events.append(
+                    {
+                        "choices": [{"delta": {}, "finish_reason": choice.get("finish_reason", "stop")}],
+                        "usage": payload.get("usage"),
+                    }
+                )
+                for event in [f"data: {json.dumps(event)}\n\n" for event in events] + ["data: [DONE]\n\n"]:
+                    data = event.encode()
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/v1/chat/completions"
+
+    def default_response(self, body):
+        return 200, completion(json.dumps({"cards": section_cards(body["messages"][-1]["content"])}))
+
+    def prompts(self):
+        return [body["messages"][-1]["content"] for body in self.requests]
+
+    def reset(self):
+        self.requests.clear()
+        self.respond = self.default_response
+
+
+@pytest.fixture(scope="session")
+def stub_server():
+    stub = StubOpenRouter()
+    threading.Thread(target=stub.server.serve_forever, daemon=True).start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+@pytest.fixture
+def openrouter(stub_server):
+    stub_server.reset()
+    return stub_server
+
+
+TEST_CONFIG = {
+    "OPENROUTER_API_KEY": "test-key",
+    "OPENROUTER_RETRY_BACKOFF_SECONDS": 0,
+    "OPENROUTER_RATE_LIMIT_ENABLED": False,
+    "AUTH_REQUIRED": False,
+    "BACKGROUND_RUNNER_ENABLED": False,
+    "CELERY_TASK_ALWAYS_EAGER": True,
+    "LLM_CACHE_ENABLED": False,
+    "GENERATION_PACK_SMALL_TOKENS": 0,
+    "GENERATION_RETRY_ROUNDS": 0,
+}
+
+
+@pytest.fixture(scope="session")
+def base_app(tmp_path_factory, stub_server):
+    # One app per session: Celery tasks bind to the app that configured them first.
+    tmp_path = tmp_path_factory.mktemp("app")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(llm, "OPENROUTER_URL", stub_server.url)
+        patch.setattr(Config, "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path}/test.db")
+        patch.setattr(Config, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+        patch.setattr(Config, "EXPORT_FOLDER", str(tmp_path / "exports"))
+        for key, value in TEST_CONFIG.items():
+            patch.setattr(Config, key, value)
+        yield create_app()
+
+
+@pytest.fixture
+def app(base_app):
+    # Fresh tables and config for every test; tests adjust app.config directly.
+    config = dict(base_app.config)
+    with base_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield base_app
+        db.session.remove()
+    base_app.config.clear()
+    base_app.config.update(config)
+
+
+@pytest.fixture
+def make_deck(app):
+    def make(text, max_chars=900, **kwargs):
+        user = User.query.filter_by(email="test@example.com").first()
+        if user is None:
+            user = User(email="test@example.com")
+            user.set_password("password")
+            db.session.add(user)
+            db.session.commit()
+        deck = Deck(
+            user_id=user.id,
+            title="Test deck",
+            card_style="basic",
+            source_type="text",
+            source_text=text,
+            settings_json={"max_chars": max_chars},
+            **kwargs,
+        )
+        db.session.add(deck)
+        db.session.commit()
+        return deck
+
+    return make
+
+
+def make_pdf(pages):
+    # Minimal PDF with one line of Helvetica text per page, enough for pypdf's text extraction.
+    count = len(pages)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + index * 2} 0 R" for index in range(count))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {count} >>".encode())
+    font = 3 + count * 2
+    for index, text in enumerate(pages):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + index * 2} 0 R "
+            f"/Resources << /Font << /F1 {font} 0 R >> >> >>".encode()
+        )
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return data
+
+
+def sections_text(count, words="Photosynthesis converts sunlight energy into chemical energy stored in glucose."):
+    return "\n\n".join(f"## Section {index}\n\n{(words + ' ') * 8}Marker{index}" for index in range(count))
@@ -0,0 +1,52 @@
+import logging
+from datetime import datetime, timedelta
+
+from app.extensions import db
+from app.models import LLMCache
+from app.services import deckgen
+from app.services.cache import cache_stats, get_cached, store_cached
+from app.services.deckgen import generate_deck
+from conftest import sections_text
+
+
+def test_identical_chunks_are_served_from_the_cache(app, make_deck, openrouter):
+    app.config.update(LLM_CACHE_ENABLED=True)
+    generate_deck(make_deck(sections_text(3)).id)
+    assert len(openrouter.requests) == 3
+    before = cache_stats()
+    deck = make_deck(sections_text(3))
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 3
+    assert cache_stats()["hits"] - before["hits"] == 3
+    assert [entry.hits for entry in LLMCache.query.order_by(LLMCache.id)] == [1, 1, 1]
+
+
+def test_least_recently_used_entries_are_evicted(app):
+    app.config.update(LLM_CACHE_ENABLED=True, LLM_CACHE_MAX_ENTRIES=2)
+    for key in ("a", "b"):
+        store_cached(key, "test/model", "v3", "{}", {"cards": []})
+    LLMCache.query.filter_by(key="a").update({LLMCache.last_used_at: datetime.utcnow() + timedelta(minutes=1)})
+    db.session.commit()
+    store_cached("c", "test/model", "v3", "{}", {"cards": []})
+    assert sorted(entry.key for entry in LLMCache.query) == ["a", "c"]
+
+
+def test_expired_entries_are_misses(app):
+    app.config.update(LLM_CACHE_ENABLED=True, LLM_CACHE_TTL_SECONDS=60)
+    store_cached("a", "test/model", "v3", "{}", {"cards": []})
+    LLMCache.query.update({LLMCache.created_at: datetime.utcnow() - timedelta(minutes=2)})
+    db.session.commit()
+    before = cache_stats()
+    assert get_cached("a") is None
+    assert cache_stats()["evictions"] - before["evictions"] == 1
+    assert LLMCache.query.count() == 0
+
+
+def test_cache_totals_are_logged_at_most_once_per_interval(app, make_deck, openrouter, monkeypatch, caplog):
+    monkeypatch.setattr(deckgen, "_stats_logged_at", None)
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        generate_deck(make_deck(sections_text(1)).id)
+        generate_deck(make_deck(sections_text(1)).id)
+    logged = [record for record in caplog.records if "LLM cache totals" in record.getMessage()]
+    assert len(logged) == 1
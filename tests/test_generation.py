@@ -0,0 +1,292 @@
+import json
+import re
+import threading
+import time
+
+from app.extensions import db
+from app.models import Card, Deck, LLMCache, LLMRun, Source
+from app.services import deckgen
+from app.services.cache import cache_key
+from app.services.deckgen import PROMPT_VERSION, generate_deck
+from conftest import completion, section_cards, sections_text
+
+
+def packed_response(body, bisect_over=None):
+    # Answers packed prompts with one card per section naming the section's "numberN" marker, and
+    # rejects single-source prompts longer than `bisect_over` characters as too long for the model.
+    prompt = body["messages"][-1]["content"]
+    if "[Section " in prompt:
+        sections = {}
+        for sid, content in re.findall(
+            r"\[Section (S\d+)\]\nTitle: .*?\nContent:\n(.*?)(?=\n\n\[Section |\n\nCard style)", prompt, re.S
+        ):
+            sections[sid] = [
+                {"type": "basic", "front": f"What does {marker} describe?", "back": f"Energy {marker}"}
+                for marker in re.findall(r"number\d+", content)
+            ]
+        return 200, completion(json.dumps({"sections": sections}))
+    content = re.search(r"Content:\n(.*?)\n\nCard style", prompt, re.S).group(1)
+    if bisect_over and len(content) > bisect_over:
+        return 400, {"error": {"message": "This model's maximum context length is 8192 tokens."}}
+    return 200, completion(json.dumps({"cards": section_cards(prompt)}))
+
+
+def small_sections(count):
+    return "\n\n".join(
+        f"## Small{index}\n\nMitochondria produce cellular energy number{index} through respiration."
+        for index in range(count)
+    )
+
+
+def test_generate_deck_streams_cards_and_checkpoints_every_chunk(make_deck, openrouter):
+    deck = make_deck(sections_text(4))
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert all(body.get("stream") for body in openrouter.requests)
+    assert Source.query.count() == 4
+    assert LLMRun.query.filter_by(error=None).count() == 4
+    assert {card.source_id for card in Card.query.filter_by(status="ok")} == {source.id for source in Source.query}
+
+
+def test_cancel_keeps_finished_chunks_and_resume_only_pays_for_the_rest(app, make_deck, openrouter, monkeypatch):
+    app.config.update(GENERATION_CONCURRENCY=4)
+    monkeypatch.setattr(deckgen, "CANCEL_POLL_SECONDS", 0.1)
+    deck = make_deck(sections_text(6))
+    release = threading.Event()
+
+    def respond(body):
+        prompt = body["messages"][-1]["content"]
+        if "Marker0" in prompt:
+            # The first chunk is still running when the user cancels, so the other five finish
+            # behind it in the ordered commit and must not be thrown away.
+            release.wait(10)
+        return 200, completion(json.dumps({"cards": section_cards(prompt)}))
+
+    def cancel():
+        deadline = time.monotonic() + 10
+        while len(openrouter.requests) < 6 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        with app.app_context():
+            Deck.query.filter_by(id=deck.id).update({"status": "cancelled"})
+            db.session.commit()
+
+    openrouter.respond = respond
+    canceller = threading.Thread(target=cancel)
+    canceller.start()
+    try:
+        generate_deck(deck.id)
+    finally:
+        release.set()
+        canceller.join()
+    db.session.expire_all()
+    assert Deck.query.get(deck.id).status == "cancelled"
+    assert LLMRun.query.filter_by(error=None).count() == 5
+
+    deck = Deck.query.get(deck.id)
+    deck.status = "processing"
+    db.session.commit()
+    calls = len(openrouter.requests)
+    generate_deck(deck.id, resume=True)
+    assert Deck.query.get(deck.id).status == "ready"
+    assert len(openrouter.requests) - calls == 1
+    assert "Marker0" in openrouter.prompts()[-1]
+    assert LLMRun.query.filter_by(error=None).count() == 6
+
+
+def test_bisected_source_keeps_packed_sections_on_their_own_sources(app, make_deck, openrouter):
+    app.config.update(GENERATION_PACK_SMALL_TOKENS=300, GENERATION_CONCURRENCY=4)
+    big = "## Big\n\n" + "Photosynthesis converts sunlight energy into glucose. " * 40
+    deck = make_deck(big + "\n\n" + small_sections(8), max_chars=200)
+    # Packed groups take a little longer, so they are still running when the big source is bisected
+    # and every later Source is renumbered.
+    openrouter.respond = lambda body: (
+        time.sleep(0.3) if "[Section " in body["messages"][-1]["content"] else None
+    ) or packed_response(body, bisect_over=1000)
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert any("[Section " in prompt for prompt in openrouter.prompts())
+    marked = [card for card in Card.query.all() if "number" in card.front]
+    assert len(marked) == 8
+    for card in marked:
+        assert re.search(r"number\d+", card.front).group(0) in card.source.text
+
+
+def test_packed_results_are_cached_under_the_model_that_produced_them(app, make_deck, openrouter):
+    app.config.update(
+        GENERATION_PACK_SMALL_TOKENS=300,
+        LLM_CACHE_ENABLED=True,
+        OPENROUTER_MODEL="main/model",
+        OPENROUTER_FAST_MODEL="fast/model",
+        ROUTING_SHORT_CHUNK_TOKENS=60,
+    )
+    deck = make_deck(small_sections(6), max_chars=120)
+    openrouter.respond = packed_response
+    generate_deck(deck.id)
+    assert [body["model"] for body in openrouter.requests] == ["main/model"]
+    keys = {
+        cache_key(source.hash, PROMPT_VERSION, model, deck.card_style, deck.settings_json): model
+        for source in Source.query.all()
+        for model in ("main/model", "fast/model")
+    }
+    entries = LLMCache.query.all()
+    assert len(entries) == 6
+    assert all(keys[entry.key] == entry.model == "main/model" for entry in entries)
+
+
+def test_chunk_that_cannot_be_stored_fails_alone(make_deck, monkeypatch):
+    persist = deckgen.persist_chunk_cards
+
+    def crash(deck_id, source, *args, **kwargs):
+        if source.idx == 1:
+            raise RuntimeError("disk full")
+        return persist(deck_id, source, *args, **kwargs)
+
+    monkeypatch.setattr(deckgen, "persist_chunk_cards", crash)
+    deck = make_deck(sections_text(3))
+    generate_deck(deck.id)
+    assert deck.status == "partial"
+    assert deck.settings_json["last_error"] == "Chunk 2: disk full"
+    assert LLMRun.query.filter_by(error=None).count() == 2
+    assert not Card.query.join(Source).filter(Source.idx == 1).count()
+
+
+def test_unexpected_error_still_finalises_the_deck(make_deck, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(deckgen, "pack_sources", broken)
+    deck = make_deck(sections_text(2))
+    generate_deck(deck.id)
+    assert deck.status == "failed"
+    assert "database is locked" in deck.settings_json["last_error"]
+
+
+def test_output_token_limit_errors_do_not_bisect(make_deck, openrouter):
+    openrouter.respond = lambda body: (400, {"error": {"message": "max_tokens: 9000 > 8192, too many output tokens"}})
+    deck = make_deck(sections_text(1))
+    generate_deck(deck.id)
+    assert deck.status == "failed"
+    assert len(openrouter.requests) == 1
+    assert Source.query.count() == 1
+    assert "split_sources" not in deck.settings_json
+
+
+def test_bisection_stops_at_the_depth_limit(app, make_deck, openrouter):
+    app.config.update(GENERATION_BISECT_MAX_DEPTH=2)
+    openrouter.respond = lambda body: (400, {"error": {"code": "context_length_exceeded"}})
+    deck = make_deck(sections_text(1, words="Photosynthesis converts sunlight. " * 4), max_chars=4000)
+    generate_deck(deck.id)
+    assert deck.status == "failed"
+    assert Source.query.count() == 4
+    assert len(openrouter.requests) == 1 + 2 + 4
+
+
+def test_bisection_keeps_settings_written_during_the_run(app, make_deck, openrouter):
+    deck = make_deck(sections_text(1), max_chars=4000)
+
+    def respond(body):
+        content = re.search(r"Content:\n(.*?)\n\nCard style", body["messages"][-1]["content"], re.S).group(1)
+        if len(openrouter.requests) == 1:
+            # A preview submit saves new settings while the first request is running.
+            with app.app_context():
+                stored = Deck.query.get(deck.id)
+                stored.settings_json = dict(stored.settings_json, focus="enzymes")
+                db.session.commit()
+        if len(content) > 600:
+            return 400, {"error": {"message": "This model's maximum context length is 8192 tokens."}}
+        return 200, completion(json.dumps({"cards": section_cards(body["messages"][-1]["content"])}))
+
+    openrouter.respond = respond
+    generate_deck(deck.id)
+    db.session.expire_all()
+    settings = Deck.query.get(deck.id).settings_json
+    assert settings["focus"] == "enzymes"
+    assert settings["split_sources"]
+
+
+def test_truncated_reply_is_continued_where_it_stopped(app, make_deck, openrouter):
+    app.config.update(GENERATION_MAX_OUTPUT_TOKENS=2000)
+    deck = make_deck(sections_text(1))
+    full = json.dumps({"cards": section_cards(deck.source_text, count=3)})
+    cut = full.index("}, {") + 10
+
+    def respond(body):
+        if body["messages"][-1]["content"] == deckgen.CONTINUE_PROMPT:
+            return 200, completion(full[cut:])
+        return 200, completion(full[:cut], finish_reason="length")
+
+    openrouter.respond = respond
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 2
+    follow_up = openrouter.requests[1]["messages"]
+    assert follow_up[-2] == {"role": "assistant", "content": full[:cut]}
+    assert all(body["max_tokens"] <= 2000 for body in openrouter.requests)
+    run = LLMRun.query.filter_by(error=None).one()
+    assert run.request_json["continuations"] == 1
+    assert run.request_json["finish_reason"] == "stop"
+    assert Card.query.filter_by(status="ok").count() == 3
+
+
+def test_continuations_are_capped_and_complete_cards_kept(app, make_deck, openrouter):
+    app.config.update(GENERATION_MAX_CONTINUATIONS=1)
+    deck = make_deck(sections_text(1))
+    full = json.dumps({"cards": section_cards(deck.source_text, count=3)})
+    parts = [full[: full.index("}, {") + 1], ", " + full[full.index("}, {") + 3 : full.rindex("}, {") + 10]]
+
+    def respond(body):
+        return 200, completion(parts[len(openrouter.requests) - 1], finish_reason="length")
+
+    openrouter.respond = respond
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 2
+    assert LLMRun.query.filter_by(error=None).one().request_json["continuations"] == 1
+    assert Card.query.filter_by(status="ok").count() == 2
+
+
+def test_regenerating_an_edited_deck_only_pays_for_changed_chunks(make_deck, openrouter):
+    deck = make_deck(sections_text(4))
+    generate_deck(deck.id)
+    kept_cards = {card.id for card in Card.query.join(Source).filter(Source.idx != 2)}
+    sections = deck.source_text.split("\n\n## ")
+    sections[2] = sections[2].replace("Marker2", "Marker2 and Edited7")
+    deck.source_text = "\n\n## ".join(sections)
+    db.session.commit()
+    openrouter.reset()
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 1
+    assert "Edited7" in openrouter.prompts()[0]
+    assert kept_cards <= {card.id for card in Card.query.filter_by(status="ok")}
+    assert Source.query.count() == 4
+    assert LLMRun.query.filter_by(error=None).count() == 4
+
+
+def test_reordered_chunks_keep_their_cards_without_llm_calls(make_deck, openrouter):
+    # Small enough that every section is a chunk of its own, without the next section's heading.
+    deck = make_deck(sections_text(3), max_chars=655)
+    generate_deck(deck.id)
+    cards = {card.id: card.source.hash for card in Card.query.all()}
+    sections = deck.source_text.split("\n\n")
+    deck.source_text = "\n\n".join(sections[4:6] + sections[:4])
+    db.session.commit()
+    openrouter.reset()
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert openrouter.requests == []
+    assert [source.title for source in Source.query.order_by(Source.idx)] == ["Section 2", "Section 0", "Section 1"]
+    assert {card.id: card.source.hash for card in Card.query.all()} == cards
+
+
+def test_changed_settings_regenerate_every_chunk(make_deck, openrouter):
+    deck = make_deck(sections_text(3))
+    generate_deck(deck.id)
+    deck.settings_json = dict(deck.settings_json, focus="enzymes")
+    db.session.commit()
+    openrouter.reset()
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 3
+    assert LLMRun.query.filter_by(error=None).count() == 3
@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from app.extensions import db
+from app.models import LLMRun
+from app.services import deckgen
+from app.services.llm import CardStreamParser, openrouter_chat, recover_json, recovery_stats
+from conftest import completion, sections_text
+
+
+CARDS = [
+    {"type": "basic", "front": "What is ATP?", "back": "The cell's energy currency.", "tags": ["bio"]},
+    {"type": "cloze", "cloze_text": "{{c1::Mitochondria}} make ATP.", "extra": "", "tags": []},
+]
+
+
+def test_stream_parser_emits_each_card_as_it_closes():
+    text = json.dumps({"cards": CARDS})
+    split = text.index("}, {") + 1
+    parser = CardStreamParser()
+    assert parser.feed(text[:10]) == []
+    assert parser.feed(text[10:split]) == [CARDS[0]]
+    assert parser.feed(text[split:]) == [CARDS[1]]
+    assert parser.text == text
+
+
+def test_stream_parser_ignores_braces_inside_strings():
+    card = {"type": "basic", "front": 'Set {a, b} and "quotes" \\ }', "back": "]}", "tags": []}
+    parser = CardStreamParser()
+    text = json.dumps({"cards": [card]})
+    assert [found for ch in text for found in parser.feed(ch)] == [card]
+
+
+def test_streamed_chat_reports_cards_before_the_reply_ends(app, openrouter):
+    openrouter.respond = lambda body: (200, completion(json.dumps({"cards": CARDS})))
+    seen = []
+    response = openrouter_chat(
+        [{"role": "user", "content": "cards"}], "test/model", "key", stream=True, on_card=seen.append
+    )
+    assert openrouter.requests[0]["stream"] is True
+    assert seen == CARDS
+    assert json.loads(response["choices"][0]["message"]["content"]) == {"cards": CARDS}
+    assert response["choices"][0]["finish_reason"] == "stop"
+
+
+def test_cancel_event_keeps_the_configured_transport(app, openrouter):
+    openrouter.respond = lambda body: (200, completion(json.dumps({"cards": CARDS})))
+    openrouter_chat([{"role": "user", "content": "cards"}], "test/model", "key", cancel_event=threading.Event())
+    assert not openrouter.requests[0].get("stream")
+
+
+def test_recover_json_keeps_complete_cards_of_truncated_output():
+    text = '```json\n{"cards": [' + json.dumps(CARDS[0]) + ', {"type": "basic", "tags": ["a", "b"], "front": "Half'
+    assert recover_json(text) == {"cards": [CARDS[0]]}
+
+
+def test_recover_json_fixes_python_literals_and_trailing_commas():
+    text = "Here you go: {'cards': [{'type': 'basic', 'front': 'Q', 'back': 'A', 'tags': [],},], 'done': True}"
+    assert recover_json(text) == {
+        "cards": [{"type": "basic", "front": "Q", "back": "A", "tags": []}],
+        "done": True,
+    }
+
+
+def test_recover_json_does_not_keep_a_half_finished_card():
+    with pytest.raises(ValueError):
+        recover_json('{"cards": [{"type": "basic", "tags": ["a"], "front": "Q')
+
+
+def test_invalid_salvaged_cards_fall_back_to_llm_repair(monkeypatch):
+    repaired = {"cards": [{"type": "basic", "front": "Q", "back": "A"}]}
+    calls = []
+    monkeypatch.setattr(deckgen, "repair_json", lambda *args, **kwargs: calls.append(args) or repaired)
+    truncated = '{"cards": [{"type": "basic", "front": "", "back": ""}, {"type": "basic", "front": "Cut'
+    cards, parsed_json = deckgen.parse_cards(truncated, "repair/model", "key", "", "")
+    assert len(calls) == 1
+    assert parsed_json["cards"] == repaired["cards"]
+    assert cards[0].front == "Q"
+
+
+def test_valid_salvaged_cards_skip_llm_repair(monkeypatch):
+    monkeypatch.setattr(deckgen, "repair_json", lambda *args, **kwargs: pytest.fail("repair_json called"))
+    truncated = '{"cards": [{"type": "basic", "front": "Q", "back": "A"}, {"type": "basic", "front": "Cut'
+    _, parsed_json = deckgen.parse_cards(truncated, "repair/model", "key", "", "")
+    assert parsed_json["cards"] == [{"type": "basic", "front": "Q", "back": "A"}]
+
+
+def test_recovery_counts_are_logged_with_the_run(app, make_deck, openrouter, monkeypatch, caplog):
+    fenced = "```json\n{'cards': [{'type': 'basic', 'front': 'Q', 'back': 'A', 'tags': [],},]}\n```"
+    openrouter.respond = lambda body: (200, completion(fenced))
+    monkeypatch.setattr(deckgen, "_stats_logged_at", None)
+    before = recovery_stats()
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        deckgen.generate_deck(make_deck(sections_text(1)).id)
+    after = recovery_stats()
+    assert after["recovered"] - before["recovered"] == 1
+    assert after["trailing_commas"] - before["trailing_commas"] == 1
+    logged = [record.getMessage() for record in caplog.records if "JSON recovery totals" in record.getMessage()]
+    assert logged == [f"JSON recovery totals for this process: {after}"]
+
+
+def add_runs(deck, latencies, error=None):
+    for latency in latencies:
+        request_json = {"messages": [{"role": "user", "content": "x" * 1000}], "latency_seconds": latency}
+        db.session.add(LLMRun(deck_id=deck.id, request_json=request_json, error=error))
+    db.session.commit()
+
+
+def test_hedge_delay_is_the_configured_latency_percentile(app, make_deck):
+    app.config.update(OPENROUTER_HEDGE_ENABLED=True, OPENROUTER_HEDGE_MIN_SAMPLES=10, OPENROUTER_HEDGE_PERCENTILE=90)
+    deck = make_deck("text")
+    add_runs(deck, [1.0 + index for index in range(9)])
+    add_runs(deck, [60.0], error="timed out")
+    assert deckgen.hedge_options() == {}
+    add_runs(deck, [1.0 + index for index in range(9, 11)])
+    options = deckgen.hedge_options()
+    assert options["hedge_after_seconds"] == 10.0
+    assert options["hedge_budget"].limit == app.config["GENERATION_MAX_HEDGES"]
+
+
+def test_slow_chunk_is_hedged_and_the_faster_reply_wins(app, make_deck, openrouter):
+    app.config.update(
+        OPENROUTER_HEDGE_ENABLED=True,
+        OPENROUTER_HEDGE_MIN_SAMPLES=1,
+        OPENROUTER_HEDGE_MODEL="hedge/model",
+        OPENROUTER_MODEL="main/model",
+    )
+    # History from another deck: starting a run clears the deck's own runs made under other settings.
+    add_runs(make_deck("text"), [0.2])
+    deck = make_deck(sections_text(1))
+    respond = openrouter.respond
+    openrouter.respond = lambda body: (time.sleep(1.5) if body["model"] == "main/model" else None) or respond(body)
+    deckgen.generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert [body["model"] for body in openrouter.requests] == ["main/model", "hedge/model"]
+    run = LLMRun.query.filter(LLMRun.source_id.isnot(None)).one()
+    assert run.request_json["hedged"] is True
+    assert run.request_json["hedge_winner"] == "hedge"
+    assert run.model == "hedge/model"
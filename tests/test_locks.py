@@ -0,0 +1,91 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.extensions import db
+from app.models import BulkJob, Card, ResourceLock, Source
+from app.services.deckgen import begin_generation, regenerate_sources
+from app.services.jobs import create_job
+from app.services.locks import FlightInProgress, acquire_lock, release_lock, renew_lock, single_flight
+from conftest import sections_text
+
+
+def test_expired_locks_are_taken_over(app):
+    token = acquire_lock("source:1")
+    assert acquire_lock("source:1") is None
+    ResourceLock.query.update({ResourceLock.expires_at: datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    assert acquire_lock("source:1") not in (None, token)
+    assert not renew_lock("source:1", token)
+    release_lock("source:1", token)
+    assert ResourceLock.query.count() == 1
+
+
+def test_single_flight_shares_the_running_result(app):
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(10)
+        return {"cards": 3}
+
+    def caller():
+        with app.app_context():
+            results.append(single_flight("improve", 1, "key", work))
+
+    first = threading.Thread(target=caller)
+    first.start()
+    started.wait(10)
+    with pytest.raises(FlightInProgress):
+        single_flight("improve", 1, "key", work, wait=False)
+    second = threading.Thread(target=caller)
+    second.start()
+    time.sleep(0.2)
+    release.set()
+    first.join()
+    second.join()
+    assert calls == [1]
+    assert results == [{"cards": 3}, {"cards": 3}]
+
+
+def test_failed_flight_is_released_for_the_next_caller(app):
+    def broken():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        single_flight("improve", 1, "key", broken)
+    assert ResourceLock.query.count() == 0
+    assert single_flight("improve", 1, "key", lambda: 5) == 5
+
+
+def test_duplicate_regenerate_jobs_share_one_llm_call(app, make_deck, openrouter):
+    deck = make_deck(sections_text(1))
+    begin_generation(deck)
+    source = Source.query.one()
+    first_job, second_job = create_job(deck.id, "regenerate"), create_job(deck.id, "regenerate")
+    respond, release = openrouter.respond, threading.Event()
+    openrouter.respond = lambda body: release.wait(10) and respond(body)
+
+    def first():
+        with app.app_context():
+            regenerate_sources(first_job.id, [source.id])
+
+    runner = threading.Thread(target=first)
+    runner.start()
+    deadline = time.monotonic() + 10
+    while not openrouter.requests and time.monotonic() < deadline:
+        time.sleep(0.05)
+    threading.Timer(0.3, release.set).start()
+    regenerate_sources(second_job.id, [source.id])
+    runner.join()
+    db.session.expire_all()
+    assert len(openrouter.requests) == 1
+    assert [(job.applied, job.failed, job.status) for job in BulkJob.query.order_by(BulkJob.id)] == [
+        (1, 0, "done"),
+        (1, 0, "done"),
+    ]
+    assert Card.query.filter_by(source_id=source.id, status="ok").count() == 2
@@ -0,0 +1,32 @@
+import json
+
+from app.services.progress import start_progress
+
+
+def stream_lines(response):
+    return [line for line in response.get_data(as_text=True).split("\n") if line]
+
+
+def test_progress_stream_ends_once_the_deck_is_finished(app, make_deck):
+    deck = make_deck("text", status="ready")
+    response = app.test_client().get(f"/decks/{deck.id}/progress/stream")
+    assert response.mimetype == "text/event-stream"
+    lines = stream_lines(response)
+    assert lines[0] == "retry: 5000"
+    assert json.loads(lines[1].removeprefix("data: "))["status"] == "ready"
+    assert len(lines) == 2
+
+
+def test_progress_stream_sends_heartbeats_and_stops_at_its_max_duration(app, make_deck):
+    app.config.update(
+        PROGRESS_STREAM_INTERVAL_SECONDS=0.1,
+        PROGRESS_STREAM_HEARTBEAT_SECONDS=0.15,
+        PROGRESS_STREAM_MAX_SECONDS=0.5,
+    )
+    deck = make_deck("text", status="processing")
+    start_progress(deck.id, 4, 0)
+    lines = stream_lines(app.test_client().get(f"/decks/{deck.id}/progress/stream"))
+    data = [line for line in lines if line.startswith("data: ")]
+    assert len(data) == 1
+    assert json.loads(data[0].removeprefix("data: "))["total_chunks"] == 4
+    assert ": keep-alive" in lines
@@ -0,0 +1,66 @@
+import time
+
+import fakeredis
+import pytest
+import redis
+
+from app.services.ratelimit import LocalRateLimiter, RateLimitTimeout, RedisRateLimiter
+
+
+@pytest.fixture
+def shared_redis(monkeypatch):
+    # Every limiter instance talks to the same in-memory server, like processes sharing one Redis.
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server))
+    return server
+
+
+def test_redis_limiter_caps_in_flight_requests_across_processes(shared_redis):
+    first = RedisRateLimiter("redis://shared", rate=100, burst=100, initial_concurrency=2)
+    second = RedisRateLimiter("redis://shared", rate=100, burst=100, initial_concurrency=2)
+    slots = [first.acquire(timeout=1), second.acquire(timeout=1)]
+    assert all(slots)
+    with pytest.raises(RateLimitTimeout):
+        second.acquire(timeout=0.2)
+    first.release(slots[0])
+    assert second.acquire(timeout=1)
+
+
+def test_redis_limiter_refills_its_token_bucket_at_the_configured_rate(shared_redis):
+    limiter = RedisRateLimiter("redis://shared", rate=5, burst=2, initial_concurrency=10)
+    assert limiter.acquire(timeout=1) and limiter.acquire(timeout=1)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(timeout=0.05)
+    started = time.monotonic()
+    assert limiter.acquire(timeout=1)
+    assert time.monotonic() - started < 0.5
+
+
+def test_redis_limiter_backs_off_on_throttling_and_honours_retry_after(shared_redis):
+    limiter = RedisRateLimiter("redis://shared", rate=100, burst=100, initial_concurrency=4)
+    other = RedisRateLimiter("redis://shared", rate=100, burst=100, initial_concurrency=4)
+    limiter.record_throttle(retry_after=0.5)
+    assert float(fakeredis.FakeRedis(server=shared_redis).get("ankigpt:ratelimit:limit")) == 2
+    with pytest.raises(RateLimitTimeout):
+        other.acquire(timeout=0.2)
+    time.sleep(0.4)
+    assert other.acquire(timeout=1)
+    limiter.record_success()
+    assert float(fakeredis.FakeRedis(server=shared_redis).get("ankigpt:ratelimit:limit")) == 2.5
+
+
+def test_redis_limiter_lets_requests_through_when_redis_is_down():
+    limiter = RedisRateLimiter("redis://127.0.0.1:1/0")
+    assert limiter.acquire(timeout=1) is None
+    limiter.release(None)
+    limiter.record_throttle(retry_after=5)
+
+
+def test_local_limiter_halves_concurrency_on_throttling():
+    limiter = LocalRateLimiter(rate=100, burst=100, initial_concurrency=4)
+    limiter.record_throttle()
+    slots = [limiter.acquire(timeout=1), limiter.acquire(timeout=1)]
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(timeout=0.1)
+    limiter.release(slots[0])
+    assert limiter.acquire(timeout=1)
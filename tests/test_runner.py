@@ -0,0 +1,61 @@
+import time
+from datetime import datetime, timedelta
+
+from app import tasks
+from app.extensions import db
+from app.models import BackgroundTask, Deck
+from app.services.runner import LocalRunner
+from conftest import sections_text
+
+
+def stale_task(name, args, attempts, heartbeat_age):
+    task = BackgroundTask(
+        name=name,
+        args=args,
+        status="running",
+        attempts=attempts,
+        owner="dead-host:1:0",
+        heartbeat_at=datetime.utcnow() - timedelta(seconds=heartbeat_age),
+    )
+    db.session.add(task)
+    db.session.commit()
+    return task.id
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db.session.expire_all()
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_stale_tasks_are_requeued_until_their_attempts_run_out(app):
+    runner = LocalRunner(app, poll_seconds=0.1, stale_seconds=1, max_attempts=2)
+    retried = stale_task("app.tasks.export_deck_task", [1], attempts=1, heartbeat_age=60)
+    exhausted = stale_task("app.tasks.export_deck_task", [2], attempts=2, heartbeat_age=60)
+    alive = stale_task("app.tasks.export_deck_task", [3], attempts=1, heartbeat_age=0)
+    runner._recover()
+    db.session.expire_all()
+    assert (BackgroundTask.query.get(retried).status, BackgroundTask.query.get(retried).owner) == ("queued", None)
+    assert BackgroundTask.query.get(exhausted).status == "failed"
+    assert BackgroundTask.query.get(exhausted).error == "Worker stopped while running this task."
+    assert BackgroundTask.query.get(alive).status == "running"
+    runner.stop()
+
+
+def test_restarted_runner_finishes_a_task_its_dead_process_left_running(app, make_deck, openrouter):
+    deck = make_deck(sections_text(2), status="processing")
+    task_id = stale_task(tasks.generate_deck_task.name, [deck.id], attempts=1, heartbeat_age=60)
+    runner = LocalRunner(app, poll_seconds=0.1, stale_seconds=1)
+    runner.start()
+    try:
+        assert wait_for(lambda: BackgroundTask.query.get(task_id).status in ("done", "failed"))
+    finally:
+        runner.stop()
+    task = BackgroundTask.query.get(task_id)
+    assert (task.status, task.attempts, task.owner) == ("done", 2, runner.owner)
+    assert Deck.query.get(deck.id).status == "ready"
+    assert len(openrouter.requests) == 2
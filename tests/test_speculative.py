@@ -0,0 +1,72 @@
+import threading
+import time
+
+from app.extensions import db
+from app.models import Deck, LLMRun
+from app.services.deckgen import DEFAULT_GENERATION_SETTINGS, generate_deck, speculate_deck
+from conftest import sections_text
+
+
+# The defaults, with chunks small enough for one per section.
+SETTINGS = dict(DEFAULT_GENERATION_SETTINGS, max_chars=900)
+
+
+def speculative_deck(make_deck, count=2):
+    # A draft as the new-deck form leaves it with SPECULATIVE_GENERATION on.
+    deck = make_deck(sections_text(count), status="draft")
+    deck.settings_json = dict(SETTINGS, speculative=True)
+    db.session.commit()
+    return deck
+
+
+def submit(deck, **settings):
+    # What the preview form does before queueing the generation task.
+    deck.settings_json = dict(SETTINGS, **settings)
+    deck.status = "processing"
+    db.session.commit()
+
+
+def test_speculative_run_leaves_a_draft_that_a_matching_submit_adopts(make_deck, openrouter):
+    deck = speculative_deck(make_deck)
+    speculate_deck(deck.id)
+    db.session.expire_all()
+    assert Deck.query.get(deck.id).status == "draft"
+    assert len(openrouter.requests) == 2
+    submit(deck)
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 2
+
+
+def test_submit_with_other_settings_supersedes_the_speculative_results(make_deck, openrouter):
+    deck = speculative_deck(make_deck)
+    speculate_deck(deck.id)
+    submit(deck, focus="enzymes")
+    generate_deck(deck.id)
+    assert deck.status == "ready"
+    assert len(openrouter.requests) == 4
+    assert all("enzymes" in prompt for prompt in openrouter.prompts()[2:])
+    assert LLMRun.query.filter_by(error=None).count() == 2
+
+
+def test_matching_submit_joins_a_speculative_run_in_flight(app, make_deck, openrouter):
+    deck = speculative_deck(make_deck)
+    respond, release = openrouter.respond, threading.Event()
+    openrouter.respond = lambda body: release.wait(10) and respond(body)
+
+    def speculate():
+        with app.app_context():
+            speculate_deck(deck.id)
+
+    runner = threading.Thread(target=speculate)
+    runner.start()
+    deadline = time.monotonic() + 10
+    while not openrouter.requests and time.monotonic() < deadline:
+        time.sleep(0.05)
+    submit(deck)
+    threading.Timer(0.3, release.set).start()
+    generate_deck(deck.id)
+    runner.join()
+    db.session.expire_all()
+    assert Deck.query.get(deck.id).status == "ready"
+    assert len(openrouter.requests) == 2
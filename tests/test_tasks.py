@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app import tasks
+from app.extensions import db
+from app.models import ChunkDispatch, Deck, LLMRun, ResourceLock
+from app.services import deckgen
+from app.services.chunk_queue import admit_chunks, queue_depth
+from app.services.locks import FlightInProgress
+from app.services.scheduler import PRIORITY_BULK, PRIORITY_SMALL
+from conftest import sections_text
+
+
+@pytest.fixture(autouse=True)
+def subtasks(app):
+    app.config.update(GENERATION_SUBTASKS=True, CHUNK_TASK_RETRY_DELAY_SECONDS=0)
+
+
+def test_eager_subtasks_finalise_the_deck_and_release_its_lock(make_deck, openrouter):
+    deck = make_deck(sections_text(5), status="processing")
+    tasks.generate_deck_task(deck.id)
+    db.session.expire_all()
+    assert Deck.query.get(deck.id).status == "ready"
+    assert LLMRun.query.filter_by(error=None).count() == 5
+    assert len(openrouter.requests) == 5
+    assert ChunkDispatch.query.count() == 0
+    assert ResourceLock.query.count() == 0
+
+
+def test_crashed_chunk_task_still_finalises_the_deck(make_deck, monkeypatch):
+    persist = deckgen.persist_chunk_cards
+
+    def crash(deck_id, source, *args, **kwargs):
+        if source.idx == 2:
+            raise RuntimeError("worker crashed")
+        return persist(deck_id, source, *args, **kwargs)
+
+    monkeypatch.setattr(deckgen, "persist_chunk_cards", crash)
+    deck = make_deck(sections_text(4), status="processing")
+    tasks.generate_deck_task(deck.id)
+    db.session.expire_all()
+    deck = Deck.query.get(deck.id)
+    assert deck.status == "partial"
+    assert deck.settings_json["last_error"] == "The chunk task stopped unexpectedly."
+    assert LLMRun.query.filter_by(error=None).count() == 3
+    assert ChunkDispatch.query.count() == 0
+    assert ResourceLock.query.count() == 0
+
+
+def test_lost_chunk_tasks_are_reclaimed_and_the_deck_finalised(make_deck, monkeypatch):
+    queue_task = tasks.queue_task
+    # The broker accepts the chunk tasks, but no worker ever reports back.
+    monkeypatch.setattr(
+        tasks,
+        "queue_task",
+        lambda task, *args, **kwargs: None if task is tasks.generate_chunk_task else queue_task(task, *args, **kwargs),
+    )
+    deck = make_deck(sections_text(3), status="processing")
+    tasks.generate_deck_task(deck.id)
+    db.session.expire_all()
+    assert Deck.query.get(deck.id).status == "processing"
+    assert ChunkDispatch.query.filter_by(status="dispatched").count() == 3
+
+    monkeypatch.setattr(tasks, "queue_task", queue_task)
+    ChunkDispatch.query.update({ChunkDispatch.dispatched_at: datetime.utcnow() - timedelta(hours=1)})
+    db.session.commit()
+    tasks.pump_chunks()
+    db.session.expire_all()
+    deck = Deck.query.get(deck.id)
+    assert deck.status == "failed"
+    assert ChunkDispatch.query.count() == 0
+    assert ResourceLock.query.count() == 0
+
+
+def test_duplicate_dispatch_is_refused_while_a_run_holds_the_deck(make_deck, monkeypatch):
+    monkeypatch.setattr(tasks, "queue_task", lambda task, *args, **kwargs: None)
+    deck = make_deck(sections_text(2), status="processing")
+    tasks.dispatch_generation(deck.id)
+    lock_count = ResourceLock.query.count()
+    with pytest.raises(FlightInProgress):
+        tasks.dispatch_generation(deck.id)
+    assert ResourceLock.query.count() == lock_count
+    assert ChunkDispatch.query.count() == 2
+
+
+def add_waiting(user_id, deck_id, count, priority=PRIORITY_BULK):
+    rows = [
+        ChunkDispatch(
+            deck_id=deck_id,
+            source_id=index,
+            user_id=user_id,
+            priority=priority,
+            run_token=f"run-{user_id}",
+            lock_name=f"flight:generate:{deck_id}:key",
+        )
+        for index in range(count)
+    ]
+    db.session.add_all(rows)
+    db.session.commit()
+
+
+def test_dispatch_slots_alternate_between_users(app, make_deck):
+    app.config.update(SCHEDULER_DISPATCH_CONCURRENCY=4, SCHEDULER_USER_CONCURRENCY=3)
+    deck = make_deck("text")
+    add_waiting(1, deck.id, 6)
+    add_waiting(2, deck.id, 2)
+    assert [row.user_id for row in admit_chunks()] == [1, 2, 1, 2]
+    assert admit_chunks() == []
+    assert queue_depth(1) == {"waiting": 4, "running": 2}
+    assert queue_depth(2) == {"waiting": 0, "running": 2}
+
+
+def test_small_decks_get_more_dispatch_slots(app, make_deck):
+    app.config.update(SCHEDULER_DISPATCH_CONCURRENCY=5, SCHEDULER_USER_CONCURRENCY=8)
+    deck = make_deck("text")
+    add_waiting(1, deck.id, 8, PRIORITY_BULK)
+    add_waiting(2, deck.id, 8, PRIORITY_SMALL)
+    admitted = [row.user_id for row in admit_chunks()]
+    assert admitted.count(2) == 4
+    assert admitted.count(1) == 1
+
+
+def test_admitting_a_large_backlog_reads_the_waiting_rows_once(app, make_deck):
+    app.config.update(SCHEDULER_DISPATCH_CONCURRENCY=30, SCHEDULER_USER_CONCURRENCY=12)
+    deck = make_deck("text")
+    for user_id in (1, 2, 3):
+        add_waiting(user_id, deck.id, 200)
+    statements = []
+    engine = db.engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        admitted = admit_chunks()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert len(admitted) == 30
+    assert {user_id: [row.user_id for row in admitted].count(user_id) for user_id in (1, 2, 3)} == {1: 10, 2: 10, 3: 10}
+    assert len([sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]) <= 6
@@ -0,0 +1,50 @@
+import io
+import os
+
+from app.extensions import db
+from app.models import Deck, Source
+from app.services import deckgen
+from conftest import make_pdf
+
+
+def upload(client, pages, filename="notes.pdf"):
+    return client.post(
+        "/decks/new",
+        data={
+            "title": "Upload",
+            "source_type": "pdf",
+            "stream": "1",
+            "pdf_file": (io.BytesIO(make_pdf(pages)), filename),
+        },
+        content_type="multipart/form-data",
+    )
+
+
+def test_streamed_uploads_with_the_same_name_keep_their_own_text(app, openrouter):
+    client = app.test_client()
+    upload(client, ["Mitochondria produce energy for the cell.", "Ribosomes assemble proteins."])
+    upload(client, ["Chloroplasts capture sunlight."])
+    db.session.expire_all()
+    first, second = Deck.query.order_by(Deck.id).all()
+    assert first.status == second.status == "ready"
+    assert "Ribosomes" in first.source_text and "Chloroplasts" not in first.source_text
+    assert "Chloroplasts" in second.source_text and "Mitochondria" not in second.source_text
+    assert "pdf_upload" not in first.settings_json
+    assert Source.query.filter_by(deck_id=second.id).count() == 1
+    assert os.listdir(app.config["UPLOAD_FOLDER"]) == []
+
+
+def test_upload_is_removed_when_extraction_fails(app, openrouter, monkeypatch):
+    def broken_pages(path, start=None, end=None):
+        yield "Mitochondria produce energy for the cell."
+        raise ValueError("corrupt xref table")
+
+    monkeypatch.setattr(deckgen, "iter_pdf_pages", broken_pages)
+    upload(app.test_client(), ["Mitochondria produce energy for the cell.", "Ribosomes assemble proteins."])
+    db.session.expire_all()
+    deck = Deck.query.one()
+    assert deck.status in ("failed", "partial")
+    assert deck.settings_json["last_error"] == "PDF extraction stopped early: corrupt xref table"
+    assert "pdf_upload" not in deck.settings_json
+    assert deck.source_text == "Mitochondria produce energy for the cell."
+    assert os.listdir(app.config["UPLOAD_FOLDER"]) == []